@@ -0,0 +1,313 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import sys
+import asyncio
+import argparse
+import logging
+import time
+import tracemalloc
+import datetime
+import numpy as np
+import pandas as pd
+
+from mlfdb import mlfdb, encoder, pgcopy
+
+
+def make_df(cells, params=20):
+    """
+    Create wide dataframe with approximately given amount of cells
+    """
+    n = max(cells // params, 1)
+    df = pd.DataFrame({'time': 1514764800 + 3600 * (np.arange(n) % 8760),
+                       'loc_id': np.arange(n) // 8760 + 1,
+                       'lon': np.full(n, 24.9),
+                       'lat': np.full(n, 60.2)})
+    for i in range(params):
+        df['param_{}'.format(i)] = np.random.rand(n)
+    return df
+
+
+def iterrows_values(_type, df, dataset, row_offset=0, time_column='time', loc_column='loc_id'):
+    """
+    Per cell loop used by add_rows_from_df before the columnar encoder
+    """
+    columns = list(df.columns.values)[4:]
+    values = []
+    row_num = -1
+    for i, data_row in df.iterrows():
+        row_num += 1
+        j = 4
+        for param in columns:
+            t = datetime.datetime.fromtimestamp(int(data_row[time_column]))
+            loc_id = data_row[loc_column]
+            value = data_row.iloc[j]
+            row = _type+'-'+dataset+'-'+str(t.timestamp())+'-'+str(loc_id)+'-'+str(int(row_num)+int(row_offset))
+            values.append("('{_type}', '{dataset}', '{time}', {location_id}, '{parameter}', {value}, '{row}')".format(_type=_type, dataset=dataset, time=t.strftime('%Y-%m-%d %H:%M:%S'), location_id=loc_id, parameter=param, value=value, row=row))
+            j += 1
+    return values
+
+
+def encoder_values(_type, df, dataset):
+    """
+    INSERT values built from the columnar encoder
+    """
+    long = encoder.to_long(encoder.encode_df(_type, df, dataset))
+    return encoder.concat_str("('{}', '{}', '".format(_type, dataset), long['timestr'], "', ",
+                              long['location_id'].astype(str), ", '", long['parameter'], "', ",
+                              encoder.value_strings(long['value']), ", '", long['row'], "')").tolist()
+
+
+def timeit(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def bench_encoder(options):
+    """
+    Compare iterrows loop against columnar encoder
+    """
+    for cells in options.sizes:
+        df = make_df(cells)
+        n = df.shape[0] * (df.shape[1] - 4)
+
+        results = []
+        if cells <= options.max_loop_cells:
+            results.append(('iterrows loop', timeit(iterrows_values, 'feature', df, 'bench')))
+        results.append(('encoder insert values', timeit(encoder_values, 'feature', df, 'bench')))
+
+        for copy_format, serialize in (('text', pgcopy.text_buffer_columns), ('binary', pgcopy.binary_buffer_columns)):
+            def run():
+                for batch in encoder.iter_long(encoder.encode_df('feature', df, 'bench'), options.batch_size):
+                    serialize(batch)
+            results.append(('encoder copy {}'.format(copy_format), timeit(run)))
+
+        for name, elapsed in results:
+            print('{:>9} cells | {:<22} | {:8.3f}s | {:12.0f} cells/s'.format(n, name, elapsed, n / max(elapsed, 1e-9)))
+
+
+def connect(options):
+    """
+    Create mlfdb instance from benchmark options
+    """
+    return mlfdb.mlfdb(config_filename=options.config, schema=options.schema,
+                       pool_maxconn=max(options.workers, 1))
+
+
+def as_float(a):
+    """
+    Convert result array (possibly object dtype with None) to float
+    """
+    return np.array([[np.nan if v is None else v for v in row] for row in a], dtype=np.float64)
+
+
+def bench_pivot(options):
+    """
+    Compare crosstab and client side numpy pivot engines of get_rows
+    """
+    starttime = datetime.datetime.strptime(options.starttime, '%Y%m%d%H%M')
+    endtime = datetime.datetime.strptime(options.endtime, '%Y%m%d%H%M')
+
+    with connect(options) as a:
+        results = {}
+        for engine in ('crosstab', 'numpy'):
+            start = time.time()
+            for i in range(options.repeat):
+                metadata, header, data = a.get_rows(options.dataset, starttime, endtime,
+                                                    rowtype=options.rowtype,
+                                                    parameters=list(options.parameters),
+                                                    workers=options.workers,
+                                                    engine=engine)
+            elapsed = (time.time() - start) / options.repeat
+            results[engine] = (as_float(metadata), as_float(data))
+            print('{:<9} | {:8} rows | {:8.3f}s | {:10.0f} rows/s'.format(engine, len(data), elapsed, len(data) / max(elapsed, 1e-9)))
+
+    (meta_c, data_c), (meta_n, data_n) = results['crosstab'], results['numpy']
+    same = meta_c.shape == meta_n.shape and np.allclose(meta_c, meta_n, equal_nan=True) and np.allclose(data_c, data_n, equal_nan=True)
+    print('Outputs match: {}'.format(same))
+
+
+def crosstab_rows(n, params=20, missing=0.01):
+    """
+    Create list of row tuples like returned by the crosstab query
+    """
+    values = np.random.rand(n, params)
+    rows = []
+    for i in range(n):
+        row = [None if v < missing else float(v) for v in values[i]]
+        rows.append(tuple([i // 8760 + 1, 1514764800 + 3600 * (i % 8760), 24.9, 60.2] + row))
+    return rows
+
+
+def bench_typed(options):
+    """
+    Compare memory and time of object array and typed decoding of get_rows results
+    """
+    a = mlfdb.mlfdb(config_filename=options.config)
+    for cells in options.sizes:
+        n = max(cells // 20, 1)
+        parameters = ['param_{}'.format(i) for i in range(20)]
+
+        for name, decode in (('object array', lambda rows: a._rows_to_result(rows, parameters, 'feature', 'np')),
+                             ('typed float64', lambda rows: a._typed_result([rows], parameters, 'np', 'float64', rows=True)),
+                             ('typed float32', lambda rows: a._typed_result([rows], parameters, 'np', 'float32', rows=True)),
+                             ('typed pandas', lambda rows: a._typed_result([rows], parameters, 'pandas', 'float64', rows=True))):
+            rows = crosstab_rows(n)
+            tracemalloc.start()
+            start = time.time()
+            result = decode(rows)
+            elapsed = time.time() - start
+            del rows
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del result
+            print('{:>9} cells | {:<13} | {:8.3f}s | retained {:10.1f} MB | peak {:10.1f} MB'.format(n * 20, name, elapsed, retained / 1024**2, peak / 1024**2))
+
+
+def bench_async(options):
+    """
+    Compare throughput of fetching several datasets with the sync client
+    and concurrently with the asyncio client
+    """
+    from mlfdb import aio
+
+    starttime = datetime.datetime.strptime(options.starttime, '%Y%m%d%H%M')
+    endtime = datetime.datetime.strptime(options.endtime, '%Y%m%d%H%M')
+    datasets = options.datasets or [options.dataset]
+
+    def rows(results):
+        return sum(len(r) if isinstance(r, pd.DataFrame) else len(r[0]) for r in results)
+
+    with connect(options) as a:
+        start = time.time()
+        for i in range(options.repeat):
+            results = [a.get_rows(dataset, starttime, endtime, rowtype=options.rowtype,
+                                  parameters=list(options.parameters), workers=options.workers,
+                                  use_cache=False)
+                       for dataset in datasets]
+        elapsed = (time.time() - start) / options.repeat
+        n = rows(results)
+        print('{:<5} | {:3} datasets | {:8} rows | {:8.3f}s | {:10.0f} rows/s'.format('sync', len(datasets), n, elapsed, n / max(elapsed, 1e-9)))
+
+    async def run():
+        async with aio.aiomlfdb(config_filename=options.config, schema=options.schema,
+                                pool_maxconn=max(options.workers, 1)) as a:
+            start = time.time()
+            for i in range(options.repeat):
+                results = await asyncio.gather(*[a.get_rows(dataset, starttime, endtime, rowtype=options.rowtype,
+                                                            parameters=list(options.parameters), use_cache=False)
+                                                 for dataset in datasets])
+            return results, (time.time() - start) / options.repeat
+
+    results, elapsed = asyncio.run(run())
+    n = rows(results)
+    print('{:<5} | {:3} datasets | {:8} rows | {:8.3f}s | {:10.0f} rows/s'.format('async', len(datasets), n, elapsed, n / max(elapsed, 1e-9)))
+
+
+def relation_sizes(a):
+    """
+    Return (table bytes, index bytes) of data table including all partitions
+    """
+    sql = """
+    WITH RECURSIVE tree AS (
+      SELECT '{schema}.data'::regclass AS oid
+      UNION ALL
+      SELECT i.inhrelid::regclass FROM pg_inherits i JOIN tree ON i.inhparent = tree.oid)
+    SELECT sum(pg_table_size(oid)), sum(pg_indexes_size(oid)) FROM tree""".format(schema=a.schema)
+    return tuple(int(v or 0) for v in a._query(sql)[0])
+
+
+def bench_layout(options):
+    """
+    Compare size and read speed of the same data in long and compact
+    layout schemas (see db/create_db.py --layout and --migrate_compact)
+    """
+    starttime = datetime.datetime.strptime(options.starttime, '%Y%m%d%H%M')
+    endtime = datetime.datetime.strptime(options.endtime, '%Y%m%d%H%M')
+
+    for schema in (options.schema, options.compact_schema):
+        with mlfdb.mlfdb(config_filename=options.config, schema=schema,
+                         pool_maxconn=max(options.workers, 1)) as a:
+            table, index = relation_sizes(a)
+            cells = a._query('SELECT count(1) FROM {schema}.data'.format(schema=schema))[0][0]
+            layout = 'compact' if a._compact() else 'long'
+            print('{:<7} | {:>10} cells | table {:10.1f} MB | indexes {:10.1f} MB | {:6.1f} bytes/cell'.format(
+                layout, cells, table / 1024**2, index / 1024**2, (table + index) / max(cells, 1)))
+
+            sql = "SELECT count(1), sum(value) FROM {schema}.data a WHERE {where} AND a.time > '{start}' AND a.time <= '{end}'".format(
+                schema=schema, where=a._filter_sql(options.dataset, options.rowtype, 'a.'),
+                start=starttime.strftime('%Y-%m-%d %H:%M:%S'), end=endtime.strftime('%Y-%m-%d %H:%M:%S'))
+            scan = timeit(lambda: [a._query(sql) for i in range(options.repeat)]) / options.repeat
+
+            for engine in ('crosstab', 'numpy'):
+                start = time.time()
+                for i in range(options.repeat):
+                    result = a.get_rows(options.dataset, starttime, endtime, rowtype=options.rowtype,
+                                        parameters=list(options.parameters), workers=options.workers,
+                                        engine=engine, use_cache=False)
+                elapsed = (time.time() - start) / options.repeat
+                n = len(result) if isinstance(result, pd.DataFrame) else len(result[0])
+                print('{:<7} | {:<8} | {:8} rows | get_rows {:8.3f}s | scan {:8.3f}s'.format(layout, engine, n, elapsed, scan))
+
+
+BENCHMARKS = {'encoder': bench_encoder,
+              'pivot': bench_pivot,
+              'typed': bench_typed,
+              'async': bench_async,
+              'layout': bench_layout}
+
+
+def main():
+    """
+    Run benchmarks
+    """
+    BENCHMARKS[options.bench](options)
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench',
+                        type=str,
+                        default='encoder',
+                        choices=sorted(BENCHMARKS.keys()),
+                        help='Benchmark to run, default encoder')
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[10**4, 10**5, 10**6],
+                        help='Amount of cells, default 10^4 10^5 10^6')
+    parser.add_argument('--max_loop_cells',
+                        type=int,
+                        default=10**6,
+                        help='Largest size run with the iterrows loop, default 10^6')
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=100000,
+                        help='Cells in one COPY batch, default 100000')
+    parser.add_argument('--config', type=str, default=None, help='Database config file, default ~/.mlfdbconfig')
+    parser.add_argument('--schema', type=str, default='traindata', help='Schema, default traindata')
+    parser.add_argument('--compact_schema', type=str, default='traindata_compact', help='Schema with compact layout compared in layout benchmark, default traindata_compact')
+    parser.add_argument('--dataset', type=str, default=None, help='Dataset name')
+    parser.add_argument('--datasets', type=str, nargs='*', default=[], help='Dataset names fetched concurrently in async benchmark, default --dataset')
+    parser.add_argument('--rowtype', type=str, default='feature', help='feature/label')
+    parser.add_argument('--parameters', type=str, nargs='*', default=[], help='Parameters to fetch, default all')
+    parser.add_argument('--starttime', type=str, default=None, help='Start time (YYYYMMDDHHMM)')
+    parser.add_argument('--endtime', type=str, default=None, help='End time (YYYYMMDDHHMM)')
+    parser.add_argument('--workers', type=int, default=1, help='Concurrent queries (pool size of async benchmark), default 1')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions of database benchmarks, default 3')
+    parser.add_argument('--logging_level',
+                        type=str,
+                        default='INFO',
+                        help='options: DEBUG,INFO,WARNING,ERROR,CRITICAL')
+
+    options = parser.parse_args()
+
+    logging_level = {'DEBUG':logging.DEBUG,
+                     'INFO':logging.INFO,
+                     'WARNING':logging.WARNING,
+                     'ERROR':logging.ERROR,
+                     'CRITICAL':logging.CRITICAL}
+    logging.basicConfig(format=("[%(levelname)s] %(asctime)s %(filename)s:%(funcName)s:%(lineno)s %(message)s"), level=logging_level[options.logging_level])
+
+    main()
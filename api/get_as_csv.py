@@ -1,59 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
 import sys
 import argparse
 import logging
 import datetime as dt
-import json
-import itertools
-import numpy as np
 
-from lib import mlfb
+from mlfdb import mlfdb, export
 
-def main():
+
+def main(options):
     """
-    Get data from db and save it as csv
+    Get data from db and save it as csv, parquet or arrow file
     """
-    
-    logging.info('Loading classification dataset from db')
-    # start_time = dt.datetime.strptime(options.start_time, "%Y%m%d%H%M")
-    # end_time = dt.datetime.strptime(options.end_time, "%Y%m%d%H%M")
-
-    a = mlfb.mlfb(1, logging_level=options.logging_level)
-    metadata, header, data = a.get_rows(options.dataset, rowtype=options.type)
+    starttime = dt.datetime.strptime(options.starttime, "%Y%m%d%H%M")
+    endtime = dt.datetime.strptime(options.endtime, "%Y%m%d%H%M")
 
-    logging.debug('Length of metadata: {}'.format(len(metadata)))
-    logging.debug('Shape of data {}'.format(data.shape))
-    logging.debug('Header is: {}'.format(','.join(header)))
+    fmt = options.format
+    if fmt is None:
+        ext = os.path.splitext(options.save_path)[1].lstrip('.').lower()
+        fmt = {'pq': 'parquet', 'feather': 'arrow', 'ipc': 'arrow'}.get(ext, ext)
+        if fmt not in export.FORMATS:
+            fmt = 'csv'
 
-    print(header)
-    print(np.array(metadata))
-    print(data)
-    
-    # TODO saving as csv
-    
-    # Serialize model to disc
-    # logging.info('Serializing dataset to disc: {}'.format(options.save_path))
-    
-    # csv = dataset.as_csv()
-    # with open(options.save_path, "w") as f: 
-    #    f.write(csv)
+    logging.info('Exporting dataset {} ({}) from {} to {} as {}'.format(options.dataset, options.type, starttime, endtime, fmt))
+    with mlfdb.mlfdb(config_filename=options.config, schema=options.schema,
+                     logging_level=options.logging_level,
+                     pool_maxconn=max(options.workers, 1)) as a:
+        stats = a.export_rows(options.save_path, options.dataset, starttime, endtime,
+                              rowtype=options.type, parameters=options.parameters or None,
+                              format=fmt, chunk_size=options.chunk_size, workers=options.workers)
 
+    logging.info('{} rows, {:.1f} MB written to {} ({:.0f} rows/s)'.format(stats['rows'], stats['bytes'] / 1024**2, options.save_path,
+                                                                           stats['rows'] / max(stats['seconds'], 1e-9)))
 
-if __name__=='__main__':
 
+def parse_args(args=None, rowtype='feature'):
     parser = argparse.ArgumentParser()
-    parser.add_argument('--starttime', type=str, help='Start time of the classification data interval')
-    parser.add_argument('--endtime', type=str, help='End time of the classification data interval')
-    parser.add_argument('--save_path', type=str, default=None, help='Dataset save path and filename')
-    parser.add_argument('--dataset', type=str, default=None, help='Dataset name')
-    parser.add_argument('--type', type=str, default='feature', help='feature/label')
+    parser.add_argument('--starttime', type=str, required=True, help='Start time of the data interval (YYYYMMDDHHMM)')
+    parser.add_argument('--endtime', type=str, required=True, help='End time of the data interval (YYYYMMDDHHMM)')
+    parser.add_argument('--save_path', type=str, required=True, help='Dataset save path and filename')
+    parser.add_argument('--dataset', type=str, required=True, help='Dataset name')
+    parser.add_argument('--type', type=str, default=rowtype, help='feature/label, default {}'.format(rowtype))
+    parser.add_argument('--format', type=str, default=None, choices=export.FORMATS, help='Output format, default from save_path extension (csv if unknown)')
+    parser.add_argument('--parameters', type=str, nargs='*', default=[], help='Parameters to export, default all')
+    parser.add_argument('--chunk_size', type=int, default=30, help='Days exported at once, default 30')
+    parser.add_argument('--workers', type=int, default=1, help='Chunks fetched concurrently, default 1')
+    parser.add_argument('--config', type=str, default=None, help='Database config file, default ~/.mlfdbconfig')
+    parser.add_argument('--schema', type=str, default='traindata', help='Schema, default traindata')
     parser.add_argument('--logging_level',
                         type=str,
                         default='INFO',
                         help='options: DEBUG,INFO,WARNING,ERROR,CRITICAL')
 
-    options = parser.parse_args()
-    
-    debug=False
+    options = parser.parse_args(args)
 
     logging_level = {'DEBUG':logging.DEBUG,
                      'INFO':logging.INFO,
@@ -61,5 +61,8 @@ if __name__=='__main__':
                      'ERROR':logging.ERROR,
                      'CRITICAL':logging.CRITICAL}
     logging.basicConfig(format=("[%(levelname)s] %(asctime)s %(filename)s:%(funcName)s:%(lineno)s %(message)s"), level=logging_level[options.logging_level])
+    return options
 
-    main()
+
+if __name__=='__main__':
+    main(parse_args())
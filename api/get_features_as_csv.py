@@ -1,10 +1,12 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-import psycopg2
-from config import config
-from configparser import ConfigParser
-from lib import mlfb
+"""
+Export features of a dataset (see get_as_csv.py for options)
 
-# Example script to use mlfb class
+    python get_features_as_csv.py --dataset ds --starttime 201801010000 --endtime 201901010000 --save_path features.parquet
+"""
+import get_as_csv
 
 
+if __name__=='__main__':
+    get_as_csv.main(get_as_csv.parse_args(rowtype='feature'))
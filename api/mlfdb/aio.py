@@ -0,0 +1,540 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+asyncio client for mlfdb
+
+Mirrors the main read and write methods of mlfdb.mlfdb as coroutines
+on top of asyncpg. All queries share one asyncpg pool, so chunks of
+one get_rows call as well as calls for different datasets are in
+flight at the same time on a single event loop:
+
+    async with aiomlfdb(pool_maxconn=16) as a:
+        results = await asyncio.gather(*[a.get_rows(d, start, end) for d in datasets])
+
+SQL is built with the same helpers as the synchronous client. Requires
+asyncpg (pip install mlfdb[async]).
+"""
+import io
+import time
+import asyncio
+import logging
+import numpy as np
+import pandas as pd
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from . import encoder
+from . import pgcopy
+from .mlfdb import mlfdb
+from .catalog import WriteStats
+
+
+class aiomlfdb(object):
+
+    pool = None
+
+    def __init__(self, id=1, logging_level='INFO', config_filename=None, schema='traindata',
+                 pool_minconn=1, pool_maxconn=10, pool_idle_timeout=300,
+                 cache_dir=None, cache_max_bytes=10*1024**3, layout=None):
+        """
+        Arguments are the same as with mlfdb.mlfdb. pool_maxconn limits
+        the amount of queries in flight at the same time.
+        """
+        if asyncpg is None:
+            raise ImportError('asyncpg is required for the asyncio client (pip install mlfdb[async])')
+
+        self.db = mlfdb(id=id, logging_level=logging_level, config_filename=config_filename,
+                        schema=schema, cache_dir=cache_dir, cache_max_bytes=cache_max_bytes,
+                        layout=layout)
+        # Ids of compact layout are looked up here and read from the cache by the SQL helpers
+        self.db._resolve_ids = False
+        self.schema = schema
+        self.pool_options = {'min_size': pool_minconn,
+                             'max_size': pool_maxconn,
+                             'max_inactive_connection_lifetime': pool_idle_timeout}
+        self._pool_lock = asyncio.Lock()
+
+    async def connect(self):
+        """ Create connection pool """
+        async with self._pool_lock:
+            if self.pool is None:
+                logging.info('Connecting to the PostgreSQL database...')
+                params = self.db.config()
+                if 'dbname' in params:
+                    params['database'] = params.pop('dbname')
+                if 'port' in params:
+                    params['port'] = int(params['port'])
+                self.pool = await asyncpg.create_pool(**params, **self.pool_options)
+        return self.pool
+
+    async def close(self):
+        """ Close all pooled connections """
+        async with self._pool_lock:
+            if self.pool is not None:
+                await self.pool.close()
+                self.pool = None
+                logging.debug('Database connections closed.')
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def execute(self, statement):
+        """
+        Execute SQL statement(s) in one transaction
+        """
+        pool = await self.connect()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                return await conn.execute(statement)
+
+    async def _query(self, sql):
+        """
+        Execute query and return results
+
+        return list of tuples
+        """
+        pool = await self.connect()
+        async with pool.acquire() as conn:
+            return [tuple(record) for record in await conn.fetch(sql)]
+
+    async def add_rows_from_df(self, _type, df, dataset, row_prefix='', row_offset=0,
+                               time_column='time', loc_column='loc_id', columns=[],
+                               update=True, method='insert', copy_format='text',
+                               batch_size=100000):
+        """
+        Add rows from pandas dataframe. See mlfdb.add_rows_from_df.
+
+        return int amount of added rows
+        """
+        logging.debug('Trying to insert {} {}s with dataset {}'.format(len(df), _type, dataset))
+
+        encoded = encoder.encode_df(_type, df, dataset, row_offset=row_offset,
+                                    time_column=time_column, loc_column=loc_column,
+                                    columns=columns)
+        await self._prime_ids(_type, dataset, encoded['parameters'], create=True)
+        if len(encoded['time']) > 0:
+            await self.create_partitions(encoded['time'].min(), encoded['time'].max(), dataset)
+        if method == 'copy':
+            await self.copy_long(encoder.iter_long(encoded, batch_size), copy_format=copy_format)
+        else:
+            stats = WriteStats()
+            stats.add_encoded(encoded)
+            await self._has_catalog()
+            await self.execute(self.db._insert_sql_long(encoded) + ';' + self.db._version_sql(dataset) + self.db._catalog_sql(stats))
+
+        return len(df) - 1
+
+    async def copy_long(self, batches, copy_format='text'):
+        """
+        Stream long layout batches (see encoder.iter_long) into data
+        table using COPY FROM STDIN. All batches are committed in one
+        transaction.
+
+        return int amount of copied rows
+        """
+        await self._compact()
+        columns, kinds = self.db._columns()
+        if copy_format == 'binary':
+            serialize = lambda batch: pgcopy.binary_buffer_columns(batch, kinds)
+        else:
+            serialize = pgcopy.text_buffer_columns
+        stats = WriteStats()
+        count = 0
+
+        start = time.time()
+        await self._has_partitions_function()
+        catalog = await self._has_catalog()
+        pool = await self.connect()
+        try:
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    for batch in batches:
+                        stats.add_batch(batch)
+                        partitions = self.db._partitions_sql(stats)
+                        if len(partitions) > 0:
+                            await conn.execute(partitions)
+                        await self._prime_ids(batch['type'], batch['dataset'], pd.unique(batch['parameter']), create=True, conn=conn)
+                        source = serialize(self.db._batch_ids(batch)).getvalue()
+                        if isinstance(source, str):
+                            source = source.encode('utf-8')
+                        await conn.copy_to_table('data', source=io.BytesIO(source), columns=columns,
+                                                 schema_name=self.schema, format=copy_format)
+                        count += len(batch['value'])
+                        logging.debug('{} rows copied...'.format(count))
+                    if catalog and len(stats.entries) > 0:
+                        for dataset in set(dataset for dataset, _type in stats.entries):
+                            await conn.execute(self.db._version_sql(dataset))
+                        await conn.execute(self.db._catalog_sql(stats))
+        except Exception:
+            # Ids added in the rolled back transaction do not exist
+            self.db._forget_ids()
+            raise
+
+        elapsed = time.time() - start
+        logging.info('Copied {} rows in {:.2f}s ({:.0f} rows/s)'.format(count, elapsed, count / max(elapsed, 1e-9)))
+        return count
+
+    async def create_partitions(self, starttime, endtime, dataset=None):
+        """
+        Create partitions of data table for given time range in advance (see mlfdb.create_partitions)
+        """
+        if not await self._has_partitions_function():
+            return 0
+        return (await self._query(self.db._create_partitions_sql(starttime, endtime, dataset)))[0][0]
+
+    async def _has_partitions_function(self):
+        """
+        Check (once) whether schema has create_partitions function. Result
+        is shared with the synchronous helpers.
+        """
+        if self.db._partitions_function is None:
+            sql = "SELECT to_regprocedure('{schema}.create_partitions(timestamp, timestamp, text)') IS NOT NULL".format(schema=self.schema)
+            self.db._partitions_function = bool((await self._query(sql))[0][0])
+        return self.db._partitions_function
+
+    async def _compact(self):
+        """
+        Check (once) whether data table has compact layout. Result is
+        shared with the synchronous helpers.
+        """
+        if self.db.layout is None:
+            self.db.layout = 'compact' if (await self._query(self.db._layout_sql()))[0][0] > 0 else 'long'
+        return self.db.layout == 'compact'
+
+    async def _prime_ids(self, _type=None, dataset=None, parameters=(), create=False, conn=None):
+        """
+        Read ids of compact layout names into the id cache of the SQL
+        helpers. Does nothing with long layout.
+
+        create : bool
+                 if True, missing names are added to the dictionaries
+        conn   : asyncpg connection
+                 if set, dictionaries are read (and written) in its transaction
+        """
+        if not await self._compact():
+            return
+        for kind, names in (('type', [] if _type is None else [_type]),
+                            ('dataset', [] if dataset is None else [dataset]),
+                            ('parameter', parameters)):
+            names = set(str(name) for name in names)
+            with self.db._ids_lock:
+                missing = sorted(names - set(self.db._ids[kind]))
+            if len(missing) == 0:
+                continue
+            sql = self.db._name_ids_sql(kind, missing)
+            if conn is None:
+                if create:
+                    await self.execute(self.db._add_names_sql(kind, missing))
+                rows = await self._query(sql)
+            else:
+                if create:
+                    await conn.execute(self.db._add_names_sql(kind, missing))
+                rows = [tuple(record) for record in await conn.fetch(sql)]
+            self.db._store_ids(kind, rows)
+
+    async def remove_dataset(self, dataset, type=None, clean_locations=False, batch_size=50000):
+        """
+        Remove dataset in batches of batch_size rows. See mlfdb.remove_dataset,
+        partitions are not truncated here.
+
+        return int amount of deleted rows
+        """
+        logging.debug('Removing dataset "{}"'.format(dataset))
+        await self._prime_ids(type, dataset)
+        catalog = await self._has_catalog()
+        if catalog:
+            await self.execute(self.db._version_sql(dataset))
+        deleted = await self._delete_batches('{schema}.data'.format(schema=self.db.schema),
+                                             self.db._filter_sql(dataset, type, 'a.'),
+                                             batch_size, dataset)
+        wide = await self._has_wide_tables()
+        if wide:
+            await self._delete_batches('{schema}.data_wide'.format(schema=self.db.schema),
+                                       self.db._wide_filter_sql(dataset, type, 'a.'),
+                                       batch_size, dataset)
+            await self.execute(self.db._remove_wide_sql(dataset, type))
+        if catalog:
+            await self.execute(self.db._remove_catalog_sql(dataset, type) + self.db._version_sql(dataset))
+        self.db._forget_parameters(dataset)
+
+        if clean_locations:
+            logging.debug('Removing locations...')
+            await self.execute(self.db._clean_locations_sql(wide))
+
+        return deleted
+
+    async def _delete_batches(self, table, where, batch_size, dataset):
+        """
+        Delete matching rows in batches, each in its own transaction (see mlfdb._delete_batches)
+        """
+        total = 0
+        last = 0
+        while True:
+            sql = self.db._delete_batch_sql(table, where, batch_size, last)
+            logging.debug(sql)
+            found, last, count = (await self._query(sql))[0]
+            total += count
+            if count > 0:
+                logging.info('Removed {} rows of dataset {}'.format(total, dataset))
+            if found < batch_size:
+                return total
+
+    async def get_locations_by_dataset(self, dataset, starttime, endtime, rettype='tuple'):
+        """
+        Get all locations attached to dataset. See mlfdb.get_locations_by_dataset.
+
+        returns list of tuples [(id, name, lon, lat)]
+        """
+        if not await self._has_catalog():
+            await self._prime_ids(dataset=dataset)
+            res = await self._query(self.db._locations_by_dataset_sql(dataset, starttime, endtime, scan=True))
+            return self.db._locs_to_dict(res) if rettype == 'dict' else res
+
+        sql = self.db._locations_by_dataset_sql(dataset, starttime, endtime)
+        logging.debug(sql)
+
+        res = await self._query(sql)
+        if len(res) == 0 and len(await self.get_datasets(dataset)) == 0:
+            logging.warning('Dataset {} not found in dataset catalog, reading locations from data'.format(dataset))
+            await self._prime_ids(dataset=dataset)
+            res = await self._query(self.db._locations_by_dataset_sql(dataset, starttime, endtime, scan=True))
+
+        if rettype == 'dict':
+            return self.db._locs_to_dict(res)
+        return res
+
+    async def get_dataset_version(self, dataset):
+        """
+        Get write version of dataset (see mlfdb.get_dataset_version)
+        """
+        if not await self._has_catalog():
+            return 0
+        sql = "SELECT version FROM {schema}.dataset_version WHERE dataset='{dataset}'".format(schema=self.schema, dataset=dataset)
+        res = await self._query(sql)
+        if len(res) > 0:
+            return int(res[0][0])
+        return 0
+
+    async def get_datasets(self, dataset=None):
+        """
+        Get datasets from dataset catalog (see mlfdb.get_datasets)
+        """
+        if not await self._has_catalog():
+            return []
+        return self.db._datasets_to_dicts(await self._query(self.db._datasets_sql(dataset)))
+
+    async def get_dataset_info(self, dataset, rowtype='feature'):
+        """
+        Get time span and size of dataset from dataset catalog (see mlfdb.get_dataset_info)
+        """
+        for info in await self.get_datasets(dataset):
+            if info['type'] == rowtype:
+                return info
+        return None
+
+    async def get_parameters(self, dataset, rowtype='feature'):
+        """
+        Get parameters of dataset from parameter catalog (see mlfdb.get_parameters)
+        """
+        if await self._has_catalog():
+            sql = self.db._parameters_catalog_sql(dataset, rowtype)
+        else:
+            await self._prime_ids(rowtype, dataset)
+            await self._has_wide_tables()
+            sql = self.db._parameters_scan_sql(dataset, rowtype)
+        logging.debug(sql)
+        return [row[0] for row in await self._query(sql)]
+
+    async def get_rows(self, dataset_name,
+                       starttime, endtime,
+                       rowtype='feature',
+                       return_type='np',
+                       parameters=None,
+                       chunk_size=1456,
+                       location_shards=1,
+                       engine='crosstab',
+                       use_cache=True,
+                       dtype=None,
+                       bbox=None,
+                       point=None,
+                       radius=None,
+                       k=None):
+        """
+        Get all feature rows from given dataset. See mlfdb.get_rows.
+
+        All chunk queries are run concurrently, limited by pool_maxconn.
+
+        returns : np array, np array, np array or pandas DataFrame depending on return_type
+        """
+        parameters = [] if parameters is None else list(parameters)
+        cache = self.db.cache
+        cache_key = None
+        loop = asyncio.get_running_loop()
+        if cache is not None and use_cache and await self._has_catalog():
+            cache_key = cache.key(self.schema, dataset_name, rowtype, list(parameters),
+                                  starttime.isoformat(), endtime.isoformat(), return_type,
+                                  engine, dtype, await self.get_dataset_version(dataset_name),
+                                  bbox, point, radius, k)
+            result = await loop.run_in_executor(None, cache.get, cache_key)
+            if result is not None:
+                return result
+
+        if await self._is_catalog_filled():
+            starttime, endtime = self.db._clip_span(await self.get_dataset_info(dataset_name, rowtype), starttime, endtime)
+        chunks = list(self.db._time_chunks(starttime, endtime, chunk_size))
+        await self._prime_ids(rowtype, dataset_name)
+        header = await self._wide_header(dataset_name, rowtype) if len(chunks) > 0 else None
+        if header is not None and len(parameters) == 0:
+            parameters += header
+        if len(chunks) > 0 and len(parameters) == 0:
+            parameters += await self.get_parameters(dataset_name, rowtype)
+        if len(chunks) > 0 and len(parameters) == 0 and await self._has_catalog():
+            logging.warning('Dataset {} ({}) not found in parameter catalog, reading parameters from all rows'.format(dataset_name, rowtype))
+            await self._has_wide_tables()
+            sql = self.db._parameters_scan_sql(dataset_name, rowtype)
+            logging.debug(sql)
+            parameters += [row[0] for row in await self._query(sql)]
+        if len(chunks) > 0 and len(parameters) == 0:
+            raise ValueError('Empty parameter set')
+        await self._prime_ids(parameters=parameters)
+
+        if any(arg is not None for arg in (bbox, point, radius, k)):
+            locations = await self.get_locations_within(bbox, point, radius, k, dataset=dataset_name, rowtype=rowtype,
+                                                        starttime=starttime, endtime=endtime)
+            location_ranges = self.db._split_location_ids([loc[0] for loc in locations], location_shards)
+        elif location_shards > 1:
+            sql = "SELECT min(id), max(id) FROM {schema}.location".format(schema=self.schema)
+            location_ranges = self.db._split_location_range(*(await self._query(sql))[0], location_shards)
+        else:
+            location_ranges = [None]
+
+        if header is not None:
+            if engine == 'numpy':
+                fetch = lambda *task: self._fetch_wide(dataset_name, rowtype, parameters, header, *task)
+            else:
+                fetch = lambda *task: self._fetch_wide_rows(dataset_name, rowtype, parameters, header, *task)
+        elif engine == 'numpy':
+            fetch = lambda *task: self._fetch_pivot(dataset_name, rowtype, parameters, *task)
+        else:
+            fetch = lambda *task: self._fetch_rows(dataset_name, rowtype, parameters, *task)
+        tasks = [fetch(start, end, location_range) for start, end in chunks for location_range in location_ranges]
+
+        # gather keeps the order of tasks
+        results = await asyncio.gather(*tasks)
+        result = self.db._collect(results, parameters, rowtype, return_type, engine, dtype=dtype)
+
+        empty = result.empty if isinstance(result, pd.DataFrame) else len(result[0]) == 0
+        if cache_key is not None and not empty:
+            await loop.run_in_executor(None, cache.put, cache_key, result)
+        return result
+
+    async def get_locations_within(self, bbox=None, point=None, radius=None, k=None, dataset=None,
+                                   rowtype=None, starttime=None, endtime=None, rettype='tuple'):
+        """
+        Get locations selected by spatial filters. See mlfdb.get_locations_within.
+
+        returns list of tuples [(id, name, lon, lat)]
+        """
+        if dataset is not None and len(await self.get_datasets(dataset)) == 0:
+            logging.warning('Dataset {} not found in dataset catalog, spatial filter is applied to all locations'.format(dataset))
+            dataset = None
+
+        sql = self.db._locations_within_sql(bbox, point, radius, k, dataset, rowtype, starttime, endtime)
+        logging.debug(sql)
+        res = await self._query(sql)
+
+        if rettype == 'dict':
+            return self.db._locs_to_dict(res)
+        return res
+
+    async def _fetch_rows(self, dataset_name, rowtype, parameters, start, end, location_range=None):
+        """
+        Fetch crosstab rows of one time window
+        """
+        sql = self.db._rows_sql(dataset_name, rowtype, parameters, start, end, location_range)
+        logging.debug(sql)
+        return await self._query(sql)
+
+    async def _has_wide_tables(self):
+        """
+        Check (once) whether schema has wide layout tables
+        """
+        if self.db._wide_tables is None:
+            self.db._wide_tables = bool((await self._query(self.db._wide_tables_sql()))[0][0])
+        return self.db._wide_tables
+
+    async def _has_catalog(self):
+        """
+        Check (once) whether schema has catalog tables (see mlfdb._has_catalog)
+        """
+        if self.db._catalog_tables is None:
+            self.db._catalog_tables = bool((await self._query(self.db._catalog_tables_sql()))[0][0])
+        return self.db._catalog_tables
+
+    async def _is_catalog_filled(self):
+        """
+        Check (once) whether dataset catalog has been filled from data (see mlfdb._is_catalog_filled)
+        """
+        if self.db._catalog_filled is None:
+            self.db._catalog_filled = await self._has_catalog() and len(await self._query(self.db._catalog_filled_sql())) > 0
+        return self.db._catalog_filled
+
+    async def _wide_header(self, dataset, rowtype):
+        """
+        Get parameter header of dataset stored in wide layout (see mlfdb._wide_header)
+        """
+        if not await self._has_wide_tables():
+            return None
+        res = await self._query(self.db._header_sql(dataset, rowtype))
+        if len(res) == 0:
+            return None
+        return list(res[0][0])
+
+    async def _fetch_wide_rows(self, dataset_name, rowtype, parameters, header, start, end, location_range=None):
+        """
+        Fetch wide layout rows of one time window in crosstab row form
+        """
+        sql = self.db._wide_rows_sql(dataset_name, rowtype, parameters, header, start, end, location_range)
+        logging.debug(sql)
+        return await self._query(sql)
+
+    async def _fetch_wide(self, dataset_name, rowtype, parameters, header, start, end, location_range=None):
+        """
+        Stream wide layout rows of one time window with COPY TO STDOUT
+        straight into float64 arrays (see mlfdb._fetch_wide)
+        """
+        sql = self.db._wide_rows_sql(dataset_name, rowtype, parameters, header, start, end, location_range)
+        logging.debug(sql)
+
+        buf = io.BytesIO()
+        pool = await self.connect()
+        async with pool.acquire() as conn:
+            await conn.copy_from_query(sql, output=buf, format='text')
+        return self.db._read_wide(buf, len(parameters))
+
+    async def _fetch_pivot(self, dataset_name, rowtype, parameters, start, end, location_range=None):
+        """
+        Stream long rows of one time window with COPY TO STDOUT and pivot
+        them client side (see mlfdb._fetch_pivot)
+        """
+        sql = self.db._long_query(dataset_name, rowtype, parameters, start, end, location_range)
+        logging.debug(sql)
+
+        buf = io.BytesIO()
+        pool = await self.connect()
+        async with pool.acquire() as conn:
+            await conn.copy_from_query(sql, output=buf, format='text')
+
+        loc_ids, times, data = self.db._read_long(buf, self.db._parameter_keys(parameters))
+        if len(loc_ids) == 0:
+            return np.empty((0, 4)), data
+
+        locations = await self._query(self.db._coordinates_sql(np.unique(loc_ids)))
+        return self.db._pivot_block(loc_ids, times, data, self.db._match_coordinates(loc_ids, locations))
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import glob
+import time
+import pickle
+import zipfile
+import hashlib
+import logging
+import threading
+import collections
+import numpy as np
+import pandas as pd
+
+
+class ResultCache(object):
+    """
+    Persistent on-disk cache for get_rows results
+
+    Entries are stored as .npz files named by the hash of their key.
+    File modification time is used as the last access time and the
+    least recently used entries are evicted when the cache grows over
+    max_bytes.
+
+    cache_dir : str
+                directory for cache files (created if missing)
+    max_bytes : int
+                maximum total size of cache files
+    """
+
+    # Temporary files older than this (seconds) are left by writers that died before os.replace
+    stale_tmp_age = 3600
+
+    def __init__(self, cache_dir, max_bytes=10*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, *args):
+        """
+        Return cache key for given arguments
+        """
+        return hashlib.sha1(repr(args).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """
+        Get cached result
+
+        return (metadata, parameters, data), pandas DataFrame or None if not found
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=True) as f:
+                if str(f['kind']) == 'pandas':
+                    columns = [str(c) for c in f['columns']]
+                    result = pd.DataFrame({c: f['c{}'.format(i)] for i, c in enumerate(columns)}, columns=columns)
+                else:
+                    result = f['metadata'], [str(p) for p in f['parameters']], f['data']
+            os.utime(path)
+        except (IOError, KeyError, ValueError, zipfile.BadZipFile, pickle.UnpicklingError) as error:
+            if os.path.exists(path):
+                logging.warning('Discarding unreadable cache entry {}: {}'.format(path, error))
+                self._remove(path)
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        logging.debug('Cache hit {}'.format(key))
+        return result
+
+    def put(self, key, result):
+        """
+        Store result returned by get_rows
+        """
+        if isinstance(result, pd.DataFrame):
+            arrays = {'c{}'.format(i): result[c].to_numpy() for i, c in enumerate(result.columns)}
+            arrays.update(kind='pandas', columns=np.array(result.columns, dtype=str))
+        else:
+            metadata, parameters, data = result
+            arrays = {'kind': 'np', 'metadata': metadata, 'parameters': np.array(parameters, dtype=str), 'data': data}
+
+        tmp = os.path.join(self.cache_dir, '.{}.{}.tmp.npz'.format(key, threading.get_ident()))
+        np.savez(tmp, **arrays)
+        os.replace(tmp, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove stale temporary files and least recently used entries
+        until cache size is under max_bytes
+        """
+        now = time.time()
+        for path in glob.glob(os.path.join(self.cache_dir, '.*.tmp.npz')):
+            try:
+                if now - os.stat(path).st_mtime > self.stale_tmp_age:
+                    logging.debug('Removing stale cache file {}'.format(path))
+                    self._remove(path)
+            except OSError:
+                continue
+
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.npz')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logging.debug('Evicting cache entry {}'.format(path))
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        for path in glob.glob(os.path.join(self.cache_dir, '*.npz')):
+            self._remove(path)
+
+    def stats(self):
+        """
+        return dict with hits, misses, entries and bytes
+        """
+        sizes = [os.path.getsize(path) for path in glob.glob(os.path.join(self.cache_dir, '*.npz'))]
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(sizes),
+                    'bytes': sum(sizes)}
+
+
+class NameCache(object):
+    """
+    In-memory cache of name to id mappings (e.g. location names)
+
+    Least recently used entries are evicted when the cache grows over
+    max_entries. Entries older than ttl seconds are treated as missing.
+
+    max_entries : int
+                  maximum amount of cached names
+    ttl : float
+          seconds entries are valid, None for no expiry
+    """
+
+    def __init__(self, max_entries=100000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict() # <-- name: (id, time stored)
+        self._lock = threading.Lock()
+
+    def get_many(self, names):
+        """
+        Get cached ids
+
+        return ({name: id} of found names, list of missing names)
+        """
+        found, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for name in names:
+                entry = self._entries.get(name)
+                if entry is not None and (self.ttl is None or now - entry[1] < self.ttl):
+                    self._entries.move_to_end(name)
+                    found[name] = entry[0]
+                else:
+                    if entry is not None:
+                        del self._entries[name]
+                    missing.append(name)
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put_many(self, ids):
+        """
+        Store {name: id} mappings
+        """
+        now = time.monotonic()
+        with self._lock:
+            for name, id in ids.items():
+                self._entries[name] = (id, now)
+                self._entries.move_to_end(name)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        return dict with hits, misses and entries
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries)}
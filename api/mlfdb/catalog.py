@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Statistics of written rows used to maintain the dataset catalog
+
+Writes collect per (dataset, type) statistics while rows are
+serialized, and the catalog tables are updated from them in the same
+transaction (see mlfdb._catalog_sql).
+"""
+import datetime
+import numpy as np
+import pandas as pd
+
+# Tables maintained by writes, see create_db.create_catalog
+CATALOG_TABLES = ('dataset_version', 'parameter', 'dataset', 'dataset_location')
+
+# Name of dataset_version row written when catalogs have been filled from data
+CATALOG_FILLED = ''
+
+
+class WriteStats(object):
+    """
+    Statistics of rows written to data table per (dataset, type)
+
+    entries : dict
+              {(dataset, type): {'parameters': set, 'rows': int, 'cells': int,
+                                 'min_time': np.datetime64, 'max_time': np.datetime64,
+                                 'locations': {location_id: [min_time, max_time]}}}
+
+    rows are counted as changes of the row key between consecutive
+    cells, so cells of one row have to be written one after another.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self._last_row = {}
+
+    def _entry(self, dataset, _type):
+        key = (dataset, _type)
+        if key not in self.entries:
+            self.entries[key] = {'parameters': set(), 'rows': 0, 'cells': 0,
+                                 'min_time': None, 'max_time': None, 'locations': {}}
+        return self.entries[key]
+
+    def _add_location(self, entry, location_id, first, last):
+        span = entry['locations'].get(location_id)
+        if span is None:
+            entry['locations'][location_id] = [first, last]
+        else:
+            span[0] = min(span[0], first)
+            span[1] = max(span[1], last)
+
+    def _add_span(self, entry, first, last):
+        entry['min_time'] = first if entry['min_time'] is None else min(entry['min_time'], first)
+        entry['max_time'] = last if entry['max_time'] is None else max(entry['max_time'], last)
+
+    def add_batch(self, batch, counts=True):
+        """
+        Add long layout batch (see encoder.iter_long)
+
+        counts : bool
+                 if False, only parameters and time spans are collected
+        """
+        n = len(batch['value'])
+        if n == 0:
+            return
+        entry = self._entry(batch['dataset'], batch['type'])
+        entry['parameters'].update(pd.unique(batch['parameter']))
+
+        times = batch['time'].astype('datetime64[s]')
+        self._add_span(entry, times.min(), times.max())
+        spans = pd.DataFrame({'location_id': batch['location_id'], 'time': times}).groupby('location_id')['time'].agg(['min', 'max'])
+        for location_id, first, last in zip(spans.index, spans['min'].to_numpy(), spans['max'].to_numpy()):
+            self._add_location(entry, int(location_id), first, last)
+
+        if counts:
+            key = (batch['dataset'], batch['type'])
+            rows = batch['row']
+            new_rows = int(np.count_nonzero(rows[1:] != rows[:-1])) + 1
+            if self._last_row.get(key) == rows[0]:
+                new_rows -= 1
+            self._last_row[key] = rows[-1]
+            entry['rows'] += new_rows
+            entry['cells'] += n
+
+    def add_encoded(self, encoded, counts=True):
+        """
+        Add encoded frame (see encoder.encode_df)
+        """
+        if encoded['values'].size == 0:
+            return
+        entry = self._entry(encoded['dataset'], encoded['type'])
+        entry['parameters'].update(encoded['parameters'].tolist())
+
+        times = encoded['time'].astype('datetime64[s]')
+        self._add_span(entry, times.min(), times.max())
+        spans = pd.DataFrame({'location_id': encoded['location_id'], 'time': times}).groupby('location_id')['time'].agg(['min', 'max'])
+        for location_id, first, last in zip(spans.index, spans['min'].to_numpy(), spans['max'].to_numpy()):
+            self._add_location(entry, int(location_id), first, last)
+
+        if counts:
+            entry['rows'] += len(encoded['row'])
+            entry['cells'] += encoded['values'].size
+
+    def add_tuples(self, rows, counts=True):
+        """
+        Wrap iterable of data table tuples
+        (type, dataset, time, location_id, parameter, value, row)
+        collecting statistics while they are consumed
+
+        yields rows unchanged
+        """
+        for row in rows:
+            _type, dataset, t, location_id, parameter, value, key = row
+            entry = self._entry(dataset, _type)
+            entry['parameters'].add(parameter)
+            t = np.datetime64(t, 's')
+            self._add_span(entry, t, t)
+            self._add_location(entry, int(location_id), t, t)
+            if counts:
+                if self._last_row.get((dataset, _type)) != key:
+                    entry['rows'] += 1
+                    self._last_row[(dataset, _type)] = key
+                entry['cells'] += 1
+            yield row
+
+
+def timestamp(t):
+    """
+    Format datetime64 or datetime as SQL timestamp literal
+    """
+    if isinstance(t, datetime.datetime):
+        return t.strftime('%Y-%m-%d %H:%M:%S')
+    return str(np.datetime64(t, 's')).replace('T', ' ')
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Columnar wide-to-long encoder for pandas DataFrames
+
+Converts wide frames (one row per time and location, one column per
+parameter) into the long layout of data table:
+(type, dataset, time, location_id, parameter, value, row)
+using vector operations only. Per-row arrays are computed once and
+expanded to cells in batches.
+"""
+import functools
+import numpy as np
+import pandas as pd
+from dateutil.tz import tzlocal
+
+
+def concat_str(*parts):
+    """
+    Concatenate string scalars and arrays element-wise
+    """
+    return functools.reduce(np.char.add, parts)
+
+
+def encode_df(_type, df, dataset, row_offset=0, time_column='time',
+              loc_column='loc_id', columns=[]):
+    """
+    Encode wide DataFrame into row level arrays
+
+    _type       : str
+                  feature or label
+    df          : pd.DataFrame
+                  data, one row per time and location
+    dataset     : str
+                  dataset name
+    row_offset  : int
+                  offset for row numbering
+    time_column : str
+                  column containing unix timestamps
+    loc_column  : str
+                  column containing location ids
+    columns     : list
+                  parameter columns. If empty, columns from 5th column on are used
+
+    returns dict with keys type, dataset, parameters (p,), epoch (n,),
+            time (n,) datetime64[s] local time, timestr (n,),
+            location_id (n,), row (n,) and values (n, p)
+    """
+    if len(columns) == 0:
+        columns = list(df.columns.values)[4:]
+        values = df.iloc[:, 4:]
+    else:
+        values = df[columns]
+    values = np.ascontiguousarray(values.to_numpy(dtype=np.float64))
+
+    # Same semantics as datetime.fromtimestamp(int(t)): truncate and convert to local time
+    epoch = df[time_column].to_numpy().astype(np.int64)
+    times = pd.to_datetime(epoch, unit='s', utc=True).tz_convert(tzlocal()).tz_localize(None)
+    times = times.to_numpy().astype('datetime64[s]')
+    timestr = np.datetime_as_string(times, unit='s')
+    if len(timestr) > 0:
+        timestr = np.char.replace(timestr, 'T', ' ')
+
+    loc = df[loc_column].to_numpy().astype(np.int64)
+
+    # df.iterrows() upcasts all-numeric rows to float, so row keys have
+    # had float location ids whenever frame contains float columns
+    dtypes = list(df.dtypes)
+    if all(pd.api.types.is_numeric_dtype(d) for d in dtypes) and any(pd.api.types.is_float_dtype(d) for d in dtypes):
+        loc_str = loc.astype(np.float64).astype(str)
+    else:
+        loc_str = loc.astype(str)
+
+    row_num = np.arange(len(df), dtype=np.int64) + int(row_offset)
+    rows = concat_str('{}-{}-'.format(_type, dataset), epoch.astype(str), '.0-',
+                      loc_str, '-', row_num.astype(str))
+
+    return {'type': _type,
+            'dataset': dataset,
+            'parameters': np.array(columns, dtype=str),
+            'epoch': epoch,
+            'time': times,
+            'timestr': timestr,
+            'location_id': loc,
+            'row': rows,
+            'values': values}
+
+
+def iter_long(encoded, batch_size=None):
+    """
+    Expand encoded frame into long layout batches
+
+    encoded    : dict
+                 output of encode_df
+    batch_size : int
+                 amount of cells in one batch. If None, all cells are
+                 returned in one batch
+
+    yields dict with keys type, dataset, time, timestr, epoch,
+           location_id, parameter, value and row. All but type and
+           dataset are arrays of batch length.
+    """
+    total = encoded['values'].size
+    if batch_size is None or batch_size <= 0:
+        batch_size = max(total, 1)
+
+    for start in range(0, total, batch_size):
+        yield cells(encoded, start, min(start + batch_size, total))
+
+
+def to_long(encoded):
+    """
+    Return whole encoded frame in long layout (see iter_long)
+    """
+    return cells(encoded, 0, encoded['values'].size)
+
+
+def cells(encoded, start, stop):
+    """
+    Return cells [start, stop) of encoded frame in long layout
+    """
+    p = encoded['values'].shape[1]
+    r, c = np.divmod(np.arange(start, stop), max(p, 1))
+    return {'type': encoded['type'],
+            'dataset': encoded['dataset'],
+            'time': encoded['time'][r],
+            'timestr': encoded['timestr'][r],
+            'epoch': encoded['epoch'][r],
+            'location_id': encoded['location_id'][r],
+            'parameter': encoded['parameters'][c],
+            'value': encoded['values'].ravel()[start:stop],
+            'row': encoded['row'][r]}
+
+
+def value_strings(values, null='NULL'):
+    """
+    Format float values as strings, NaN as null
+    """
+    ret = values.astype(str)
+    ret[np.isnan(values)] = null
+    return ret
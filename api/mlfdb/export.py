@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+File formats and helpers of mlfdb.export_rows
+
+CSV is produced by the database with COPY TO STDOUT and streamed to
+the file as is. Parquet and Arrow chunks are pivoted client side (see
+mlfdb.get_rows engine numpy), converted to pyarrow tables and appended
+to the file as row groups or record batches.
+
+Parquet and Arrow need pyarrow (pip install mlfdb[export]).
+"""
+import time
+import logging
+import collections
+import concurrent.futures
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+FORMATS = ('csv', 'parquet', 'arrow')
+
+
+class CountingWriter(object):
+    """
+    File wrapper counting written bytes and lines
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes = 0
+        self.rows = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.bytes += len(data)
+        self.rows += data.count(b'\n')
+        return self.f.write(data)
+
+
+def check_format(fmt):
+    """
+    Raise if fmt is unknown or its dependencies are missing
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Unknown format {}, use one of {}'.format(fmt, ', '.join(FORMATS)))
+    if fmt != 'csv' and pa is None:
+        raise ImportError('{} export needs pyarrow (pip install mlfdb[export])'.format(fmt))
+
+
+def ordered(fetch, tasks, workers):
+    """
+    Map fetch over tasks with workers threads yielding results in task
+    order. At most 2 * workers results are pending at a time.
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield fetch(task)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(executor.submit(fetch, task))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def progress(i, n, rows, size, start):
+    """
+    Log progress of exported chunks
+    """
+    elapsed = max(time.time() - start, 1e-9)
+    logging.info('{}/{} chunks, {} rows, {:.1f} MB ({:.0f} rows/s, {:.1f} MB/s)'.format(
+        i, n, rows, size / 1024**2, rows / elapsed, size / 1024**2 / elapsed))
+
+
+def arrow_schema(parameters):
+    """
+    Return pyarrow schema of exported columns
+    """
+    return pa.schema([('loc_id', pa.int64()), ('time', pa.int64()), ('lon', pa.float64()), ('lat', pa.float64())] +
+                     [(param, pa.float64()) for param in parameters])
+
+
+def arrow_writer(path, schema, fmt):
+    """
+    Open Parquet or Arrow IPC file writer
+    """
+    if fmt == 'parquet':
+        return pq.ParquetWriter(path, schema)
+    return pa.ipc.new_file(path, schema)
+
+
+def block_table(block, schema):
+    """
+    Convert (metadata, data) block to pyarrow Table. NaN is stored as null.
+    """
+    metadata, data = block
+    columns = [pa.array(metadata[:, 0].astype(np.int64)), pa.array(metadata[:, 1].astype(np.int64)),
+               pa.array(metadata[:, 2]), pa.array(metadata[:, 3])]
+    columns += [pa.array(data[:, i], from_pandas=True) for i in range(data.shape[1])]
+    return pa.Table.from_arrays(columns, schema=schema)
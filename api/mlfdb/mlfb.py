@@ -6,17 +6,25 @@ import logging
 import numpy as np
 import os
 import datetime
+import threading
+
+from .pool import ConnectionPool
 
 class mlfb(object):
 
-    conn = None
+    pool = None
     config_filename = None
     schema = 'traindata'
     id = 1
     
-    def __init__(self, id=1, logging_level='INFO', config_filename=None, schema='traindata'):
+    def __init__(self, id=1, logging_level='INFO', config_filename=None, schema='traindata',
+                 pool_minconn=1, pool_maxconn=4, pool_idle_timeout=300):
         self.id = id
         self.schema = schema
+        self.pool_options = {'minconn': pool_minconn,
+                             'maxconn': pool_maxconn,
+                             'idle_timeout': pool_idle_timeout}
+        self._pool_lock = threading.Lock()
 
         if config_filename is None:
             config_filename = os.path.dirname(os.path.abspath(__file__))+'/../cnf/database.ini'
@@ -43,75 +51,60 @@ class mlfb(object):
 
     def connect(self):
         """ Connect to the PostgreSQL database server """
-        conn = None
         try:
-            # read connection parameters
-            params = self.config()
-
-            # connect to the PostgreSQL server
             logging.info('Connecting to the PostgreSQL database...')
-            conn = psycopg2.connect(**params)
-
-            # create a cursor
-            cur = conn.cursor()
+            with self._connection() as conn:
+                with conn:
+                    with conn.cursor() as cur:
+                        cur.execute('SELECT version()')
+                        db_version = cur.fetchone()
+                        # logging.debug(db_version)
+        except (Exception, psycopg2.DatabaseError) as error:
+            logging.critical(error)
 
-            # execute a statement
-            # logging.debug('PostgreSQL database version:')
-            cur.execute('SELECT version()')
+    def close(self):
+        """ Close all pooled connections """
+        with self._pool_lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+                logging.debug('Database connections closed.')
 
-            # display the PostgreSQL database server version
-            db_version = cur.fetchone()
-            # logging.debug(db_version)
+    def __enter__(self):
+        return self
 
-            # close the communication with the PostgreSQL
-            cur.close()
-        except (Exception, psycopg2.DatabaseError) as error:
-            logging.critical(error)
-        finally:
-            if conn is not None:
-                conn.close()
-                logging.debug('Database connection closed.')
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
                 
     def get_rows_from_postgre_to_numpy(self,parameter_in,value_in):
         """ Method: get data from the trains table Postgre table and return Numpy array with return sentence"""
-        conn = None
-        var1 = 'testa1'
         try:
-            logging.info(parameter_in,value_in)
+            logging.info('Fetching rows with {} {}'.format(parameter_in, value_in))
             # logging.info(location_id_in)
             # logging.info(type_in)
-            params = self.config()
-            conn = psycopg2.connect(**params)
-            cur = conn.cursor()
-            cur.execute("select AA1.parameter,AA1.value,AA1.time,AA1.type,BB2.name,BB2.geom,AA1.id,AA1.location_id from traindata._data AA1 INNER JOIN traindata._location BB2 ON AA1.location_id=BB2.id and AA1.parameter = %s and AA1.value='%s'", (parameter_in,value_in,))
-                            
-            logging.info("The number of training.trains_fmi_trainingdata and location: ", cur.rowcount)
-            row = cur.fetchone()
+            with self._connection() as conn:
+                with conn:
+                    with conn.cursor() as cur:
+                        cur.execute("select AA1.parameter,AA1.value,AA1.time,AA1.type,BB2.name,BB2.geom,AA1.id,AA1.location_id from traindata._data AA1 INNER JOIN traindata._location BB2 ON AA1.location_id=BB2.id and AA1.parameter = %s and AA1.value='%s'", (parameter_in,value_in,))
 
-            
-            # Parse data to numpy array
-            logging.info('Parsing data to np array...')
-            result = []
- 
-            while row is not None:
-                #logging.info(row)
-                row = cur.fetchone()
-                #result = cur.fetchone()
-                result.append(row)
+                        logging.info("The number of training.trains_fmi_trainingdata and location: {}".format(cur.rowcount))
+                        row = cur.fetchone()
 
-            
-            result = np.array(result)
-            print(result)
-            return result
+                        # Parse data to numpy array
+                        logging.info('Parsing data to np array...')
+                        result = []
 
+                        while row is not None:
+                            #logging.info(row)
+                            row = cur.fetchone()
+                            #result = cur.fetchone()
+                            result.append(row)
 
-            # close communication with the database
-            cur.close()
+            result = np.array(result)
+            logging.debug(result)
+            return result
         except (Exception, psycopg2.DatabaseError) as error:
-            print(error)
-        finally:
-            if conn is not None:
-                conn.close()
+            logging.error(error)
 
 
     def get_rows(self, dataset_name, geom_type='point', rowtype='feature'):
@@ -181,8 +174,6 @@ class mlfb(object):
         locations : list
                     location information in following format: ['name', 'lat', 'lon']
         """
-        self._connect()
-
         logging.info('Adding {} locations to db...'.format(len(locations)))
         
         ids = []
@@ -231,8 +222,6 @@ class mlfb(object):
 
 
         logging.info('Trying to insert {} {}s with dataset {}'.format(len(data), _type, dataset))
-
-        self._connect()
         
         sql = "INSERT INTO {schema}.data (type, dataset, time, location_id, parameter, value, row) VALUES ".format(schema=self.schema)
         i = 0
@@ -341,16 +330,17 @@ class mlfb(object):
         Execute single SQL statement in
         a proper manner
         """
-        self._connect()
-        with self.conn as conn:
-            with conn.cursor() as curs:
-                curs.execute(statement)
+        with self._connection() as conn:
+            with conn:
+                with conn.cursor() as curs:
+                    curs.execute(statement)
         
-    def _connect(self):
-        """ Create connection if needed """
-        params = self.config()
-        self.conn = psycopg2.connect(**params)
-        return self.conn
+    def _connection(self):
+        """ Borrow connection from the pool, pool is created on first use """
+        with self._pool_lock:
+            if self.pool is None:
+                self.pool = ConnectionPool(self.config(), **self.pool_options)
+        return self.pool.connection()
         
     def _query(self, sql):
         """
@@ -360,12 +350,12 @@ class mlfb(object):
         
         return list of sets
         """
-        self._connect()
-        with self.conn as conn:
-            with conn.cursor() as curs:
-                curs.execute(sql)
-                results = curs.fetchall()
-                return results
+        with self._connection() as conn:
+            with conn:
+                with conn.cursor() as curs:
+                    curs.execute(sql)
+                    results = curs.fetchall()
+                    return results
 
 
 
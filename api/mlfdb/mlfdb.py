@@ -4,23 +4,93 @@ import psycopg2
 from configparser import ConfigParser
 import logging
 import numpy as np
+import io
 import os
 import re
+import csv
+import json
+import time
+import tempfile
+import threading
 import datetime
+import itertools
+import concurrent.futures
 from os.path import expanduser
-from google.cloud import storage
 import pandas as pd
 
+from . import encoder
+from . import pgcopy
+from . import export
+from .pool import ConnectionPool
+from .cache import ResultCache, NameCache
+from .catalog import WriteStats, timestamp, CATALOG_TABLES, CATALOG_FILLED
+
 class mlfdb(object):
 
-    conn = None
+    pool = None
     config_filename = None
     schema = 'traindata'
     id = 1
 
-    def __init__(self, id=1, logging_level='INFO', config_filename=None, schema='traindata'):
+    def __init__(self, id=1, logging_level='INFO', config_filename=None, schema='traindata',
+                 pool_minconn=1, pool_maxconn=4, pool_idle_timeout=300,
+                 cache_dir=None, cache_max_bytes=10*1024**3, parameter_cache_ttl=300,
+                 layout=None, location_cache_size=100000, location_cache_ttl=None):
+        """
+        id                : int
+                            instance id
+        config_filename   : str
+                            path (or gs:// url) to config file. Default ~/.mlfdbconfig
+        schema            : str
+                            database schema
+        pool_minconn      : int
+                            amount of connections kept open in the pool
+        pool_maxconn      : int
+                            maximum amount of open connections
+        pool_idle_timeout : int
+                            seconds after which idle connections above pool_minconn are closed
+        cache_dir         : str
+                            if set, get_rows results are cached on disk in this directory
+        cache_max_bytes   : int
+                            maximum size of the cache, least recently used entries are evicted
+        parameter_cache_ttl : int
+                              seconds parameter lists read from the parameter catalog are cached
+        layout            : str
+                            long | compact. With compact layout type, dataset and parameter
+                            are stored as ids of dictionary tables (see db/create_db.py).
+                            Default: detected from data table
+        location_cache_size : int
+                              maximum amount of location names whose ids are cached
+        location_cache_ttl : int
+                             seconds location ids are cached, None for no expiry
+        """
         self.id = id
         self.schema = schema
+        self.pool_options = {'minconn': pool_minconn,
+                             'maxconn': pool_maxconn,
+                             'idle_timeout': pool_idle_timeout}
+        self._pool_lock = threading.Lock()
+
+        self.parameter_cache_ttl = parameter_cache_ttl
+        self._parameter_cache = {} # <-- (dataset, type): (parameters, time read)
+        self._parameter_lock = threading.Lock()
+        self._partitions_function = None
+        self._wide_tables = None
+        self._catalog_tables = None
+        self._catalog_filled = None
+        self._location_index = None
+        self._seq_column = None
+
+        self.layout = layout
+        self._ids = {'type': {}, 'dataset': {}, 'parameter': {}} # <-- name: id of compact layout
+        self._ids_lock = threading.Lock()
+        self._resolve_ids = True # <-- if False, ids are only read from the cache (filled by aio client)
+
+        self.location_cache = NameCache(location_cache_size, location_cache_ttl)
+
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = ResultCache(cache_dir, max_bytes=cache_max_bytes)
 
         if config_filename is None:
             home = expanduser("~")
@@ -30,6 +100,8 @@ class mlfdb(object):
             bucket_name = re.search('(?<=//).*?(?=/)', config_filename).group(0)
             blob_name = re.search('(?<=gs://'+bucket_name+'/).*$', config_filename).group(0)
             tmp_filename = '/tmp/creds'
+            # Needed only for configs in Google Cloud Storage (pip install mlfdb[gcs])
+            from google.cloud import storage
             client = storage.Client()
             bucket = client.get_bucket(bucket_name)
             blob = storage.Blob(blob_name, bucket)
@@ -59,75 +131,94 @@ class mlfdb(object):
 
     def connect(self):
         """ Connect to the PostgreSQL database server """
-        conn = None
         try:
-            # read connection parameters
-            params = self.config()
-
-            # connect to the PostgreSQL server
             logging.info('Connecting to the PostgreSQL database...')
-            conn = psycopg2.connect(**params)
-
-            # create a cursor
-            cur = conn.cursor()
+            with self._connection() as conn:
+                with conn:
+                    with conn.cursor() as cur:
+                        cur.execute('SELECT version()')
+                        db_version = cur.fetchone()
+                        # logging.debug(db_version)
+        except (Exception, psycopg2.DatabaseError) as error:
+            logging.critical(error)
 
-            # execute a statement
-            # logging.debug('PostgreSQL database version:')
-            cur.execute('SELECT version()')
+    def close(self):
+        """ Close all pooled connections """
+        with self._pool_lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+                logging.debug('Database connections closed.')
 
-            # display the PostgreSQL database server version
-            db_version = cur.fetchone()
-            # logging.debug(db_version)
+    def __enter__(self):
+        return self
 
-            # close the communication with the PostgreSQL
-            cur.close()
-        except (Exception, psycopg2.DatabaseError) as error:
-            logging.critical(error)
-        finally:
-            if conn is not None:
-                conn.close()
-                logging.debug('Database connection closed.')
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def add_point_locations(self, locations, check_for_duplicates=False):
         """
-        Add locations to the db
+        Add locations to the db in one statement
 
         locations : list
                     location information in following format: ['name', 'lat', 'lon']
-        """
-        self._connect()
+        check_for_duplicates : boolean
+                               If True, existing locations with same name are kept and their
+                               ids returned (default False). Always done if schema has unique
+                               index on location name (see db/create_db.py --location_name_index)
 
+        return dict {name: id}
+        """
         logging.info('Adding {} locations to db...'.format(len(locations)))
+        if len(locations) == 0:
+            return {}
 
-        ids = []
-        if check_for_duplicates:
-            for loc in locations:
-                id = self.get_location_by_name(loc[0])
+        names, lats, lons = zip(*((str(loc[0]), float(loc[1]), float(loc[2])) for loc in locations))
+        sql = self._add_locations_sql(check_for_duplicates, self._has_location_index())
+        rows = self._query(sql, (list(names), list(lats), list(lons)))
+        ids = {name: int(id) for name, id in rows}
+        self.location_cache.put_many(ids)
+        return ids
 
-                if id is not None:
-                    logging.info('Found id {} for location named {}'.format(id, loc[0]))
-                    ids.append(id)
-                else:
-                    logging.info('Location with name {} not found, creating...'.format(loc[0]))
-                    sql = "INSERT INTO {schema}.location (name, geom) VALUES ('{name}', ST_GeomFromText('POINT({lon} {lat})'))".format(name=loc[0], lat=loc[1], lon=loc[2], schema=self.schema)
-                    # logging.debug(sql)
-                    self.execute(sql)
-                    id = self.get_location_by_name(loc[0])
-                    ids.append(id)
+    def _add_locations_sql(self, upsert=False, unique=False):
+        """
+        Build statement inserting locations given as name, lat and lon
+        arrays and returning (name, id) of them. With upsert, existing
+        locations are not inserted again but returned as well. With
+        unique index on location name (unique), existing names are
+        always skipped with ON CONFLICT, otherwise upsert skips names
+        found with an anti-join.
+        """
+        source = "SELECT * FROM unnest(%s::text[], %s::float8[], %s::float8[]) AS i(name, lat, lon)"
+        if not upsert and not unique:
+            return ("INSERT INTO {schema}.location (name, geom) SELECT i.name, ST_MakePoint(i.lon, i.lat) FROM ({source}) i "
+                    "RETURNING name, id").format(schema=self.schema, source=source)
+        if unique:
+            added = ("SELECT DISTINCT ON (i.name) i.name, ST_MakePoint(i.lon, i.lat) FROM input i "
+                     "ON CONFLICT (name) DO NOTHING")
         else:
-            sql = "INSERT INTO {schema}.location (name, geom) VALUES ".format(schema=self.schema)
-            first = True
-            for loc in locations:
-                if not first:
-                    sql = sql+', '
-                else:
-                    first = False
-                sql = sql + "('{name}', ST_GeomFromText('POINT({lon} {lat})'))".format(name=loc[0], lat=loc[1], lon=loc[2])
-            self.execute(sql)
+            added = ("SELECT DISTINCT ON (i.name) i.name, ST_MakePoint(i.lon, i.lat) FROM input i "
+                     "WHERE NOT EXISTS (SELECT 1 FROM {schema}.location l WHERE l.name = i.name)").format(schema=self.schema)
+        return ("WITH input AS ({source}), "
+                "added AS (INSERT INTO {schema}.location (name, geom) {added} RETURNING name, id) "
+                "SELECT name, id FROM added UNION ALL "
+                "SELECT l.name, l.id FROM {schema}.location l WHERE l.name IN (SELECT name FROM input)").format(schema=self.schema, source=source, added=added)
+
+    def _has_location_index(self):
+        """
+        Check (once) whether location table has unique index on name
+        """
+        if self._location_index is None:
+            self._location_index = bool(self._query(self._location_index_sql())[0][0])
+        return self._location_index
+
+    def _location_index_sql(self):
+        return "SELECT to_regclass('{schema}.location_name_uniq') IS NOT NULL".format(schema=self.schema)
 
     def update_rows_df(self, _type, df, dataset, row_prefix='', row_offset=0,
                        time_column='time', loc_column='loc_id', columns=[],
-                       insert=False):
+                       insert=False, method='update', copy_format='text',
+                       batch_size=100000):
         """
         Update rows from pandas dataframe
 
@@ -157,57 +248,47 @@ class mlfdb(object):
         insert      : boolean
                       If True, tries to insert if row is missing
                       Default: False
-
-        return int amount of added rows
+        method      : str
+                      update | upsert. If upsert, frame is copied into a
+                      staging table and merged with set based statements
+                      Default: update
+        copy_format : str
+                      text | binary, used with method upsert
+                      Default: text
+        batch_size  : int
+                      amount of cells sent in one COPY batch, used with method upsert
+                      Default: 100000
+
+        return int amount of added rows or, with method upsert,
+               tuple (updated, inserted) with amount of updated and inserted cells
         """
         logging.debug('Trying to update {} {}s with dataset {}'.format(len(df), _type, dataset))
-        self._connect()
-
-        # we skip metadata and start from first data value
-        numeric_indexer = False
-        if len(columns) == 0:
-            columns = list(df.columns.values)[4:]
-            numeric_indexer = True
-
-
-        sql = ""
 
-        row_num = -1 # <-- for finding correct row
-        for i, data_row in df.iterrows():
-            row_num += 1
-            j = 4
-            for param in columns:
-                t = datetime.datetime.fromtimestamp(int(data_row[time_column]))
-                loc_id = data_row[loc_column]
+        encoded = encoder.encode_df(_type, df, dataset, row_offset=row_offset,
+                                    time_column=time_column, loc_column=loc_column,
+                                    columns=columns)
+        if insert:
+            self._create_partitions_for(encoded)
+        if method == 'upsert':
+            return self._upsert(encoded, insert=insert, copy_format=copy_format, batch_size=batch_size)
 
-                if numeric_indexer:
-                    value = data_row.iloc[j]
-                else:
-                    value = data_row[param]
-
-                row = _type+'-'+dataset+'-'+str(t.timestamp())+'-'+str(loc_id)+'-'+str(int(row_num)+int(row_offset))
-
-                params = {'schema'   : self.schema,
-                          'value'    : value,
-                          '_type'    : _type,
-                          'dataset'  : dataset,
-                          'time'     : t.strftime('%Y-%m-%d %H:%M:%S'),
-                          'loc_id'   : loc_id,
-                          'parameter': param,
-                          'row'      : row}
-
-                sql += "UPDATE {schema}.data a SET value={value} WHERE a.type='{_type}' AND a.dataset='{dataset}' AND a.time='{time}' AND location_id={loc_id} AND parameter='{parameter}';".format(**params)
-
-                if insert:
-                    sql += "INSERT INTO {schema}.data (type, dataset, time, location_id, parameter, value, row) SELECT '{_type}', '{dataset}', '{time}', {loc_id}, '{parameter}', {value}, '{row}' WHERE NOT EXISTS (SELECT 1 FROM {schema}.data a WHERE a.type='{_type}' AND a.dataset='{dataset}' AND a.time='{time}' AND location_id={loc_id} AND parameter='{parameter}');".format(**params)
-
-                j += 1
+        sql = self._update_sql(encoded, insert=insert)
         logging.debug(sql)
-        return self.execute(sql)
+        if insert:
+            # Amount of inserted cells is not known, so only parameters and time spans are cataloged
+            stats = WriteStats()
+            stats.add_encoded(encoded, counts=False)
+            sql += self._version_sql(dataset) + self._catalog_sql(stats)
+        else:
+            sql += self._version_sql(dataset)
+        count = self.execute(sql)
+        self._forget_parameters(dataset)
+        return count
 
     def add_rows_from_df(self, _type, df, dataset, row_prefix='', row_offset=0,
                          time_column='time', loc_column='loc_id', columns=[],
-                         update=True):
+                         update=True, method='insert', copy_format='text',
+                         batch_size=100000, wide=False):
         """
         Add rows from pandas dataframe
 
@@ -234,403 +315,2713 @@ class mlfdb(object):
                       first 4 colums are assumed to be metadata and all columns
                       from 5th column are added.
                       Default: empty
+        method      : str
+                      insert | copy. If copy, rows are streamed with COPY FROM STDIN
+                      Default: insert
+        copy_format : str
+                      text | binary, used with method copy
+                      Default: text
+        batch_size  : int
+                      amount of cells sent in one COPY batch
+                      Default: 100000
+        wide        : boolean
+                      If True, rows are stored in wide layout table with
+                      one value array per row (see _write_wide)
+                      Default: False
 
         return int amount of added rows
         """
         logging.debug('Trying to insert {} {}s with dataset {}'.format(len(df), _type, dataset))
-        self._connect()
-
-        # we skip metadata and start from first data value
-        numeric_indexer = False
-        if len(columns) == 0:
-            columns = list(df.columns.values)[4:]
-            numeric_indexer = True
-
-        sql = "INSERT INTO {schema}.data (type, dataset, time, location_id, parameter, value, row) VALUES ".format(schema=self.schema)
-
-        first = True
-        row_num = -1 # <-- for finding correct row
-        for i, data_row in df.iterrows():
-            row_num += 1
-            j = 4
-#            print(data_row)
-            for param in columns:
-                if not first: sql = sql+', '
-                else: first = False
-
-                t = datetime.datetime.fromtimestamp(int(data_row[time_column]))
-                loc_id = data_row[loc_column]
-                if numeric_indexer:
-                    value = data_row.iloc[j]
-                else:
-                    value = data_row[param]
-
-                #print('{}: {}'.format(param, value))
 
-                row = _type+'-'+dataset+'-'+str(t.timestamp())+'-'+str(loc_id)+'-'+str(int(row_num)+int(row_offset))
-                #print(data_row)
-                #print(data_row.iloc[j])
-                sql = sql + "('{_type}', '{dataset}', '{time}', {location_id}, '{parameter}', {value}, '{row}')".format(_type=_type, dataset=dataset, time=t.strftime('%Y-%m-%d %H:%M:%S'), location_id=loc_id, parameter=param, value=value, row=row)
+        encoded = encoder.encode_df(_type, df, dataset, row_offset=row_offset,
+                                    time_column=time_column, loc_column=loc_column,
+                                    columns=columns)
+        if wide:
+            self._write_wide(encoded)
+            return len(df) - 1
 
-                j += 1
-
-            #print(sql)
-        self.execute(sql)
-        return row_num
+        self._create_partitions_for(encoded)
+        if method == 'copy':
+            self.copy_long(encoder.iter_long(encoded, batch_size), copy_format=copy_format)
+        else:
+            stats = WriteStats()
+            stats.add_encoded(encoded)
+            self.execute(self._insert_sql_long(encoded) + ';' + self._version_sql(dataset) + self._catalog_sql(stats))
+            self._forget_parameters(dataset)
 
+        return len(df) - 1
 
-    def add_rows(self, _type, header, data, metadata, dataset, row_prefix='', row_offset=0, check_uniq=False, time_column=0, loc_column=1):
+    def add_rows(self, _type, header, data, metadata, dataset, row_prefix='',
+                 row_offset=0, check_uniq=False, time_column=0, loc_column=1,
+                 method='insert', copy_format='text', batch_size=100000, wide=False):
         """
         Add rows to the db
 
-        type       : str
-                     feature or label
-        header     : list
-                     list containing data header (i.e. 'temperature';'windspeedms')
-        data       : np.array
-                     numpy array or similar containing data in the same order with header
-        metadata   : list
-                     list containing metadata in following order ['time', 'location_id']
-        dataset    : str
-                     optional dataset information
-        row_prefix : str
-                     row prefix to add (used if adding rows is done in paraller)
-        row_offset : int
-                     offset for row numbering (used if adding rows is split to batches)
+        type        : str
+                      feature or label
+        header      : list
+                      list containing data header (i.e. 'temperature';'windspeedms')
+        data        : np.array
+                      numpy array or similar containing data in the same order with header
+        metadata    : list
+                      list containing metadata in following order ['time', 'location_id']
+        dataset     : str
+                      optional dataset information
+        row_prefix  : str
+                      row prefix to add (used if adding rows is done in paraller)
+        row_offset  : int
+                      offset for row numbering (used if adding rows is split to batches)
+        method      : str
+                      insert | copy. If copy, rows are streamed with COPY FROM STDIN
+                      Default: insert
+        copy_format : str
+                      text | binary, used with method copy
+                      Default: text
+        batch_size  : int
+                      amount of cells sent in one COPY batch
+                      Default: 100000
+        wide        : boolean
+                      If True, rows are stored in wide layout table with
+                      one value array per row (see _write_wide)
+                      Default: False
 
         return int amount of added rows
         """
         logging.debug('Trying to insert {} {}s with dataset {}'.format(len(data), _type, dataset))
-        self._connect()
-
-        sql = "INSERT INTO {schema}.data (type, dataset, time, location_id, parameter, value, row) VALUES ".format(schema=self.schema)
-        i = 0 # <-- for row indexing
-        first = True
-        row_num = -1 # <-- for finding correct row
-        for row in data:
-            j = 0 # <-- for parameter
-            row_num += 1
-            for param in header:
-                if metadata[row_num][1] is None:
-                    logging.error('No location for row {} (row: {})'.format(row_num, metadata[row_num]))
-                    continue
 
-                if not first: sql = sql+', '
-                else: first = False
+        if wide:
+            self._write_wide(self._encode_arrays(_type, header, data, metadata, dataset,
+                                                 row_offset=row_offset, time_column=time_column,
+                                                 loc_column=loc_column))
+            return len(data)
+
+        rows = self._iter_array_rows(_type, header, data, metadata, dataset,
+                                     row_offset=row_offset, time_column=time_column,
+                                     loc_column=loc_column)
+        if method == 'copy':
+            self.copy_rows(rows, copy_format=copy_format, batch_size=batch_size)
+        else:
+            stats = WriteStats()
+            rows = stats.add_tuples(rows)
+            if self._compact():
+                rows = self._tuple_ids(rows)
+            sql = self._insert_sql(rows)
+            partitions = self._partitions_sql(stats)
+            if len(partitions) > 0:
+                self.execute(partitions)
+            self.execute(sql + ';' + self._version_sql(dataset) + self._catalog_sql(stats))
+            self._forget_parameters(dataset)
+
+        return len(data)
+
+    def copy_rows(self, rows, copy_format='text', batch_size=100000):
+        """
+        Stream rows into data table using COPY FROM STDIN. All batches
+        are committed in one transaction.
+
+        rows        : iterable
+                      tuples in order (type, dataset, time, location_id, parameter, value, row)
+        copy_format : str
+                      text | binary
+        batch_size  : int
+                      amount of rows serialized and sent in one COPY
 
-                if isinstance(metadata[row_num][time_column], int) or isinstance(metadata[row_num][time_column], float):
-                    t = datetime.datetime.fromtimestamp(int(metadata[row_num][time_column]))
-                else:
-                    t = metadata[row_num][time_column]
+        return int amount of copied rows
+        """
+        columns, kinds = self._columns()
+        if copy_format == 'binary':
+            serialize = lambda batch: pgcopy.binary_buffer(batch, kinds)
+        else:
+            serialize = pgcopy.text_buffer
+        stats = WriteStats()
+        rows = stats.add_tuples(rows)
 
-                loc_id = metadata[row_num][loc_column]
-                row = _type+'-'+dataset+'-'+str(t.timestamp())+'-'+str(loc_id)+'-'+str(i+row_offset)
+        def buffers(curs):
+            tuples = self._tuple_ids(rows, curs) if self._compact() else rows
+            while True:
+                batch = list(itertools.islice(tuples, batch_size))
+                if len(batch) == 0:
+                    return
+                yield serialize(batch), len(batch)
 
-                sql = sql + "('{_type}', '{dataset}', '{time}', {location_id}, '{parameter}', {value}, '{row}')".format(_type=_type, dataset=dataset, time=t.strftime('%Y-%m-%d %H:%M:%S'), location_id=loc_id, parameter=param, value=data[row_num][j], row=row)
-                j += 1
+        return self._copy(buffers, copy_format, stats)
 
-            i +=1
+    def copy_long(self, batches, copy_format='text'):
+        """
+        Stream long layout batches (see encoder.iter_long) into data
+        table using COPY FROM STDIN. All batches are committed in one
+        transaction.
 
-        #logging.debug(sql)
-        self.execute(sql)
-        return i
+        batches     : iterable
+                      long layout batches
+        copy_format : str
+                      text | binary
+
+        return int amount of copied rows
+        """
+        columns, kinds = self._columns()
+        if copy_format == 'binary':
+            serialize = lambda batch: pgcopy.binary_buffer_columns(batch, kinds)
+        else:
+            serialize = pgcopy.text_buffer_columns
+        stats = WriteStats()
+
+        def buffers(curs):
+            for batch in batches:
+                stats.add_batch(batch)
+                yield serialize(self._batch_ids(batch, curs)), len(batch['value'])
+
+        return self._copy(buffers, copy_format, stats)
+
+    def _copy(self, buffers, copy_format, stats):
+        """
+        Send serialized (buffer, row count) pairs with COPY FROM STDIN and
+        update catalogs of written datasets in the same transaction
+
+        buffers : function
+                  function returning iterable of (buffer, row count) pairs
+                  for cursor of the transaction
+        stats   : catalog.WriteStats
+                  statistics of written rows, filled while buffers are consumed
+        """
+        sql = pgcopy.copy_sql('{}.data'.format(self.schema), columns=self._columns()[0], copy_format=copy_format)
+        self._has_partitions_function()
+        catalog = self._has_catalog()
+
+        start = time.time()
+        try:
+            with self._connection() as conn:
+                with conn:
+                    with conn.cursor() as curs:
+                        count = self._copy_buffers(curs, sql, buffers(curs), stats)
+                        if catalog and len(stats.entries) > 0:
+                            for dataset in set(dataset for dataset, _type in stats.entries):
+                                curs.execute(self._version_sql(dataset))
+                            curs.execute(self._catalog_sql(stats))
+        except Exception:
+            # Ids added in the rolled back transaction do not exist
+            self._forget_ids()
+            raise
+
+        for dataset, _type in stats.entries:
+            self._forget_parameters(dataset)
+
+        elapsed = time.time() - start
+        logging.info('Copied {} rows in {:.2f}s ({:.0f} rows/s)'.format(count, elapsed, count / max(elapsed, 1e-9)))
+        return count
+
+    def _copy_buffers(self, curs, sql, buffers, stats=None):
+        """
+        Run COPY statement for each (buffer, row count) pair with given
+        cursor. If stats (catalog.WriteStats filled by buffers) is given,
+        missing partitions are created before each COPY.
+        """
+        count = 0
+        for buf, n in buffers:
+            partitions = '' if stats is None else self._partitions_sql(stats)
+            if len(partitions) > 0:
+                curs.execute(partitions)
+            curs.copy_expert(sql, buf)
+            count += n
+            logging.debug('{} rows copied...'.format(count))
+        return count
+
+    def _upsert(self, encoded, insert=False, copy_format='text', batch_size=100000):
+        """
+        Copy encoded frame (see encoder.encode_df) into a temporary staging
+        table and merge it into data table in one transaction.
+
+        Matching cells are updated with UPDATE ... FROM. Missing cells are
+        inserted with an anti-join instead of ON CONFLICT because rows
+        routed by the partition trigger never reach the parent's unique
+        index.
+
+        return tuple (updated, inserted)
+        """
+        columns, kinds = self._columns()
+        key = ' AND '.join('a.{col} = s.{col}'.format(col=col) for col in columns[:5])
+        if copy_format == 'binary':
+            serialize = lambda batch: pgcopy.binary_buffer_columns(batch, kinds)
+        else:
+            serialize = pgcopy.text_buffer_columns
+        if self._compact():
+            names = ('type_id smallint', 'dataset_id integer', 'parameter_id integer')
+        else:
+            names = ('type character varying(254)', 'dataset character varying(254)', 'parameter character varying(254)')
+        stage_source = self._named_source('data_stage', columns=('time', 'location_id', 'new_row'))
+        row_key = ' AND '.join('a.{col} = s.{col}'.format(col=col) for col in columns[:4])
+        column_list = ', '.join(columns)
+        seq = self._seq_sql()
+        catalog = self._has_catalog()
+
+        try:
+            with self._connection() as conn:
+                with conn:
+                    with conn.cursor() as curs:
+                        buffers = ((serialize(self._batch_ids(batch, curs)), len(batch['value']))
+                                   for batch in encoder.iter_long(encoded, batch_size))
+                        curs.execute("""
+                        CREATE TEMP TABLE data_stage
+                        (
+                          ord SERIAL,
+                          {},
+                          {},
+                          "time" TIMESTAMP,
+                          location_id bigint,
+                          {},
+                          value double precision,
+                          "row" character varying(254),
+                          new_row boolean DEFAULT false
+                        ) ON COMMIT DROP""".format(*names))
+                        staged = self._copy_buffers(curs, pgcopy.copy_sql('data_stage', columns=columns, copy_format=copy_format), buffers)
+
+                        # Last value wins if the frame contains the same cell several times
+                        curs.execute("DELETE FROM data_stage a USING data_stage s WHERE {key} AND a.ord < s.ord".format(key=key))
+                        staged -= curs.rowcount
+                        curs.execute("ANALYZE data_stage")
+
+                        curs.execute("UPDATE {schema}.data a SET value = s.value{seq} FROM data_stage s WHERE {key}".format(schema=self.schema, seq=seq, key=key))
+                        updated = curs.rowcount
+
+                        inserted = 0
+                        if insert:
+                            curs.execute("DELETE FROM data_stage s USING {schema}.data a WHERE {key}".format(schema=self.schema, key=key))
+                            inserted = staged - curs.rowcount
+                            if catalog:
+                                # Inserted cells may extend existing rows, only rows without any cells are new
+                                curs.execute("UPDATE data_stage s SET new_row = true WHERE NOT EXISTS (SELECT 1 FROM {schema}.data a WHERE {key})".format(schema=self.schema, key=row_key))
+                                curs.execute(self._table_catalog_sql(stage_source, new_rows='new_row'))
+                            curs.execute("INSERT INTO {schema}.data ({columns}) SELECT {columns} FROM data_stage".format(schema=self.schema, columns=column_list))
+                        if catalog:
+                            curs.execute(self._version_sql(encoded['dataset']))
+        except Exception:
+            # Ids added in the rolled back transaction do not exist
+            self._forget_ids()
+            raise
+
+        self._forget_parameters(encoded['dataset'])
+
+        logging.info('Upserted {} cells: {} updated, {} inserted'.format(staged, updated, inserted))
+        return updated, inserted
+
+    def _iter_array_rows(self, _type, header, data, metadata, dataset,
+                         row_offset=0, time_column=0, loc_column=1):
+        """
+        Generate data table tuples from header, data and metadata
+        """
+        for i in range(len(data)):
+            if metadata[i][1] is None:
+                logging.error('No location for row {} (row: {})'.format(i, metadata[i]))
+                continue
+
+            if isinstance(metadata[i][time_column], int) or isinstance(metadata[i][time_column], float):
+                t = datetime.datetime.fromtimestamp(int(metadata[i][time_column]))
+            else:
+                t = metadata[i][time_column]
+
+            loc_id = metadata[i][loc_column]
+            row = _type+'-'+dataset+'-'+str(t.timestamp())+'-'+str(loc_id)+'-'+str(i+row_offset)
+            for j, param in enumerate(header):
+                yield (_type, dataset, t, loc_id, param, data[i][j], row)
+
+    def _encode_arrays(self, _type, header, data, metadata, dataset,
+                       row_offset=0, time_column=0, loc_column=1):
+        """
+        Encode header, data and metadata like encoder.encode_df encodes
+        data frames. Rows without location are skipped like in _iter_array_rows.
+        """
+        keep, times, loc_ids, rows = [], [], [], []
+        for i in range(len(data)):
+            if metadata[i][1] is None:
+                logging.error('No location for row {} (row: {})'.format(i, metadata[i]))
+                continue
+
+            if isinstance(metadata[i][time_column], int) or isinstance(metadata[i][time_column], float):
+                t = datetime.datetime.fromtimestamp(int(metadata[i][time_column]))
+            else:
+                t = metadata[i][time_column]
+
+            loc_id = metadata[i][loc_column]
+            keep.append(i)
+            times.append(t)
+            loc_ids.append(loc_id)
+            rows.append(_type+'-'+dataset+'-'+str(t.timestamp())+'-'+str(loc_id)+'-'+str(i+row_offset))
+
+        times = np.array(times, dtype='datetime64[s]')
+        timestr = np.datetime_as_string(times, unit='s')
+        if len(timestr) > 0:
+            timestr = np.char.replace(timestr, 'T', ' ')
+        values = np.array(data, dtype=np.float64).reshape(len(data), len(header))
+
+        return {'type': _type,
+                'dataset': dataset,
+                'parameters': np.array(header, dtype=str),
+                'epoch': np.array([int(t.timestamp()) for t in times.tolist()], dtype=np.int64),
+                'time': times,
+                'timestr': timestr,
+                'location_id': np.array(loc_ids, dtype=np.int64),
+                'row': np.array(rows, dtype=str),
+                'values': np.ascontiguousarray(values[keep])}
+
+    def _write_wide(self, encoded):
+        """
+        Write encoded frame (see encoder.encode_df) into wide layout table
+        with COPY. Each row stores its values in one array ordered by the
+        parameter header of the dataset. Parameters missing from the header
+        are appended to it in the same transaction, so arrays written
+        earlier stay valid and are only shorter.
+
+        return int amount of written rows
+        """
+        n = len(encoded['row'])
+        if n == 0:
+            return 0
+
+        dataset, _type = encoded['dataset'], encoded['type']
+        stats = WriteStats()
+        stats.add_encoded(encoded)
+        sql = pgcopy.copy_sql('{}.data_wide'.format(self.schema), columns=pgcopy.WIDE_COLUMNS)
+        catalog = self._has_catalog()
+
+        start = time.time()
+        with self._connection() as conn:
+            with conn:
+                with conn.cursor() as curs:
+                    # Row lock serializes header changes of the dataset
+                    curs.execute(self._lock_header_sql(dataset, _type))
+                    header = list(curs.fetchone()[0])
+                    missing = [param for param in encoded['parameters'].tolist() if param not in header]
+                    if len(missing) > 0:
+                        curs.execute(self._extend_header_sql(dataset, _type, missing))
+                        header += missing
+                    curs.copy_expert(sql, pgcopy.text_buffer_wide(encoded, self._header_values(encoded, header)))
+                    if catalog:
+                        curs.execute(self._version_sql(dataset) + self._catalog_sql(stats))
+
+        self._forget_parameters(dataset)
+
+        elapsed = time.time() - start
+        logging.info('Copied {} wide rows in {:.2f}s ({:.0f} rows/s)'.format(n, elapsed, n / max(elapsed, 1e-9)))
+        return n
+
+    def _header_values(self, encoded, header):
+        """
+        Return values of encoded frame as (n, len(header)) matrix with
+        columns in order of header and NaN for parameters not in the frame
+        """
+        if encoded['parameters'].tolist() == header:
+            return encoded['values']
+        index = {param: i for i, param in enumerate(header)}
+        values = np.full((len(encoded['row']), len(header)), np.nan)
+        values[:, [index[param] for param in encoded['parameters'].tolist()]] = encoded['values']
+        return values
+
+    def _lock_header_sql(self, dataset, _type):
+        """
+        Build statements creating (if missing) and locking parameter header
+        of dataset and returning its parameters
+        """
+        return """INSERT INTO {schema}.dataset_header (dataset, type, parameters) VALUES ('{dataset}', '{type}', '{{}}') ON CONFLICT DO NOTHING;
+        SELECT parameters FROM {schema}.dataset_header WHERE dataset='{dataset}' AND type='{type}' FOR UPDATE""".format(
+            schema=self.schema, dataset=dataset, type=_type)
+
+    def _extend_header_sql(self, dataset, _type, parameters):
+        """
+        Build statement appending parameters to parameter header of dataset
+        """
+        return "UPDATE {schema}.dataset_header SET parameters = parameters || ARRAY[{params}]::varchar[] WHERE dataset='{dataset}' AND type='{type}'".format(
+            schema=self.schema, dataset=dataset, type=_type, params=', '.join("'{}'".format(param) for param in parameters))
+
+    def _wide_header(self, dataset, rowtype):
+        """
+        Get parameter header of dataset stored in wide layout
+
+        return list of parameters in order of value arrays or None if
+               dataset is not stored in wide layout
+        """
+        if not self._has_wide_tables():
+            return None
+        res = self._query(self._header_sql(dataset, rowtype))
+        if len(res) == 0:
+            return None
+        return list(res[0][0])
+
+    def _header_sql(self, dataset, rowtype):
+        """
+        Build query returning parameter header of dataset
+        """
+        return "SELECT parameters FROM {schema}.dataset_header WHERE dataset='{dataset}' AND type='{type}'".format(schema=self.schema, dataset=dataset, type=rowtype)
+
+    def _has_wide_tables(self):
+        """
+        Check (once) whether schema has wide layout tables
+        """
+        if self._wide_tables is None:
+            self._wide_tables = bool(self._query(self._wide_tables_sql())[0][0])
+        return self._wide_tables
+
+    def _wide_tables_sql(self):
+        return "SELECT to_regclass('{schema}.dataset_header') IS NOT NULL".format(schema=self.schema)
+
+    def _has_catalog(self):
+        """
+        Check (once) whether schema has catalog tables. Catalogs are not
+        maintained and are read from data in schemas created without them.
+        """
+        if self._catalog_tables is None:
+            self._catalog_tables = bool(self._query(self._catalog_tables_sql())[0][0])
+        return self._catalog_tables
+
+    def _catalog_tables_sql(self):
+        return "SELECT " + " AND ".join("to_regclass('{schema}.{table}') IS NOT NULL".format(schema=self.schema, table=table)
+                                        for table in CATALOG_TABLES)
+
+    def _is_catalog_filled(self):
+        """
+        Check (once) whether dataset catalog has been filled from data
+        (see refresh_dataset_catalog). Before that, time spans of the
+        catalog may miss rows written before the catalog existed.
+        """
+        if self._catalog_filled is None:
+            self._catalog_filled = self._has_catalog() and len(self._query(self._catalog_filled_sql())) > 0
+        return self._catalog_filled
+
+    def _catalog_filled_sql(self):
+        return "SELECT 1 FROM {schema}.dataset_version WHERE dataset='{marker}'".format(schema=self.schema, marker=CATALOG_FILLED)
+
+    def _has_seq_column(self):
+        """
+        Check (once) whether data table has seq column numbering changed rows
+        """
+        if self._seq_column is None:
+            self._seq_column = bool(self._query(self._seq_column_sql())[0][0])
+        return self._seq_column
+
+    def _seq_column_sql(self):
+        return "SELECT count(1) FROM information_schema.columns WHERE table_schema='{schema}' AND table_name='data' AND column_name='seq'".format(schema=self.schema)
+
+    def _seq_sql(self):
+        """
+        Return SET clause renumbering updated rows ('' if data table has no seq column).
+        Inserted rows get their number from column default.
+        """
+        if not self._has_seq_column():
+            return ''
+        return ", seq = nextval('{schema}.data_seq')".format(schema=self.schema)
+
+    def _insert_sql(self, rows):
+        """
+        Build INSERT statement from data table tuples
+        """
+        values = ("('{}', '{}', '{}', {}, '{}', {}, '{}')".format(_type, dataset, t.strftime('%Y-%m-%d %H:%M:%S'), loc_id, param, value, row)
+                  for _type, dataset, t, loc_id, param, value, row in rows)
+        return "INSERT INTO {schema}.data ({columns}) VALUES ".format(schema=self.schema, columns=', '.join(self._columns()[0])) + ', '.join(values)
 
-    def remove_dataset(self, dataset, type=None, clean_locations=False):
+    def _insert_sql_long(self, encoded, batch_size=100000):
+        """
+        Build INSERT statement from encoded frame (see encoder.encode_df)
+        """
+        values = []
+        for batch in encoder.iter_long(encoded, batch_size):
+            batch = self._batch_ids(batch)
+            values += encoder.concat_str("('{}', '{}', '".format(batch['type'], batch['dataset']),
+                                         batch['timestr'], "', ",
+                                         batch['location_id'].astype(str), ", '",
+                                         batch['parameter'], "', ",
+                                         encoder.value_strings(batch['value']), ", '",
+                                         batch['row'], "')").tolist()
+        return "INSERT INTO {schema}.data ({columns}) VALUES ".format(schema=self.schema, columns=', '.join(self._columns()[0])) + ', '.join(values)
+
+    def _update_sql(self, encoded, insert=False, batch_size=100000):
+        """
+        Build UPDATE (and INSERT if insert is True) statements for each
+        cell of encoded frame (see encoder.encode_df)
+        """
+        columns = self._columns()[0]
+        seq = self._seq_sql()
+        statements = []
+        for batch in encoder.iter_long(encoded, batch_size):
+            batch = self._batch_ids(batch)
+            loc_id = batch['location_id'].astype(str)
+            value = encoder.value_strings(batch['value'])
+            where = encoder.concat_str("a.{}='{}' AND a.{}='{}' AND a.time='".format(columns[0], batch['type'], columns[1], batch['dataset']),
+                                       batch['timestr'], "' AND location_id=", loc_id,
+                                       " AND {}='".format(columns[4]), batch['parameter'], "'")
+            sql = encoder.concat_str("UPDATE {schema}.data a SET value=".format(schema=self.schema),
+                                     value, seq + " WHERE ", where, ";")
+            if insert:
+                sql = encoder.concat_str(sql,
+                                         "INSERT INTO {schema}.data ({columns}) SELECT '{_type}', '{dataset}', '".format(schema=self.schema, columns=', '.join(columns), _type=batch['type'], dataset=batch['dataset']),
+                                         batch['timestr'], "', ", loc_id, ", '", batch['parameter'], "', ",
+                                         value, ", '", batch['row'],
+                                         "' WHERE NOT EXISTS (SELECT 1 FROM {schema}.data a WHERE ".format(schema=self.schema),
+                                         where, ");")
+            statements += sql.tolist()
+        return ''.join(statements)
+
+    def remove_dataset(self, dataset, type=None, clean_locations=False, batch_size=50000, drop_partitions=False):
         """
         Remove dataset
 
+        Partitions holding only rows of the dataset are truncated (or
+        dropped) as a whole. TRUNCATE and DROP take an ACCESS EXCLUSIVE
+        lock, so queries reading those partitions wait until each
+        partition is removed. Partitions shared with other datasets are
+        locked against writes while they are checked. Remaining rows are
+        deleted in batches, each batch in its own transaction, which does
+        not block concurrent reads.
+
         dataset : str
                   dataset name
         type : str
                If set, only given type is removed (by default all types are removed)
         clean_locations : boolean
                           If True, locations with no data rows are cleaned (default False)
+        batch_size : int
+                     amount of rows deleted in one transaction (default 50000)
+        drop_partitions : boolean
+                          If True, partitions owned by the dataset are dropped instead of
+                          truncated. Dropping locks the parent table for a moment (default False)
+
+        return int amount of deleted rows (rows of truncated partitions are not counted)
         """
 
         # Remove dataset
         logging.debug('Removing dataset "{}"'.format(dataset))
-        sql = "DELETE FROM {schema}.data WHERE dataset='{dataset}'".format(schema=self.schema, dataset=dataset)
-        if type is not None:
-            sql += " AND type='{type}'".format(type=type)
-        logging.debug(sql)
-        self.execute(sql)
+        infos = [info for info in self.get_datasets(dataset) if type is None or info['type'] == type]
+        expected = sum(info['cells'] for info in infos)
+        span = None
+        if len(infos) > 0 and self._is_catalog_filled():
+            span = (min(info['min_time'] for info in infos), max(info['max_time'] for info in infos))
+        catalog = self._has_catalog()
+        if catalog:
+            self.execute(self._version_sql(dataset))
+
+        partitions = self._remove_partitions(dataset, type, drop_partitions, span)
+        if partitions > 0:
+            logging.info('Removed {} partitions of dataset {}'.format(partitions, dataset))
+
+        deleted = self._delete_batches('{schema}.data'.format(schema=self.schema),
+                                       self._filter_sql(dataset, type, 'a.'),
+                                       batch_size, dataset, expected)
+        wide = self._has_wide_tables()
+        if wide:
+            self._delete_batches('{schema}.data_wide'.format(schema=self.schema),
+                                 self._wide_filter_sql(dataset, type, 'a.'),
+                                 batch_size, dataset)
+            self.execute(self._remove_wide_sql(dataset, type))
+
+        if catalog:
+            self.execute(self._remove_catalog_sql(dataset, type) + self._version_sql(dataset))
+        self._forget_parameters(dataset)
 
         # Clean locations
         if clean_locations:
             logging.debug('Removing locations...')
-            sql = "DELETE FROM {schema}.location WHERE id NOT IN (SELECT location_id FROM {schema}.data)".format(schema=self.schema)
-            self.execute(sql)
+            count = self.execute(self._clean_locations_sql(wide))
+            self.location_cache.clear()
+            logging.info('Removed {} locations'.format(count))
 
-    def get_locations_by_name(self, names):
-        """
-        Find location ids by names
+        return deleted
 
-        names : list
-                list of location names
+    def _remove_partitions(self, dataset, type, drop=False, span=None):
         """
-        sql = "SELECT id, name FROM {}.location WHERE name IN ({})".format(self.schema, '\''+'\',\''.join(names)+'\'')
-        # logging.debug(sql)
+        Truncate or drop leaf partitions (or inheritance children) of
+        data table holding only rows of dataset
 
-        return self._query(sql)
+        Dataset sub-partitions are recognized from their bounds, list
+        partitions of other datasets are skipped. Other partitions whose
+        time range overlaps span (min_time, max_time) of the dataset
+        (all if span is None) are probed for rows of the dataset. If
+        there are any, the partition is locked against writes and checked
+        for rows of other datasets before truncating.
 
-    def get_location_by_name(self, name):
+        return int amount of removed partitions
         """
-        Find location id by name
+        where = self._filter_sql(dataset, type, 'a.')
+        bound = 'FOR VALUES IN ({})'.format(self._key('dataset', dataset))
+        removed = 0
+        for partition, partition_bound, parent_bound in self._query(self._leaf_partitions_sql()):
+            owned = type is None and partition_bound == bound
+            if not owned:
+                if partition_bound.startswith('FOR VALUES IN') and partition_bound != bound:
+                    continue
+                if not self._overlaps(self._partition_span(partition_bound) or self._partition_span(parent_bound), span):
+                    continue
+                if not self._query(self._partition_rows_sql(partition, where))[0][0]:
+                    continue
+            with self._connection() as conn:
+                with conn:
+                    with conn.cursor() as curs:
+                        if not owned:
+                            # Self-conflicting lock keeps writers and other removals out until truncate
+                            curs.execute("LOCK TABLE {partition} IN SHARE ROW EXCLUSIVE MODE".format(partition=partition))
+                            curs.execute(self._partition_rows_sql(partition, '({}) IS NOT TRUE'.format(where)))
+                            owned = not curs.fetchone()[0]
+                        if owned:
+                            logging.debug('Removing partition {}'.format(partition))
+                            curs.execute("{} {}".format('DROP TABLE' if drop else 'TRUNCATE', partition))
+                            removed += 1
+        return removed
+
+    def _partition_span(self, bound):
+        """
+        Parse time range [start, end[ of range partition bound
 
-        name : str
-               location name
+        return (start, end) or None if bound is not a time range
+        """
+        match = re.match(r"FOR VALUES FROM \('([^']+)'\) TO \('([^']+)'\)", bound)
+        if match is None:
+            return None
+        try:
+            return tuple(datetime.datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S') for value in match.groups())
+        except ValueError:
+            return None
 
-        return id (int) or None
+    def _overlaps(self, partition_span, span):
         """
-        sql = "SELECT id FROM {schema}.location WHERE name='{name}'".format(schema=self.schema, name=name)
-        # logging.debug(sql)
-        res = self._query(sql)
-        if len(res) > 0:
-            return int(res[0][0])
+        Check whether partition time range [start, end[ may have rows
+        within dataset span [min_time, max_time]. Unknown ranges overlap.
+        """
+        if partition_span is None or span is None:
+            return True
+        return partition_span[0] <= span[1] and partition_span[1] > span[0]
 
-        return None
+    def _leaf_partitions_sql(self):
+        """
+        Build query returning leaf partitions (or inheritance children)
+        of data table, their partition bounds and bounds of their parents
+        """
+        return ("WITH RECURSIVE tree AS ("
+                "SELECT inhrelid, inhparent FROM pg_inherits WHERE inhparent = to_regclass('{schema}.data') "
+                "UNION ALL SELECT i.inhrelid, i.inhparent FROM pg_inherits i JOIN tree ON i.inhparent = tree.inhrelid) "
+                "SELECT c.oid::regclass::text, coalesce(pg_get_expr(c.relpartbound, c.oid), ''), "
+                "coalesce(pg_get_expr(p.relpartbound, p.oid), '') "
+                "FROM tree JOIN pg_class c ON c.oid = tree.inhrelid JOIN pg_class p ON p.oid = tree.inhparent "
+                "WHERE c.relkind = 'r' ORDER BY 1").format(schema=self.schema)
+
+    def _partition_rows_sql(self, partition, where):
+        """
+        Build query checking whether partition has rows matching where
+        """
+        return "SELECT EXISTS (SELECT 1 FROM ONLY {partition} a WHERE {where})".format(partition=partition, where=where)
 
-    def get_locations_by_dataset(self, dataset, starttime, endtime, rettype='tuple'):
+    def _delete_batches(self, table, where, batch_size, dataset, expected=None):
         """
-        Get all locations attached to dataset.
+        Delete rows of table matching where in batches of batch_size
+        rows, each batch in its own transaction. Batches walk the id
+        range, so each one continues where the previous one stopped.
 
-        dataset   : str
-                    dataset name
-        starttime : DateTime
-                    starttime
-        endtime : DateTime
-                  endtime
-        rettype : str
-                  tuple|dict
+        return int amount of deleted rows
+        """
+        total = 0
+        last = 0
+        while True:
+            sql = self._delete_batch_sql(table, where, batch_size, last)
+            logging.debug(sql)
+            found, last, count = self._query(sql)[0]
+            total += count
+            if count > 0:
+                if expected:
+                    logging.info('Removed {}/{} rows of dataset {}'.format(total, expected, dataset))
+                else:
+                    logging.info('Removed {} rows of dataset {}'.format(total, dataset))
+            if found < batch_size:
+                return total
 
-        returns list of tuples [(id, name, lon, lat)]
+    def _delete_batch_sql(self, table, where, batch_size, last=0):
         """
+        Build statement deleting at most batch_size rows of table matching
+        where with id greater than last
 
-        sql = "SELECT id, name, ST_x(geom) as lon, ST_y(geom) as lat"
-        sql += " FROM {schema}.location b WHERE id IN (SELECT location_id FROM {schema}.data a WHERE dataset='{dataset}' AND a.time > '{starttime}' AND a.time <= '{endtime}')".format(schema=self.schema, dataset=dataset, starttime=starttime.strftime('%Y-%m-%d %H:%M:%S'), endtime=endtime.strftime('%Y-%m-%d %H:%M:%S'))
+        Statement returns amount of matched rows, their largest id and
+        amount of deleted rows
+        """
+        return ("WITH batch AS (SELECT a.id FROM {table} a WHERE {where} AND a.id > {last} ORDER BY a.id LIMIT {limit}), "
+                "deleted AS (DELETE FROM {table} d USING batch WHERE d.id = batch.id RETURNING d.id) "
+                "SELECT (SELECT count(1) FROM batch), (SELECT coalesce(max(id), {last}) FROM batch), "
+                "(SELECT count(1) FROM deleted)").format(table=table, where=where, last=int(last), limit=int(batch_size))
 
-        logging.debug(sql)
+    def _wide_filter_sql(self, dataset, type=None, alias=''):
+        """
+        Build condition selecting rows of dataset and type from wide layout tables
+        """
+        where = "{alias}dataset='{dataset}'".format(alias=alias, dataset=dataset)
+        if type is not None:
+            where += " AND {alias}type='{type}'".format(alias=alias, type=type)
+        return where
 
-        res = self._query(sql)
-        if rettype == 'dict':
-            return self._locs_to_dict(res)
+    def _remove_wide_sql(self, dataset, type=None):
+        """
+        Build statements deleting wide layout rows and parameter header of dataset
+        """
+        where = self._wide_filter_sql(dataset, type)
+        return "DELETE FROM {schema}.data_wide WHERE {where};DELETE FROM {schema}.dataset_header WHERE {where}".format(schema=self.schema, where=where)
 
-        return res
+    def _remove_catalog_sql(self, dataset, type=None):
+        """
+        Build statements removing dataset from parameter and dataset
+        catalogs (empty if schema has no catalog tables)
+        """
+        if not self._has_catalog():
+            return ''
+        where = " WHERE dataset='{dataset}'".format(dataset=dataset)
+        if type is not None:
+            where += " AND type='{type}'".format(type=type)
+        return ''.join("DELETE FROM {schema}.{table}{where};".format(schema=self.schema, table=table, where=where)
+                       for table in ('parameter', 'dataset', 'dataset_location'))
 
-    def clean_duplicate_rows(self, dataset, rowtype, correct_length):
+    def _clean_locations_sql(self, wide=False):
         """
-        Clean duplicate rows. Note! only first 1000 rows are handled.
+        Build statement deleting locations with no data rows (anti-join
+        using index of data.location_id)
 
-        dataset : str
-                  name of dataset
-        rowtype : str
-                  feature | label
-        correct_length : int
-                         correct length of the row
+        wide : boolean
+               if True, locations referenced by wide layout rows are kept
+        """
+        sql = ("DELETE FROM {schema}.location b "
+               "WHERE NOT EXISTS (SELECT 1 FROM {schema}.data a WHERE a.location_id = b.id)").format(schema=self.schema)
+        if wide:
+            sql += " AND NOT EXISTS (SELECT 1 FROM {schema}.data_wide a WHERE a.location_id = b.id)".format(schema=self.schema)
+        return sql
 
-        returns : int
-                  count of cleaned rows
+    def get_dataset_version(self, dataset):
         """
-        self._connect()
-        sql = "SELECT row, count(1) c FROM {schema}.data WHERE type='{rowtype}' and dataset='{dataset}' GROUP BY row ORDER BY c DESC LIMIT 1000".format(schema=self.schema, rowtype=rowtype, dataset=dataset)
+        Get write version of dataset. Version is bumped by every write
+        to the dataset and used to invalidate cached results.
 
-        logging.debug(sql)
-        rows = self._query(sql)
+        dataset : str
+                  dataset name
 
-        duplicates = []
-        for row in rows:
-            if row[1] > correct_length:
-                duplicates.append(row[0])
+        return int version (0 if dataset has never been written or
+               schema has no catalog tables)
+        """
+        if not self._has_catalog():
+            return 0
+        sql = "SELECT version FROM {schema}.dataset_version WHERE dataset='{dataset}'".format(schema=self.schema, dataset=dataset)
+        res = self._query(sql)
+        if len(res) > 0:
+            return int(res[0][0])
+        return 0
 
+    def cache_stats(self):
+        """
+        Get result cache statistics
 
-        sql = "SELECT id,type,dataset,time,location_id,parameter,row FROM {schema}.data WHERE type='{rowtype}' and dataset='{dataset}' AND row IN ({duplicates})".format(schema=self.schema, rowtype=rowtype, dataset=dataset, duplicates='\''+'\',\''.join(duplicates)+'\'')
-        logging.debug(sql)
+        return dict with hits, misses, entries and bytes or None if cache is not used
+        """
+        if self.cache is None:
+            return None
+        return self.cache.stats()
 
-        rows = self._query(sql)
+    def create_partitions(self, starttime, endtime, dataset=None):
+        """
+        Create monthly partitions (and dataset sub-partitions) of data
+        table for given time range in advance. Does nothing if the schema
+        has no create_partitions function (see db/create_db.py).
 
-        df = pd.DataFrame(rows)
-        mask = df.duplicated([1,2,3,4,5,6]).as_matrix()
-        ids = df.as_matrix()
-        ids = ids[(mask)][:,0]
-        logging.debug(ids.shape)
-        logging.debug(ids)
+        starttime : DateTime
+                    start of time range
+        endtime   : DateTime
+                    end of time range
+        dataset   : str
+                    dataset written, used with dataset sub-partitioning
 
-        sql = "DELETE FROM {schema}.data WHERE id IN ({ids})".format(schema=self.schema, ids=','.join(list(map(str,ids))))
+        return int amount of created partitions
+        """
+        if not self._has_partitions_function():
+            return 0
+        sql = self._create_partitions_sql(starttime, endtime, dataset)
         logging.debug(sql)
+        created = self._query(sql)[0][0]
+        if created > 0:
+            logging.info('Created {} partitions for {} - {}'.format(created, starttime, endtime))
+        return created
 
-        self.execute(sql)
-        return len(ids)
-
-    def execute(self, statement):
+    def _create_partitions_for(self, encoded):
+        """
+        Create partitions for time range of encoded frame (see encoder.encode_df)
+        """
+        if len(encoded['time']) > 0:
+            self.create_partitions(encoded['time'].min(), encoded['time'].max(), encoded['dataset'])
 
+    def _create_partitions_sql(self, starttime, endtime, dataset=None):
         """
-        Execute single SQL statement in
-        a proper manner
+        Build query creating partitions for time range
         """
-        self._connect()
-        with self.conn as conn:
-            with conn.cursor() as curs:
-                curs.execute(statement)
-                return curs.rowcount
+        return "SELECT {schema}.create_partitions('{starttime}', '{endtime}', {dataset})".format(
+            schema=self.schema, starttime=timestamp(starttime), endtime=timestamp(endtime),
+            dataset='NULL' if dataset is None else "'{}'".format(dataset))
 
-    def _locs_to_dict(self, locs):
+    def _partitions_sql(self, stats):
         """
-        Convert locations to dict where id is key
+        Build statements creating partitions for rows collected in stats (see catalog.WriteStats)
         """
-        ret = {}
-        for loc in locs:
-            ret[loc[0]] = {'name': loc[1],
-                           'lon' : loc[2],
-                           'lat' : loc[3]}
+        if not self._has_partitions_function():
+            return ''
+        return ''.join(self._create_partitions_sql(entry['min_time'], entry['max_time'], dataset) + ';'
+                       for (dataset, _type), entry in sorted(stats.entries.items())
+                       if entry['min_time'] is not None)
 
-        return ret
+    def _has_partitions_function(self):
+        """
+        Check (once) whether schema has create_partitions function
+        """
+        if self._partitions_function is None:
+            sql = "SELECT to_regprocedure('{schema}.create_partitions(timestamp, timestamp, text)') IS NOT NULL".format(schema=self.schema)
+            self._partitions_function = bool(self._query(sql)[0][0])
+        return self._partitions_function
 
-    def _connect(self):
-        """ Create connection if needed """
-        params = self.config()
-        self.conn = psycopg2.connect(**params)
-        return self.conn
+    def _compact(self):
+        """
+        Check (once) whether data table has compact layout where type,
+        dataset and parameter are stored as ids of dictionary tables
+        """
+        if self.layout is None:
+            self.layout = 'compact' if self._query(self._layout_sql())[0][0] > 0 else 'long'
+        return self.layout == 'compact'
 
-    def _query(self, sql):
+    def _layout_sql(self):
         """
-        Execute query and return results
+        Build query returning 1 if data table has compact layout and 0 otherwise
+        """
+        return "SELECT count(1) FROM information_schema.columns WHERE table_schema='{schema}' AND table_name='data' AND column_name='dataset_id'".format(schema=self.schema)
 
-        sql str sql to execute
+    def _columns(self):
+        """
+        Return data table columns and their COPY wire types of the layout in use
+        """
+        if self._compact():
+            return pgcopy.COMPACT_COLUMNS, pgcopy.COMPACT_KINDS
+        return pgcopy.DATA_COLUMNS, pgcopy.DATA_KINDS
 
-        return list of sets
+    def _name_ids(self, kind, names, create=False, curs=None):
         """
-        self._connect()
-        with self.conn as conn:
-            with conn.cursor() as curs:
+        Translate names to ids of compact layout dictionary tables. Ids
+        never change, so they are cached for the lifetime of the instance.
+
+        kind   : str
+                 type | dataset | parameter
+        names  : iterable
+                 names to translate
+        create : bool
+                 if True, missing names are added to the dictionary
+        curs   : cursor
+                 if set, dictionary is read (and written) in transaction of
+                 the cursor. Cache has to be cleared with _forget_ids if
+                 the transaction is rolled back.
+
+        return dict {name: id}, names not in the dictionary are left out
+        """
+        names = set(str(name) for name in names)
+        with self._ids_lock:
+            missing = sorted(names - set(self._ids[kind]))
+        if len(missing) > 0 and self._resolve_ids:
+            sql = self._name_ids_sql(kind, missing)
+            if create:
+                sql = self._add_names_sql(kind, missing) + ';' + sql
+            logging.debug(sql)
+            if curs is None:
+                rows = self._query(sql)
+            else:
                 curs.execute(sql)
-                results = curs.fetchall()
-                return results
+                rows = curs.fetchall()
+            self._store_ids(kind, rows)
+        with self._ids_lock:
+            return {name: self._ids[kind][name] for name in names if name in self._ids[kind]}
 
-    def get_rows(self, dataset_name,
-                 starttime, endtime,
-                 rowtype='feature',
-                 return_type='np',
-                 parameters=[],
-                 chunk_size=1456):
+    def _name_ids_sql(self, kind, names):
         """
-        Get all feature rows from given dataset
+        Build query returning (name, id) of names in dictionary table of kind
+        """
+        return "SELECT name, id FROM {schema}.{kind}_dict WHERE name IN ({names})".format(
+            schema=self.schema, kind=kind, names=', '.join("'{}'".format(name) for name in names))
 
-        dataset_name : str
-                       dataset name
-        starttime : DateTime
-                    start time of rows ( data fetched from ]starttime, endtime] )
-        endtime : DateTime
-                    end time of rows ( data fetched from ]starttime, endtime] )
-        rowtype : str
-                  Type of rows to be returned (default feature)
-        return_type : str
-                      whether to return np arrays or pandas dataframe (np|pandas, default np)
-        parameters : list
-                     list of parameters to fetch. If omited all distinct parameters from the first 100 rows are fetched
-        chunk_size : int
-                     how large time chunks are used while reading the data from db (to save db memory)
+    def _add_names_sql(self, kind, names):
+        """
+        Build statement adding names to dictionary table of kind
+        """
+        return "INSERT INTO {schema}.{kind}_dict (name) VALUES {values} ON CONFLICT (name) DO NOTHING".format(
+            schema=self.schema, kind=kind, values=', '.join("('{}')".format(name) for name in names))
 
-        returns : np array, np array, np array or pandas DataFrame depending on return_type
+    def _store_ids(self, kind, rows):
         """
+        Add (name, id) rows to id cache
+        """
+        with self._ids_lock:
+            for name, id in rows:
+                self._ids[kind][name] = int(id)
 
-        start = starttime
-        end = starttime
-        data = []
+    def _forget_ids(self):
+        """
+        Drop cached ids of compact layout
+        """
+        with self._ids_lock:
+            self._ids = {kind: {} for kind in self._ids}
 
-        # Do long queries in chunks to save database memory
-        while end < endtime:
-            end = start + datetime.timedelta(days=chunk_size)
-            if end > endtime: end = endtime
+    def _key(self, kind, name, create=False, curs=None):
+        """
+        Return SQL literal of name or, with compact layout, its id
+        (-1 if name is not in the dictionary)
+        """
+        if not self._compact():
+            return "'{}'".format(name)
+        return str(self._name_ids(kind, [name], create, curs).get(str(name), -1))
+
+    def _column(self, kind):
+        """
+        Return data table column of type, dataset or parameter
+        """
+        return kind + '_id' if self._compact() else kind
+
+    def _filter_sql(self, dataset=None, rowtype=None, alias=''):
+        """
+        Build condition selecting rows of dataset and type from data table
+        """
+        conditions = []
+        if dataset is not None:
+            conditions.append('{}{} = {}'.format(alias, self._column('dataset'), self._key('dataset', dataset)))
+        if rowtype is not None:
+            conditions.append('{}{} = {}'.format(alias, self._column('type'), self._key('type', rowtype)))
+        return ' AND '.join(conditions)
+
+    def _parameter_keys(self, parameters):
+        """
+        Return parameters as they are stored in data table: names or,
+        with compact layout, ids as strings ('-1' for unknown names)
+        """
+        if not self._compact():
+            return list(parameters)
+        ids = self._name_ids('parameter', parameters)
+        return [str(ids.get(str(param), -1)) for param in parameters]
+
+    def _batch_ids(self, batch, curs=None):
+        """
+        Replace names in long layout batch (see encoder.iter_long) with
+        ids of compact layout. Batch is returned as is with long layout.
+        """
+        if not self._compact():
+            return batch
+        parameters = self._name_ids('parameter', pd.unique(batch['parameter']), True, curs)
+        ret = dict(batch)
+        ret['type'] = self._key('type', batch['type'], True, curs)
+        ret['dataset'] = self._key('dataset', batch['dataset'], True, curs)
+        ret['parameter'] = pd.Series(batch['parameter']).map(parameters).to_numpy().astype(str)
+        return ret
+
+    def _tuple_ids(self, rows, curs=None):
+        """
+        Replace names in data table tuples with ids of compact layout
+        """
+        for _type, dataset, t, loc_id, param, value, row in rows:
+            yield (self._key('type', _type, True, curs), self._key('dataset', dataset, True, curs), t, loc_id,
+                   self._key('parameter', param, True, curs), value, row)
+
+    def _named_source(self, table, columns=('time', 'location_id')):
+        """
+        Return table or, with compact layout, subquery joining names of
+        type, dataset and parameter to given columns of it
+        """
+        if not self._compact():
+            return table
+        return """(SELECT t.name AS type, d.name AS dataset, p.name AS parameter{columns}
+          FROM {table} s
+          LEFT JOIN {schema}.type_dict t ON t.id = s.type_id
+          LEFT JOIN {schema}.dataset_dict d ON d.id = s.dataset_id
+          LEFT JOIN {schema}.parameter_dict p ON p.id = s.parameter_id)""".format(
+              schema=self.schema, table=table, columns=''.join(', s.' + col for col in columns))
+
+    def _version_sql(self, dataset):
+        """
+        Build statement bumping dataset write version (empty if schema
+        has no catalog tables)
+        """
+        if not self._has_catalog():
+            return ''
+        return "INSERT INTO {schema}.dataset_version (dataset, version) VALUES ('{dataset}', 1) ON CONFLICT (dataset) DO UPDATE SET version = {schema}.dataset_version.version + 1;".format(schema=self.schema, dataset=dataset)
+
+    def _catalog_sql(self, stats):
+        """
+        Build statements adding statistics of written rows (see
+        catalog.WriteStats) to parameter and dataset catalogs (empty if
+        schema has no catalog tables)
+        """
+        sql = ''
+        if not self._has_catalog():
+            return sql
+        for (dataset, _type), entry in sorted(stats.entries.items()):
+            values = ', '.join("('{}', '{}', '{}')".format(dataset, _type, param) for param in sorted(entry['parameters']))
+            if len(values) > 0:
+                sql += "INSERT INTO {schema}.parameter (dataset, type, parameter) VALUES {values} ON CONFLICT DO NOTHING;".format(schema=self.schema, values=values)
+
+            if entry['min_time'] is None:
+                continue
+
+            sql += """INSERT INTO {schema}.dataset (dataset, type, min_time, max_time, row_count, cell_count) VALUES ('{dataset}', '{type}', '{min_time}', '{max_time}', {rows}, {cells}) {conflict};""".format(
+                schema=self.schema, dataset=dataset, type=_type, min_time=timestamp(entry['min_time']),
+                max_time=timestamp(entry['max_time']), rows=entry['rows'], cells=entry['cells'],
+                conflict=self._dataset_conflict_sql())
+
+            values = ', '.join("('{}', '{}', {}, '{}', '{}')".format(dataset, _type, location_id, timestamp(span[0]), timestamp(span[1]))
+                               for location_id, span in sorted(entry['locations'].items()))
+            sql += "INSERT INTO {schema}.dataset_location (dataset, type, location_id, min_time, max_time) VALUES {values} {conflict};".format(
+                schema=self.schema, values=values, conflict=self._location_conflict_sql())
+        return sql
+
+    def _table_catalog_sql(self, table, where='', conflict=True, new_rows=None):
+        """
+        Build statements adding statistics of rows in table (or subquery,
+        see _named_source) with columns type, dataset, parameter, time
+        and location_id to parameter and dataset catalogs
+
+        new_rows : str
+                   if set, only cells matching this condition are counted
+                   in row_count (default all cells)
+        """
+        return """
+        INSERT INTO {schema}.parameter (dataset, type, parameter)
+          SELECT DISTINCT dataset, type, parameter FROM {table} src{where} ON CONFLICT DO NOTHING;
+        INSERT INTO {schema}.dataset (dataset, type, min_time, max_time, row_count, cell_count)
+          SELECT dataset, type, min(time), max(time), count(DISTINCT (time, location_id)){row_filter}, count(1)
+          FROM {table} src{where} GROUP BY dataset, type {dataset_conflict};
+        INSERT INTO {schema}.dataset_location (dataset, type, location_id, min_time, max_time)
+          SELECT dataset, type, location_id, min(time), max(time)
+          FROM {table} src{where} GROUP BY dataset, type, location_id {location_conflict};
+        """.format(schema=self.schema, table=table, where=where,
+                   row_filter='' if new_rows is None else ' FILTER (WHERE {})'.format(new_rows),
+                   dataset_conflict=self._dataset_conflict_sql() if conflict else '',
+                   location_conflict=self._location_conflict_sql() if conflict else '')
+
+    def _wide_catalog_sql(self, where=''):
+        """
+        Build statements adding statistics of wide layout rows to
+        parameter and dataset catalogs. Cells are counted as lengths of
+        value arrays.
+        """
+        return """
+        {parameters};
+        INSERT INTO {schema}.dataset (dataset, type, min_time, max_time, row_count, cell_count)
+          SELECT dataset, type, min(time), max(time), count(1), sum(cardinality(value_array))
+          FROM {schema}.data_wide{where} GROUP BY dataset, type {dataset_conflict};
+        INSERT INTO {schema}.dataset_location (dataset, type, location_id, min_time, max_time)
+          SELECT dataset, type, location_id, min(time), max(time)
+          FROM {schema}.data_wide{where} GROUP BY dataset, type, location_id {location_conflict};
+        """.format(schema=self.schema, where=where, parameters=self._header_parameters_sql(where),
+                   dataset_conflict=self._dataset_conflict_sql(),
+                   location_conflict=self._location_conflict_sql())
+
+    def _header_parameters_sql(self, where=''):
+        """
+        Build statement adding parameters of wide layout headers to parameter catalog
+        """
+        return "INSERT INTO {schema}.parameter (dataset, type, parameter) SELECT dataset, type, unnest(parameters) FROM {schema}.dataset_header{where} ON CONFLICT DO NOTHING".format(schema=self.schema, where=where)
+
+    def _dataset_conflict_sql(self):
+        return """ON CONFLICT (dataset, type) DO UPDATE SET
+          min_time = LEAST({schema}.dataset.min_time, EXCLUDED.min_time),
+          max_time = GREATEST({schema}.dataset.max_time, EXCLUDED.max_time),
+          row_count = {schema}.dataset.row_count + EXCLUDED.row_count,
+          cell_count = {schema}.dataset.cell_count + EXCLUDED.cell_count""".format(schema=self.schema)
+
+    def _location_conflict_sql(self):
+        return """ON CONFLICT (dataset, type, location_id) DO UPDATE SET
+          min_time = LEAST({schema}.dataset_location.min_time, EXCLUDED.min_time),
+          max_time = GREATEST({schema}.dataset_location.max_time, EXCLUDED.max_time)""".format(schema=self.schema)
+
+    def get_datasets(self, dataset=None):
+        """
+        Get datasets from dataset catalog
+
+        dataset : str
+                  if set, only given dataset is returned
+
+        return list of dicts with keys dataset, type, min_time, max_time,
+               rows and cells (empty if schema has no catalog tables)
+        """
+        if not self._has_catalog():
+            return []
+        sql = self._datasets_sql(dataset)
+        logging.debug(sql)
+        return self._datasets_to_dicts(self._query(sql))
+
+    def _datasets_sql(self, dataset=None):
+        """
+        Build query returning dataset catalog entries
+        """
+        sql = "SELECT dataset, type, min_time, max_time, row_count, cell_count FROM {schema}.dataset".format(schema=self.schema)
+        if dataset is not None:
+            sql += " WHERE dataset='{dataset}'".format(dataset=dataset)
+        return sql + " ORDER BY dataset, type"
+
+    def _datasets_to_dicts(self, rows):
+        """
+        Convert dataset catalog rows to dicts
+        """
+        return [{'dataset': row[0], 'type': row[1], 'min_time': row[2], 'max_time': row[3],
+                 'rows': int(row[4]), 'cells': int(row[5])}
+                for row in rows]
+
+    def get_dataset_info(self, dataset, rowtype='feature'):
+        """
+        Get time span and size of dataset from dataset catalog
+
+        dataset : str
+                  dataset name
+        rowtype : str
+                  feature | label
+
+        return dict with keys dataset, type, min_time, max_time, rows
+               and cells or None if dataset is not in the catalog. rows
+               is approximate if cells have been added to existing rows
+               with update_rows_df.
+        """
+        for info in self.get_datasets(dataset):
+            if info['type'] == rowtype:
+                return info
+        return None
+
+    def get_dataset_location_ids(self, dataset, rowtype=None, starttime=None, endtime=None):
+        """
+        Get ids of locations in dataset from dataset catalog
+
+        dataset   : str
+                    dataset name
+        rowtype   : str
+                    feature | label. If None, all types are included
+        starttime : DateTime
+                    if set, only locations with data after starttime are returned
+        endtime   : DateTime
+                    if set, only locations with data before or at endtime are returned
 
-            startstr = start.strftime('%Y-%m-%d %H:%M:%S')
-            endstr = end.strftime('%Y-%m-%d %H:%M:%S')
+        return list of location ids
+        """
+        sql = "SELECT DISTINCT location_id FROM {schema}.dataset_location{where} ORDER BY location_id".format(
+            schema=self.schema, where=self._dataset_location_where(dataset, rowtype, starttime, endtime))
+        logging.debug(sql)
+        return [int(row[0]) for row in self._query(sql)]
+
+    def _dataset_location_where(self, dataset, rowtype=None, starttime=None, endtime=None):
+        """
+        Build WHERE clause selecting locations of dataset whose time span
+        overlaps ]starttime, endtime]
+        """
+        where = " WHERE dataset='{dataset}'".format(dataset=dataset)
+        if rowtype is not None:
+            where += " AND type='{type}'".format(type=rowtype)
+        if starttime is not None:
+            where += " AND max_time > '{}'".format(timestamp(starttime))
+        if endtime is not None:
+            where += " AND min_time <= '{}'".format(timestamp(endtime))
+        return where
+
+    def refresh_dataset_catalog(self, dataset=None):
+        """
+        Recompute dataset catalog from data table. Needed for data
+        written before the catalog existed and to make row counts exact.
+        Time spans of the catalog are used to clip reads only after the
+        whole catalog has been recomputed once.
 
-            if len(parameters) == 0:
-                sql = "SELECT DISTINCT(parameter) FROM (SELECT parameter FROM {schema}.data a WHERE dataset='{dataset}' AND type='{type}' AND a.time >= '{starttime}' and a.time <= '{endtime}' LIMIT 100) AS parameter".format(schema=self.schema, dataset=dataset_name, type=rowtype, starttime=startstr, endtime=endstr)
+        dataset : str
+                  if set, only given dataset is recomputed
+        """
+        where = ''
+        if dataset is not None:
+            where = " WHERE dataset='{dataset}'".format(dataset=dataset)
+        sql = "DELETE FROM {schema}.dataset{where};DELETE FROM {schema}.dataset_location{where};".format(schema=self.schema, where=where)
+        sql += self._table_catalog_sql(self._named_source('{schema}.data'.format(schema=self.schema)), where=where, conflict=False)
+        if self._has_wide_tables():
+            sql += self._wide_catalog_sql(where=where)
+        if dataset is None:
+            sql += self._catalog_filled_mark_sql()
+        logging.debug(sql)
+        self.execute(sql)
+        if dataset is None:
+            self._catalog_filled = True
+        with self._parameter_lock:
+            self._parameter_cache = {}
+
+    def _catalog_filled_mark_sql(self):
+        """
+        Build statement marking dataset catalog filled from data
+        """
+        return "INSERT INTO {schema}.dataset_version (dataset, version) VALUES ('{marker}', 1) ON CONFLICT DO NOTHING;".format(schema=self.schema, marker=CATALOG_FILLED)
+
+    def _dataset_span(self, dataset, rowtype, starttime, endtime):
+        """
+        Clip time window ]starttime, endtime] to time span of dataset in
+        dataset catalog. Window is returned as is if dataset is not in
+        the catalog or the catalog has not been filled from data.
+
+        return (starttime, endtime), empty window if there is no data
+        """
+        if not self._is_catalog_filled():
+            return starttime, endtime
+        return self._clip_span(self.get_dataset_info(dataset, rowtype), starttime, endtime)
+
+    def _clip_span(self, info, starttime, endtime):
+        """
+        Clip time window ]starttime, endtime] to time span of dataset catalog entry
+        """
+        if info is None or starttime.tzinfo is not None or endtime.tzinfo is not None:
+            return starttime, endtime
+
+        first = info['min_time'] - datetime.timedelta(seconds=1)
+        return max(starttime, first), min(endtime, info['max_time'])
+
+    def get_parameters(self, dataset, rowtype='feature', use_cache=True):
+        """
+        Get parameters of dataset from parameter catalog. Lists are
+        cached for parameter_cache_ttl seconds. If schema has no catalog
+        tables, parameters are read from data.
 
+        dataset   : str
+                    dataset name
+        rowtype   : str
+                    feature | label
+        use_cache : bool
+                    if False, catalog is always read
+
+        return list of parameter names in alphabetical order
+        """
+        key = (dataset, rowtype)
+        if use_cache:
+            with self._parameter_lock:
+                cached = self._parameter_cache.get(key)
+            if cached is not None and time.time() - cached[1] < self.parameter_cache_ttl:
+                return list(cached[0])
+
+        if self._has_catalog():
+            sql = self._parameters_catalog_sql(dataset, rowtype)
+        else:
+            sql = self._parameters_scan_sql(dataset, rowtype)
+        logging.debug(sql)
+        parameters = [row[0] for row in self._query(sql)]
+        with self._parameter_lock:
+            self._parameter_cache[key] = (parameters, time.time())
+        return list(parameters)
+
+    def rebuild_parameter_catalog(self, dataset=None):
+        """
+        Fill parameter catalog from data table. Needed for data written
+        before the catalog existed.
+
+        dataset : str
+                  if set, only given dataset is scanned
+
+        return int amount of added catalog entries
+        """
+        sql = "INSERT INTO {schema}.parameter (dataset, type, parameter) SELECT DISTINCT dataset, type, parameter FROM {source} a".format(
+            schema=self.schema, source=self._named_source('{schema}.data'.format(schema=self.schema), columns=()))
+        if dataset is not None:
+            sql += " WHERE dataset='{dataset}'".format(dataset=dataset)
+        sql += " ON CONFLICT DO NOTHING"
+        if self._has_wide_tables():
+            sql += ';' + self._header_parameters_sql('' if dataset is None else " WHERE dataset='{dataset}'".format(dataset=dataset))
+        logging.debug(sql)
+        count = self.execute(sql)
+        with self._parameter_lock:
+            self._parameter_cache = {}
+        return count
+
+    def _parameters_catalog_sql(self, dataset, rowtype):
+        """
+        Build query returning parameters of dataset from parameter catalog
+        """
+        return "SELECT parameter FROM {schema}.parameter WHERE dataset='{dataset}' AND type='{type}' ORDER BY parameter".format(schema=self.schema, dataset=dataset, type=rowtype)
+
+    def _parameters_scan_sql(self, dataset, rowtype):
+        """
+        Build query returning distinct parameters of dataset from data tables
+        """
+        where = self._filter_sql(dataset, rowtype, 'a.')
+        if self._compact():
+            sql = "SELECT DISTINCT p.name AS parameter FROM {schema}.data a JOIN {schema}.parameter_dict p ON p.id = a.parameter_id WHERE {where}".format(schema=self.schema, where=where)
+        else:
+            sql = "SELECT DISTINCT a.parameter FROM {schema}.data a WHERE {where}".format(schema=self.schema, where=where)
+        if self._has_wide_tables():
+            sql += " UNION SELECT unnest(a.parameters) FROM {schema}.dataset_header a WHERE {where}".format(
+                schema=self.schema, where=self._wide_filter_sql(dataset, rowtype, 'a.'))
+        return sql + " ORDER BY parameter"
+
+    def _forget_parameters(self, dataset):
+        """
+        Drop cached parameter lists of dataset
+        """
+        with self._parameter_lock:
+            for key in [key for key in self._parameter_cache if key[0] == dataset]:
+                del self._parameter_cache[key]
+
+    def get_locations_by_name(self, names):
+        """
+        Find location ids by names
+
+        names : list
+                list of location names
+
+        return list of tuples [(id, name)] of found locations
+        """
+        ids = self.resolve_locations(names)
+        return [(ids[name], name) for name in dict.fromkeys(map(str, names)) if name in ids]
+
+    def get_location_by_name(self, name):
+        """
+        Find location id by name
+
+        name : str
+               location name
+
+        return id (int) or None
+        """
+        return self.resolve_locations([name]).get(str(name))
+
+    def resolve_locations(self, names):
+        """
+        Resolve location names to ids. Ids are cached (see
+        location_cache_size and location_cache_ttl) and names missing
+        from the cache are looked up with one query.
+
+        names : list
+                list of location names
+
+        return dict {name: id} of found locations
+        """
+        ids, missing = self.location_cache.get_many(dict.fromkeys(map(str, names)))
+        if len(missing) > 0:
+            found = {name: int(id) for name, id in self._query(self._locations_by_name_sql(), (missing,))}
+            self.location_cache.put_many(found)
+            ids.update(found)
+        return ids
+
+    def _locations_by_name_sql(self):
+        """
+        Build query returning (name, id) of locations in name array parameter
+        """
+        return "SELECT name, id FROM {schema}.location WHERE name = ANY(%s)".format(schema=self.schema)
+
+    def get_locations_by_dataset(self, dataset, starttime, endtime, rettype='tuple'):
+        """
+        Get all locations attached to dataset. Locations are read from
+        dataset catalog and include locations whose data spans over the
+        given time window.
+
+        dataset   : str
+                    dataset name
+        starttime : DateTime
+                    starttime
+        endtime : DateTime
+                  endtime
+        rettype : str
+                  tuple|dict
+
+        returns list of tuples [(id, name, lon, lat)]
+        """
+
+        if not self._has_catalog():
+            sql = self._locations_by_dataset_sql(dataset, starttime, endtime, scan=True)
+            logging.debug(sql)
+            res = self._query(sql)
+            return self._locs_to_dict(res) if rettype == 'dict' else res
+
+        sql = self._locations_by_dataset_sql(dataset, starttime, endtime)
+        logging.debug(sql)
+
+        res = self._query(sql)
+        if len(res) == 0 and len(self.get_datasets(dataset)) == 0:
+            logging.warning('Dataset {} not found in dataset catalog, reading locations from data. Fill the catalog with refresh_dataset_catalog'.format(dataset))
+            sql = self._locations_by_dataset_sql(dataset, starttime, endtime, scan=True)
+            logging.debug(sql)
+            res = self._query(sql)
+
+        if rettype == 'dict':
+            return self._locs_to_dict(res)
+
+        return res
+
+    def _locations_by_dataset_sql(self, dataset, starttime, endtime, scan=False):
+        """
+        Build query returning locations (id, name, lon, lat) of dataset.
+        Locations are read from dataset catalog or, if scan is True, from data table.
+        """
+        sql = "SELECT id, name, ST_x(geom) as lon, ST_y(geom) as lat"
+        if scan:
+            sql += " FROM {schema}.location b WHERE id IN (SELECT location_id FROM {schema}.data a WHERE {where} AND a.time > '{starttime}' AND a.time <= '{endtime}')".format(schema=self.schema, where=self._filter_sql(dataset, alias='a.'), starttime=starttime.strftime('%Y-%m-%d %H:%M:%S'), endtime=endtime.strftime('%Y-%m-%d %H:%M:%S'))
+        else:
+            sql += " FROM {schema}.location b WHERE id IN (SELECT location_id FROM {schema}.dataset_location{where})".format(schema=self.schema, where=self._dataset_location_where(dataset, None, starttime, endtime))
+        return sql
+
+    def get_locations_within(self, bbox=None, point=None, radius=None, k=None, dataset=None,
+                             rowtype=None, starttime=None, endtime=None, rettype='tuple'):
+        """
+        Get locations selected by spatial filters. Filters are combined
+        and evaluated using the spatial index of location table.
+
+        bbox      : tuple
+                    (min_lon, min_lat, max_lon, max_lat) bounding box
+        point     : tuple
+                    (lon, lat), needed by radius and k
+        radius    : float
+                    maximum distance in meters from point
+        k         : int
+                    amount of nearest locations to point
+        dataset   : str
+                    if set, only locations of dataset in dataset catalog are
+                    returned (ignored if dataset is not in the catalog)
+        rowtype   : str
+                    feature | label, used with dataset
+        starttime : DateTime
+                    if set, only locations with data of dataset after starttime are returned
+        endtime   : DateTime
+                    if set, only locations with data of dataset before or at endtime are returned
+        rettype   : str
+                    tuple|dict
+
+        returns list of tuples [(id, name, lon, lat)] ordered by distance
+                from point or by id
+        """
+        if dataset is not None and len(self.get_datasets(dataset)) == 0:
+            logging.warning('Dataset {} not found in dataset catalog, spatial filter is applied to all locations'.format(dataset))
+            dataset = None
+
+        sql = self._locations_within_sql(bbox, point, radius, k, dataset, rowtype, starttime, endtime)
+        logging.debug(sql)
+        res = self._query(sql)
+
+        if rettype == 'dict':
+            return self._locs_to_dict(res)
+        return res
+
+    def _locations_within_sql(self, bbox=None, point=None, radius=None, k=None, dataset=None,
+                              rowtype=None, starttime=None, endtime=None):
+        """
+        Build query returning locations (id, name, lon, lat) selected by
+        spatial filters. Radius is checked on geography after prefiltering
+        with a bounding box on the indexed geometry and nearest locations
+        are found with the index assisted <-> operator.
+        """
+        if (radius is not None or k is not None) and point is None:
+            raise ValueError('point is needed with radius and k')
+
+        conditions = []
+        if bbox is not None:
+            conditions.append("b.geom && ST_MakeEnvelope({}, {}, {}, {})".format(*map(float, bbox)))
+        if point is not None:
+            lon, lat = map(float, point)
+            origin = 'ST_MakePoint({}, {})'.format(lon, lat)
+        if radius is not None:
+            dy = radius / 110574.0 * 1.01
+            dx = radius / (111320.0 * max(np.cos(np.radians(lat)), 0.01)) * 1.01
+            conditions.append("b.geom && ST_Expand({origin}, {dx}, {dy})".format(origin=origin, dx=dx, dy=dy))
+            conditions.append("ST_DWithin(b.geom::geography, {origin}::geography, {radius})".format(origin=origin, radius=float(radius)))
+        if dataset is not None:
+            conditions.append("b.id IN (SELECT location_id FROM {schema}.dataset_location{where})".format(
+                schema=self.schema, where=self._dataset_location_where(dataset, rowtype, starttime, endtime)))
+
+        sql = "SELECT id, name, ST_x(geom) as lon, ST_y(geom) as lat FROM {schema}.location b".format(schema=self.schema)
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        if point is not None:
+            sql += " ORDER BY b.geom <-> {origin}".format(origin=origin)
+        else:
+            sql += " ORDER BY b.id"
+        if k is not None:
+            sql += " LIMIT {}".format(int(k))
+        return sql
+
+    def clean_duplicate_rows(self, dataset, rowtype, correct_length=None, batch_size=50000,
+                             dry_run=False, keep='first'):
+        """
+        Clean duplicate cells of dataset, i.e. cells having same type,
+        dataset, time, location and parameter. Duplicates are found on
+        server side with a window function and deleted in batches, one
+        partition of data table at a time.
+
+        Cell counts of dataset catalog are not updated, use
+        refresh_dataset_catalog to make them exact.
+
+        dataset : str
+                  name of dataset
+        rowtype : str
+                  feature | label
+        correct_length : int
+                         not used, kept for compatibility
+        batch_size : int
+                     amount of cells deleted in one transaction (default 50000)
+        dry_run : boolean
+                  If True, duplicates are only counted (default False)
+        keep : str
+               first | last, which one of duplicate cells is kept (by id, default first)
+
+        returns : int
+                  count of cleaned (or, with dry_run, found) cells
+        """
+        where = self._filter_sql(dataset, rowtype, 'a.')
+        tables = [partition for partition, _, _ in self._query(self._leaf_partitions_sql())]
+        if len(tables) == 0:
+            tables = ['{schema}.data'.format(schema=self.schema)]
+
+        total = 0
+        for table in tables:
+            duplicates = self._duplicates_sql(table, where, keep)
+            if dry_run:
+                sql = "SELECT count(1) FROM ({duplicates}) d".format(duplicates=duplicates)
                 logging.debug(sql)
-                rows = self._query(sql)
-                for row in rows:
-                    parameters.append(row[0])
-
-            logging.debug('Fetching following parameters: {}'.format(parameters))
-            if len(parameters) == 0:
-                raise ValueError('Empty parameter set')
-
-            sql = """
-            SELECT
-            row_info[1] as location_id, row_info[2] as t, ST_x(b.geom) as lon, ST_y(b.geom) as lat, ct.{params}
-            FROM
-            crosstab ($$
-              SELECT
-         	ARRAY[cast(a.location_id as integer), cast(extract(epoch from a.time) as integer)] as row_info,
-                parameter,
-                a.value
-              FROM
-                {schema}.data a
-              JOIN (
-                VALUES """.format(params=', ct.'.join(parameters), schema=self.schema)
-
-            first = True
-            i = 0
-            for param in parameters:
-                if not first: sql += ", "
-                else: first = False
-                sql += '(\'{}\', {})'.format(param, i)
-                i += 1
-            sql += ') AS x (id, ordering) ON parameter = x.id'
-
-            sql += """
-              WHERE
-                a.type = '{type}'
-                AND dataset = '{dataset}'
-                AND a.time > '{starttime}'
-                AND a.time <= '{endtime}'
-                AND (""".format(type=rowtype, dataset=dataset_name, params=', ct.'.join(parameters), starttime=startstr, endtime=endstr, schema=self.schema)
-
-            first = True
-            for param in parameters:
-                if not first: sql += " OR "
-                else: first = False
-                sql += 'parameter=\'{param}\''.format(param=param)
-            sql += """)
-               ORDER BY row_info, x.ordering
-               $$) as ct(row_info int[]"""
-            for param in parameters:
-                sql += ', {param} float8'.format(param=param)
-            sql += """)
-            LEFT JOIN {schema}.location b ON ct.row_info[1] = b.id
-            """.format(schema=self.schema)
+                total += int(self._query(sql)[0][0])
+                continue
 
+            sql = "DELETE FROM {table} WHERE id IN (SELECT d.id FROM ({duplicates}) d LIMIT {limit})".format(table=table, duplicates=duplicates, limit=int(batch_size))
             logging.debug(sql)
-            newrows = self._query(sql)
-            logging.debug('{} new rows loaded from db...'.format(len(newrows)))
-            data += newrows
+            while True:
+                count = self.execute(sql)
+                total += count
+                if count > 0:
+                    logging.info('Removed {} duplicate cells of dataset {}'.format(total, dataset))
+                if count < batch_size:
+                    break
+
+        if total > 0 and not dry_run and self._has_catalog():
+            self.execute(self._version_sql(dataset))
+        return total
+
+    def _duplicates_sql(self, table, where, keep='first'):
+        """
+        Build query returning ids of duplicate cells in table (all but
+        the first or last cell of each group by id)
+        """
+        partition = ', '.join('a.' + column for column in self._columns()[0][:5])
+        return ("SELECT s.id FROM (SELECT a.id, row_number() OVER (PARTITION BY {partition} ORDER BY a.id{order}) AS n "
+                "FROM ONLY {table} a WHERE {where}) s WHERE s.n > 1").format(partition=partition, order=' DESC' if keep == 'last' else '',
+                                                                           table=table, where=where)
 
-            start = end
+    def execute(self, statement, params=None):
+
+        """
+        Execute single SQL statement in
+        a proper manner
+
+        params : tuple
+                 query parameters of %s placeholders in statement
+        """
+        with self._connection() as conn:
+            with conn:
+                with conn.cursor() as curs:
+                    curs.execute(statement, params)
+                    return curs.rowcount
+
+    def _locs_to_dict(self, locs):
+        """
+        Convert locations to dict where id is key
+        """
+        ret = {}
+        for loc in locs:
+            ret[loc[0]] = {'name': loc[1],
+                           'lon' : loc[2],
+                           'lat' : loc[3]}
+
+        return ret
+
+    def _connection(self):
+        """
+        Borrow connection from the pool. Pool is created (and config
+        parsed) on first use.
+
+        return context manager yielding psycopg2 connection
+        """
+        with self._pool_lock:
+            if self.pool is None:
+                self.pool = ConnectionPool(self.config(), **self.pool_options)
+        return self.pool.connection()
+
+    def _query(self, sql, params=None):
+        """
+        Execute query and return results
+
+        sql str sql to execute
+        params tuple query parameters of %s placeholders in sql
+
+        return list of sets
+        """
+        with self._connection() as conn:
+            with conn:
+                with conn.cursor() as curs:
+                    curs.execute(sql, params)
+                    results = curs.fetchall()
+                    return results
+
+    def get_rows(self, dataset_name,
+                 starttime, endtime,
+                 rowtype='feature',
+                 return_type='np',
+                 parameters=None,
+                 chunk_size=1456,
+                 workers=1,
+                 location_shards=1,
+                 engine='crosstab',
+                 use_cache=True,
+                 out=None,
+                 dtype=None,
+                 bbox=None,
+                 point=None,
+                 radius=None,
+                 k=None):
+        """
+        Get all feature rows from given dataset
 
-        logging.debug('{} rows loaded from db'.format(len(data)))
+        dataset_name : str
+                       dataset name
+        starttime : DateTime
+                    start time of rows ( data fetched from ]starttime, endtime] )
+        endtime : DateTime
+                    end time of rows ( data fetched from ]starttime, endtime] )
+        rowtype : str
+                  Type of rows to be returned (default feature)
+        return_type : str
+                      whether to return np arrays or pandas dataframe (np|pandas, default np)
+        parameters : list
+                     list of parameters to fetch. If omited all parameters of dataset in parameter catalog are fetched
+        chunk_size : int
+                     how large time chunks are used while reading the data from db (to save db memory)
+        workers : int
+                  amount of chunk queries run concurrently. Each worker
+                  borrows its own connection, so pool_maxconn limits the
+                  effective concurrency (default 1)
+        location_shards : int
+                          split each time chunk further to this many location id
+                          ranges (default 1)
+        engine : str
+                 crosstab | numpy. With crosstab rows are pivoted in the
+                 database. With numpy long rows are streamed with COPY TO
+                 STDOUT and pivoted client side. Both engines place values
+                 by parameter and return the same rows, missing values
+                 being NaN (numpy) or None (crosstab without dtype)
+                 (default crosstab)
+        use_cache : bool
+                    if False, result cache (see cache_dir) is bypassed (default True)
+        out : str
+              if set, metadata and data are written chunk by chunk as
+              float64 arrays to this directory and returned as read-only
+              np.memmap arrays (see load_memmap). Only np return_type is
+              supported and result cache is not used (default None)
+        dtype : str
+                if set (float64|float32), rows are decoded to typed arrays:
+                metadata is a structured array with int32 loc_id, int64 time
+                and float64 lon and lat fields and data a contiguous matrix
+                of given dtype with NaN for missing values. Pandas
+                DataFrame wraps the same arrays (default None, object
+                arrays as returned by the database driver)
+        bbox : tuple
+               if set, only locations within (min_lon, min_lat, max_lon, max_lat) are fetched
+        point : tuple
+                (lon, lat) used with radius and k
+        radius : float
+                 if set, only locations within radius meters from point are fetched
+        k : int
+            if set, only k locations of dataset nearest to point are fetched
+
+        Spatial filters are resolved to location ids with one query using
+        the spatial index of location table (see get_locations_within).
 
-        if len(data) == 0:
+        returns : np array, np array, np array or pandas DataFrame depending on return_type
+        """
+        if out is not None:
+            if return_type == 'pandas':
+                raise ValueError('Memory mapped output is only supported with return_type np')
+            use_cache = False
+
+        parameters = [] if parameters is None else list(parameters)
+
+        cache_key = None
+        # Cached results are invalidated by dataset versions of the catalog
+        if self.cache is not None and use_cache and self._has_catalog():
+            cache_key = self.cache.key(self.schema, dataset_name, rowtype, list(parameters),
+                                       starttime.isoformat(), endtime.isoformat(), return_type,
+                                       engine, dtype, self.get_dataset_version(dataset_name),
+                                       bbox, point, radius, k)
+            result = self.cache.get(cache_key)
+            if result is not None:
+                return result
+
+        result = self._get_rows(dataset_name, starttime, endtime, rowtype=rowtype,
+                                return_type=return_type, parameters=parameters,
+                                chunk_size=chunk_size, workers=workers,
+                                location_shards=location_shards, engine=engine,
+                                out=out, dtype=dtype, spatial=(bbox, point, radius, k))
+
+        empty = result.empty if isinstance(result, pd.DataFrame) else len(result[0]) == 0
+        if cache_key is not None and not empty:
+            self.cache.put(cache_key, result)
+        return result
+
+    def _get_rows(self, dataset_name, starttime, endtime, rowtype, return_type,
+                  parameters, chunk_size, workers, location_shards, engine, out=None,
+                  dtype=None, spatial=(None, None, None, None)):
+        """
+        Fetch rows for get_rows
+
+        spatial : tuple
+                  (bbox, point, radius, k) spatial filter of get_rows
+        """
+        starttime, endtime = self._dataset_span(dataset_name, rowtype, starttime, endtime)
+        chunks = list(self._time_chunks(starttime, endtime, chunk_size))
+        header = None
+        if len(chunks) > 0:
+            header = self._wide_header(dataset_name, rowtype)
+            if header is not None and len(parameters) == 0:
+                parameters += header
+            self._discover_parameters(dataset_name, rowtype, parameters)
+
+        if header is not None:
+            # Wide rows need no pivot, the numpy engine only parses them client side
+            if engine == 'numpy':
+                fetch = lambda task: self._fetch_wide(dataset_name, rowtype, parameters, header, *task)
+            else:
+                fetch = lambda task: self._query(self._wide_rows_sql(dataset_name, rowtype, parameters, header, *task))
+        elif engine == 'numpy':
+            fetch = lambda task: self._fetch_pivot(dataset_name, rowtype, parameters, *task)
+        else:
+            fetch = lambda task: self._query(self._rows_sql(dataset_name, rowtype, parameters, *task))
+
+        # Queries are ordered by time chunk and location range, and each
+        # query is ordered by location and time, so the result order is
+        # deterministic regardless of the amount of workers
+        if any(arg is not None for arg in spatial):
+            locations = self.get_locations_within(*spatial, dataset=dataset_name, rowtype=rowtype,
+                                                  starttime=starttime, endtime=endtime)
+            location_ranges = self._split_location_ids([loc[0] for loc in locations], location_shards)
+        else:
+            location_ranges = self._location_ranges(location_shards)
+        tasks = [(start, end, location_range) for start, end in chunks for location_range in location_ranges]
+
+        if workers > 1 and len(tasks) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                return self._collect(executor.map(fetch, tasks), parameters, rowtype, return_type, engine, out, dtype)
+        return self._collect(map(fetch, tasks), parameters, rowtype, return_type, engine, out, dtype)
+
+    def _collect(self, results, parameters, rowtype, return_type, engine, out=None, dtype=None):
+        """
+        Combine chunk results (in order) of _get_rows into the final result
+        """
+        if out is not None:
+            if engine != 'numpy':
+                results = map(self._rows_to_block, results)
+            return self._write_memmap(out, results, parameters)
+
+        if dtype is not None:
+            return self._typed_result(list(results), parameters, return_type, dtype, rows=engine != 'numpy')
+
+        results = list(results)
+        if engine == 'numpy':
+            results = [block for block in results if len(block[0]) > 0]
+            logging.debug('{} rows loaded from db'.format(sum(len(block[0]) for block in results)))
+        else:
+            results = [row for newrows in results for row in newrows]
+            logging.debug('{} rows loaded from db'.format(len(results)))
+
+        if len(results) == 0:
             if return_type == 'pandas':
                 return pd.DataFrame()
             else:
                 return [], [], []
 
+        if engine == 'numpy':
+            return self._blocks_to_result(results, parameters, rowtype, return_type)
+        return self._rows_to_result(results, parameters, rowtype, return_type)
+
+    def iter_rows(self, dataset_name,
+                  starttime, endtime,
+                  rowtype='feature',
+                  return_type='np',
+                  parameters=None,
+                  chunk_size=1456,
+                  batch_size=10000,
+                  itersize=10000,
+                  dtype=None,
+                  bbox=None,
+                  point=None,
+                  radius=None,
+                  k=None):
+        """
+        Iterate feature rows from given dataset in batches of bounded size.
+        Rows are streamed from a server-side cursor so memory usage does
+        not depend on the size of the dataset.
+
+        dataset_name : str
+                       dataset name
+        starttime : DateTime
+                    start time of rows ( data fetched from ]starttime, endtime] )
+        endtime : DateTime
+                    end time of rows ( data fetched from ]starttime, endtime] )
+        rowtype : str
+                  Type of rows to be returned (default feature)
+        return_type : str
+                      whether to yield np arrays or pandas dataframes (np|pandas, default np)
+        parameters : list
+                     list of parameters to fetch. If omited all parameters of dataset in parameter catalog are fetched
+        chunk_size : int
+                     how large time chunks are used while reading the data from db (to save db memory)
+        batch_size : int
+                     maximum amount of rows in one yielded batch
+        itersize : int
+                   amount of rows transferred from server-side cursor at once
+        dtype : str
+                if set (float64|float32), batches are decoded to typed arrays (see get_rows)
+        bbox, point, radius, k :
+                spatial filters (see get_rows)
+
+        yields : np array, np array, np array or pandas DataFrame depending on return_type
+        """
+        parameters = [] if parameters is None else list(parameters)
+        starttime, endtime = self._dataset_span(dataset_name, rowtype, starttime, endtime)
+        header = self._wide_header(dataset_name, rowtype)
+        if header is not None and len(parameters) == 0:
+            parameters += header
+        location_ids = None
+        if any(arg is not None for arg in (bbox, point, radius, k)):
+            location_ids = sorted(loc[0] for loc in self.get_locations_within(bbox, point, radius, k, dataset=dataset_name, rowtype=rowtype,
+                                                                              starttime=starttime, endtime=endtime))
+            if len(location_ids) == 0:
+                return
+        for start, end in self._time_chunks(starttime, endtime, chunk_size):
+            self._discover_parameters(dataset_name, rowtype, parameters)
+            if header is not None:
+                sql = self._wide_rows_sql(dataset_name, rowtype, parameters, header, start, end, location_ids)
+            else:
+                sql = self._rows_sql(dataset_name, rowtype, parameters, start, end, location_ids)
+
+            logging.debug(sql)
+            with self._connection() as conn:
+                with conn:
+                    with conn.cursor(name='mlfdb_iter_rows') as curs:
+                        curs.itersize = itersize
+                        curs.execute(sql)
+                        while True:
+                            rows = curs.fetchmany(batch_size)
+                            if len(rows) == 0:
+                                break
+                            logging.debug('{} new rows loaded from db...'.format(len(rows)))
+                            if dtype is not None:
+                                yield self._typed_result([rows], parameters, return_type, dtype, rows=True)
+                            else:
+                                yield self._rows_to_result(rows, parameters, rowtype, return_type)
+
+    def get_training_set(self, dataset_name,
+                         starttime, endtime,
+                         features=None,
+                         labels=None,
+                         label_dataset=None,
+                         tolerance=None,
+                         keep_unlabeled=False,
+                         return_type='np',
+                         chunk_size=1456,
+                         workers=1):
+        """
+        Get feature rows and label rows aligned by location and time. Rows
+        are joined in the database, one query per time chunk.
+
+        dataset_name : str
+                       dataset name
+        starttime : DateTime
+                    start time of rows ( data fetched from ]starttime, endtime] )
+        endtime : DateTime
+                    end time of rows ( data fetched from ]starttime, endtime] )
+        features : list
+                   feature parameters. If omited all feature parameters of dataset in parameter catalog are fetched
+        labels : list
+                 label parameters. If omited all label parameters of label dataset in parameter catalog are fetched
+        label_dataset : str
+                        dataset of labels (default dataset_name)
+        tolerance : datetime.timedelta
+                    if set, each feature row is joined with the latest label row of the
+                    same location at or before its time, at most tolerance earlier.
+                    By default label time has to match exactly.
+        keep_unlabeled : bool
+                         if True, feature rows without labels are kept with NaN labels (default False)
+        return_type : str
+                      np | pandas (default np)
+        chunk_size : int
+                     how large time chunks are used while reading the data from db (to save db memory)
+        workers : int
+                  amount of chunk queries run concurrently (default 1)
+
+        returns : metadata, X, y np arrays or pandas DataFrame depending on return_type.
+                  metadata has columns (loc_id, time, lon, lat), X columns follow
+                  features and y columns labels. Missing values are NaN.
+        """
+        label_dataset = dataset_name if label_dataset is None else label_dataset
+        features = [] if features is None else list(features)
+        labels = [] if labels is None else list(labels)
+
+        starttime, endtime = self._dataset_span(dataset_name, 'feature', starttime, endtime)
+        chunks = list(self._time_chunks(starttime, endtime, chunk_size))
+        if len(chunks) > 0:
+            self._discover_parameters(dataset_name, 'feature', features)
+            self._discover_parameters(label_dataset, 'label', labels)
+
+        fetch = lambda chunk: self._query(self._training_set_sql(dataset_name, label_dataset, features, labels,
+                                                                 chunk[0], chunk[1], tolerance, keep_unlabeled))
+        if workers > 1 and len(chunks) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                rows = [row for result in executor.map(fetch, chunks) for row in result]
+        else:
+            rows = [row for result in map(fetch, chunks) for row in result]
+        logging.debug('{} training rows loaded from db'.format(len(rows)))
+
         if return_type == 'pandas':
-            return pd.DataFrame(data, columns=['loc_id', 'time', 'lon', 'lat'] + parameters)
-            return pd.DataFrame(data)
+            label_columns = [label + '_label' if label in features else label for label in labels]
+            return pd.DataFrame(rows, columns=['loc_id', 'time', 'lon', 'lat'] + features + label_columns)
+
+        data = np.array(rows, dtype=np.float64).reshape(len(rows), 4 + len(features) + len(labels))
+        return data[:, :4], data[:, 4:4 + len(features)], data[:, 4 + len(features):]
+
+    def export_rows(self, path, dataset_name, starttime, endtime, rowtype='feature',
+                    parameters=None, format='csv', chunk_size=30, workers=1):
+        """
+        Export rows of dataset to CSV, Parquet or Arrow IPC file. Rows are
+        exported one time chunk at a time, so memory usage depends on the
+        chunk size only. With several workers chunks are fetched
+        concurrently and written in time order.
+
+        path : str
+               output file
+        dataset_name : str
+                       dataset name
+        starttime : DateTime
+                    start time of rows ( data fetched from ]starttime, endtime] )
+        endtime : DateTime
+                  end time of rows ( data fetched from ]starttime, endtime] )
+        rowtype : str
+                  feature | label (default feature)
+        parameters : list
+                     parameters to export. If omited all parameters of dataset in parameter catalog are exported
+        format : str
+                 csv | parquet | arrow (default csv). Parquet and Arrow need pyarrow
+        chunk_size : int
+                     length of exported time chunks in days (default 30)
+        workers : int
+                  amount of chunks fetched concurrently. Each worker borrows
+                  its own connection, so pool_maxconn should be at least
+                  workers (default 1)
+
+        Columns are loc_id, time (unix time), lon, lat and parameters,
+        missing values are empty (CSV) or null. Rows are ordered by time
+        chunk, location and time.
+
+        returns dict with rows, bytes and seconds
+        """
+        export.check_format(format)
+
+        parameters = [] if parameters is None else list(parameters)
+        starttime, endtime = self._dataset_span(dataset_name, rowtype, starttime, endtime)
+        chunks = list(self._time_chunks(starttime, endtime, chunk_size))
+        header = None
+        if len(chunks) > 0:
+            header = self._wide_header(dataset_name, rowtype)
+            if header is not None and len(parameters) == 0:
+                parameters += header
+            self._discover_parameters(dataset_name, rowtype, parameters)
+        logging.info('Exporting {} chunks of dataset {} ({}) to {}'.format(len(chunks), dataset_name, rowtype, path))
+
+        start = time.time()
+        if format == 'csv':
+            rows, size = self._export_csv(path, dataset_name, rowtype, parameters, header, chunks, workers, start)
         else:
-            data = np.array(data)
-            metadata = data[:,0:4]
-            data = data[:,4:]
-            logging.debug('{} \n'.format(rowtype))
-            logging.debug('Header is: \n {} \n'.format(','.join(parameters)))
+            rows, size = self._export_arrow(path, dataset_name, rowtype, parameters, header, chunks, workers, format, start)
+
+        elapsed = time.time() - start
+        logging.info('Exported {} rows ({:.1f} MB) in {:.1f}s'.format(rows, size / 1024**2, elapsed))
+        return {'rows': rows, 'bytes': size, 'seconds': elapsed}
+
+    def _export_csv(self, path, dataset_name, rowtype, parameters, header, chunks, workers, started):
+        """
+        Stream CSV of each chunk from the database to path. Concurrently
+        fetched chunks are spooled to temporary files until their turn.
+        """
+        # Build statements before fetching, so that workers do not resolve names
+        statements = [self._export_csv_sql(dataset_name, rowtype, parameters, header, start, end) for start, end in chunks]
+
+        with open(path, 'wb') as f:
+            out = export.CountingWriter(f)
+            out.write(','.join(['loc_id', 'time', 'lon', 'lat'] + parameters) + '\n')
+            rows, size = 0, out.bytes
+
+            def fetch(sql):
+                logging.debug(sql)
+                target = f if workers <= 1 else tempfile.TemporaryFile()
+                writer = export.CountingWriter(target)
+                with self._connection() as conn:
+                    with conn:
+                        with conn.cursor() as curs:
+                            curs.copy_expert(sql, writer)
+                return target, writer.rows, writer.bytes
+
+            for i, (target, chunk_rows, chunk_bytes) in enumerate(export.ordered(fetch, statements, workers)):
+                if target is not f:
+                    target.seek(0)
+                    while True:
+                        data = target.read(1024**2)
+                        if not data:
+                            break
+                        f.write(data)
+                    target.close()
+                rows += chunk_rows
+                size += chunk_bytes
+                export.progress(i + 1, len(chunks), rows, size, started)
+        return rows, size
+
+    def _export_csv_sql(self, dataset_name, rowtype, parameters, header, start, end):
+        """
+        Build COPY statement writing rows of time window as CSV
+        """
+        if header is not None:
+            query = self._wide_rows_sql(dataset_name, rowtype, parameters, header, start, end)
+        else:
+            columns = ''.join(', f.f{}'.format(i) for i in range(len(parameters)))
+            query = """
+            SELECT f.location_id, cast(extract(epoch from f.time) as integer), ST_x(b.geom), ST_y(b.geom){columns}
+            FROM ({pivot}) f
+            LEFT JOIN {schema}.location b ON b.id = f.location_id
+            ORDER BY f.location_id, f.time""".format(columns=columns, schema=self.schema,
+                                                    pivot=self._pivot_sql(dataset_name, rowtype, parameters, 'f', start, end))
+        return "COPY ({query}\n) TO STDOUT WITH (FORMAT csv)".format(query=query)
+
+    def _export_arrow(self, path, dataset_name, rowtype, parameters, header, chunks, workers, format, started):
+        """
+        Append chunks to Parquet file as row groups or to Arrow IPC file as record batches
+        """
+        schema = export.arrow_schema(parameters)
+        if header is not None:
+            fetch = lambda chunk: self._fetch_wide(dataset_name, rowtype, parameters, header, *chunk)
+        else:
+            # Resolve names before fetching, so that workers only hit the cache
+            self._parameter_keys(parameters)
+            fetch = lambda chunk: self._fetch_pivot(dataset_name, rowtype, parameters, *chunk)
+
+        writer = export.arrow_writer(path, schema, format)
+        rows = 0
+        try:
+            for i, block in enumerate(export.ordered(fetch, chunks, workers)):
+                if len(block[0]) > 0:
+                    writer.write_table(export.block_table(block, schema))
+                    rows += len(block[0])
+                # File size is known only after closing, progress shows size of values
+                export.progress(i + 1, len(chunks), rows, rows * len(schema) * 8, started)
+        finally:
+            writer.close()
+
+        return rows, os.path.getsize(path)
+
+    def _pivot_sql(self, dataset_name, rowtype, parameters, prefix, start, end):
+        """
+        Build query pivoting rows of time window ]start, end] to
+        (location_id, time, {prefix}0, {prefix}1, ...) with conditional aggregates
+        """
+        column = self._column('parameter')
+        keys = [self._key('parameter', param) for param in parameters]
+        values = ''.join(', max(a.value) FILTER (WHERE a.{column} = {key}) AS {prefix}{i}'.format(column=column, key=key, prefix=prefix, i=i)
+                         for i, key in enumerate(keys))
+        return """SELECT a.location_id, a.time{values}
+          FROM {schema}.data a
+          WHERE {filter}
+            AND a.time > '{starttime}'
+            AND a.time <= '{endtime}'
+            AND a.{column} IN ({keys})
+          GROUP BY a.location_id, a.time""".format(values=values, schema=self.schema, column=column, keys=', '.join(keys),
+                                                   filter=self._filter_sql(dataset_name, rowtype, 'a.'),
+                                                   starttime=start.strftime('%Y-%m-%d %H:%M:%S'),
+                                                   endtime=end.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def _training_set_sql(self, dataset_name, label_dataset, features, labels, start, end, tolerance=None, keep_unlabeled=False):
+        """
+        Build query returning rows (location_id, t, lon, lat, features..., labels...)
+        ordered by location and time for time window ]start, end]
+
+        With tolerance, the latest label time at or before each feature
+        time is found with a running max over feature and label times
+        merged by location.
+        """
+        label_start = start if tolerance is None else start - tolerance
+        sql = """
+        WITH f AS ({features}),
+        l AS ({labels})""".format(features=self._pivot_sql(dataset_name, 'feature', features, 'f', start, end),
+                                  labels=self._pivot_sql(label_dataset, 'label', labels, 'l', label_start, end))
+        if tolerance is None:
+            on = "l.location_id = f.location_id AND l.time = f.time"
+            source = "f"
+        else:
+            sql += """,
+        m AS (SELECT t.location_id, t.time, t.is_feature,
+                     max(CASE WHEN t.is_feature THEN NULL ELSE t.time END) OVER (PARTITION BY t.location_id ORDER BY t.time, t.is_feature ROWS UNBOUNDED PRECEDING) AS label_time
+              FROM (SELECT location_id, time, true AS is_feature FROM f UNION ALL SELECT location_id, time, false FROM l) t)"""
+            on = "l.location_id = f.location_id AND l.time = m.label_time AND l.time >= f.time - interval '{} seconds'".format(tolerance.total_seconds())
+            source = "f JOIN m ON m.is_feature AND m.location_id = f.location_id AND m.time = f.time"
+
+        columns = ''.join(', f.f{}'.format(i) for i in range(len(features))) + ''.join(', l.l{}'.format(i) for i in range(len(labels)))
+        sql += """
+        SELECT f.location_id, cast(extract(epoch from f.time) as integer), ST_x(b.geom) as lon, ST_y(b.geom) as lat{columns}
+        FROM {source}
+        {join} l ON {on}
+        LEFT JOIN {schema}.location b ON b.id = f.location_id
+        ORDER BY f.location_id, f.time""".format(columns=columns, source=source, join='LEFT JOIN' if keep_unlabeled else 'JOIN',
+                                                on=on, schema=self.schema)
+        return sql
+
+    def get_changes(self, dataset_name, since=0, rowtype='feature', parameters=None, return_type='np'):
+        """
+        Get cells of dataset inserted or updated after watermark. Every
+        write numbers the cells it inserts or updates from data_seq
+        sequence (see db/create_db.py --add_seq), so changes can be
+        merged into earlier fetched rows instead of fetching them again.
+        Removed cells are not reported. Rows of wide layout are not
+        numbered, so datasets stored in it are not supported.
+
+        Writes still in progress get their numbers before they commit,
+        so cells of a write committing after this call may have numbers
+        below the returned watermark. Pass an earlier watermark to cover
+        such writes, fetching cells again is harmless.
+
+        dataset_name : str
+                       dataset name
+        since : int
+                watermark returned by previous call (default 0, all numbered cells)
+        rowtype : str
+                  Type of rows to be returned (default feature)
+        parameters : list
+                     list of parameters to fetch. If omited all parameters of dataset in parameter catalog are fetched
+        return_type : str
+                      whether to return np arrays or pandas dataframe (np|pandas, default np)
+
+        returns : (result, watermark) where result is like result of
+                  get_rows with engine numpy with NaN for cells not changed
+        """
+        if not self._has_seq_column():
+            raise ValueError('Data table has no seq column, add it with db/create_db.py --add_seq')
+        if self._wide_header(dataset_name, rowtype) is not None:
+            raise ValueError('Dataset {} ({}) is stored in wide layout, which does not number changed rows'.format(dataset_name, rowtype))
+
+        parameters = self.get_parameters(dataset_name, rowtype) if parameters is None else list(parameters)
+        keys = self._parameter_keys(parameters)
+        params = ', '.join(self._key('parameter', param) for param in parameters)
+        where = "{filter} AND a.seq > {since}".format(filter=self._filter_sql(dataset_name, rowtype, 'a.'), since=int(since))
+
+        buf = io.BytesIO()
+        with self._connection() as conn:
+            with conn:
+                with conn.cursor() as curs:
+                    # Watermark and cells are read from the same snapshot
+                    curs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                    curs.execute("SELECT max(a.seq) FROM {schema}.data a WHERE {where}".format(schema=self.schema, where=where))
+                    watermark = curs.fetchone()[0]
+                    if watermark is not None and len(parameters) > 0:
+                        sql = self._changes_sql(where, watermark, params)
+                        logging.debug(sql)
+                        curs.copy_expert(sql, buf)
+
+        watermark = int(since) if watermark is None else int(watermark)
+        loc_ids, times, data = self._read_long(buf, keys)
+        if len(loc_ids) == 0:
+            if return_type == 'pandas':
+                return pd.DataFrame(), watermark
+            return ([], parameters, []), watermark
+
+        block = self._pivot_block(loc_ids, times, data, self._location_coordinates(loc_ids))
+        logging.info('{} changed rows of dataset {} up to {}'.format(len(loc_ids), dataset_name, watermark))
+        return self._blocks_to_result([block], parameters, rowtype, return_type), watermark
+
+    def _changes_sql(self, where, watermark, params):
+        """
+        Build COPY statement streaming long rows (location_id, t, parameter, value)
+        matching where and numbered at most watermark
+
+        params : str
+                 SQL list of parameters as stored in data table
+        """
+        return """
+        COPY (SELECT a.location_id, cast(extract(epoch from a.time) as integer), a.{column}, a.value
+          FROM {schema}.data a
+          WHERE {where}
+            AND a.seq <= {watermark}
+            AND a.{column} IN ({params})
+        ) TO STDOUT""".format(schema=self.schema, column=self._column('parameter'), where=where, watermark=int(watermark), params=params)
+
+    def _time_chunks(self, starttime, endtime, chunk_size):
+        """
+        Split ]starttime, endtime] into chunk_size days long windows
+
+        yields (start, end) tuples
+        """
+        start = starttime
+        end = starttime
+        while end < endtime:
+            end = start + datetime.timedelta(days=chunk_size)
+            if end > endtime: end = endtime
+            yield start, end
+            start = end
+
+    def _location_ranges(self, shards):
+        """
+        Split location ids into shards equally long id ranges
+
+        returns list of (first, last) tuples or [None] if shards is 1
+        """
+        if shards <= 1:
+            return [None]
+
+        sql = "SELECT min(id), max(id) FROM {schema}.location".format(schema=self.schema)
+        first, last = self._query(sql)[0]
+        return self._split_location_range(first, last, shards)
+
+    def _split_location_ids(self, location_ids, shards):
+        """
+        Split location ids into shards lists of consecutive ids
+
+        returns list of id lists (empty if there are no ids)
+        """
+        location_ids = sorted(location_ids)
+        return [[int(i) for i in ids] for ids in np.array_split(location_ids, max(1, min(shards, len(location_ids)))) if len(ids) > 0]
+
+    def _location_filter_sql(self, location_range, alias='a.'):
+        """
+        Build condition limiting rows to location_range, which is either
+        (first, last) tuple of location id range or list of location ids
+        """
+        if location_range is None:
+            return ''
+        if isinstance(location_range, list):
+            return """
+          AND {alias}location_id = ANY('{{{ids}}}'::int[])""".format(alias=alias, ids=','.join(map(str, location_range)))
+        return """
+          AND {alias}location_id BETWEEN {first} AND {last}""".format(alias=alias, first=location_range[0], last=location_range[1])
+
+    def _split_location_range(self, first, last, shards):
+        """
+        Split location ids [first, last] into shards equally long id ranges
+        """
+        if first is None:
+            return [None]
+
+        bounds = np.linspace(first, last + 1, shards + 1).astype(np.int64)
+        return [(int(lo), int(hi) - 1) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+    def _discover_parameters(self, dataset_name, rowtype, parameters):
+        """
+        Fill empty parameter list from parameter catalog. If dataset is
+        not in the catalog, distinct parameters of the dataset are read
+        from data, which scans all its rows.
+        """
+        if len(parameters) == 0:
+            parameters += self.get_parameters(dataset_name, rowtype)
+
+        if len(parameters) == 0 and self._has_catalog():
+            logging.warning('Dataset {} ({}) not found in parameter catalog, reading parameters from all rows. Fill the catalog with rebuild_parameter_catalog'.format(dataset_name, rowtype))
+            sql = self._parameters_scan_sql(dataset_name, rowtype)
+
+            logging.debug(sql)
+            rows = self._query(sql)
+            for row in rows:
+                parameters.append(row[0])
+
+        logging.debug('Fetching following parameters: {}'.format(parameters))
+        if len(parameters) == 0:
+            raise ValueError('Empty parameter set')
+
+    def _rows_sql(self, dataset_name, rowtype, parameters, start, end, location_range=None):
+        """
+        Build crosstab query returning rows (location_id, t, lon, lat, parameters...)
+        ordered by location and time for time window ]start, end]. If
+        location_range (see _location_filter_sql) is given, only those locations are included.
+
+        Values are placed by parameter position with the two argument
+        form of crosstab, so missing cells are NULL in their own column.
+        """
+        startstr = start.strftime('%Y-%m-%d %H:%M:%S')
+        endstr = end.strftime('%Y-%m-%d %H:%M:%S')
+        keys = [self._key('parameter', param) for param in parameters]
+
+        sql = """
+        SELECT
+        row_info[1] as location_id, row_info[2] as t, ST_x(b.geom) as lon, ST_y(b.geom) as lat, ct.{params}
+        FROM
+        crosstab ($$
+          SELECT
+     	ARRAY[cast(a.location_id as integer), cast(extract(epoch from a.time) as integer)] as row_info,
+            x.ordering,
+            a.value
+          FROM
+            {schema}.data a
+          JOIN (
+            VALUES """.format(params=', ct.'.join(parameters), schema=self.schema)
+
+        sql += ', '.join('({}, {})'.format(key, i) for i, key in enumerate(keys))
+        sql += ') AS x (id, ordering) ON {} = x.id'.format(self._column('parameter'))
+
+        sql += """
+          WHERE
+            {filter}
+            AND a.time > '{starttime}'
+            AND a.time <= '{endtime}'""".format(filter=self._filter_sql(dataset_name, rowtype, 'a.'), starttime=startstr, endtime=endstr)
+
+        sql += self._location_filter_sql(location_range)
+
+        sql += """
+            AND ({params})
+           ORDER BY row_info
+           $$, $$SELECT generate_series(0, {last})$$) as ct(row_info int[]""".format(
+               params=' OR '.join('{column}={key}'.format(column=self._column('parameter'), key=key) for key in keys),
+               last=len(parameters) - 1)
+        for param in parameters:
+            sql += ', {param} float8'.format(param=param)
+        sql += """)
+        LEFT JOIN {schema}.location b ON ct.row_info[1] = b.id
+        """.format(schema=self.schema)
+
+        return sql
+
+    def _long_sql(self, dataset_name, rowtype, parameters, start, end, location_range=None):
+        """
+        Build COPY statement streaming long rows (location_id, t, parameter, value)
+        for time window ]start, end]
+        """
+        return """
+        COPY ({query}
+        ) TO STDOUT""".format(query=self._long_query(dataset_name, rowtype, parameters, start, end, location_range))
+
+    def _long_query(self, dataset_name, rowtype, parameters, start, end, location_range=None):
+        """
+        Build query returning long rows (location_id, t, parameter, value)
+        for time window ]start, end]
+        """
+        sql = """
+          SELECT a.location_id, cast(extract(epoch from a.time) as integer), a.{column}, a.value
+          FROM {schema}.data a
+          WHERE
+            {filter}
+            AND a.time > '{starttime}'
+            AND a.time <= '{endtime}'
+            AND a.{column} IN ({params})""".format(schema=self.schema, column=self._column('parameter'),
+                                                    filter=self._filter_sql(dataset_name, rowtype, 'a.'),
+                                                    starttime=start.strftime('%Y-%m-%d %H:%M:%S'),
+                                                    endtime=end.strftime('%Y-%m-%d %H:%M:%S'),
+                                                    params=', '.join(self._key('parameter', param) for param in parameters))
+        sql += self._location_filter_sql(location_range)
+        return sql
+
+    def _fetch_pivot(self, dataset_name, rowtype, parameters, start, end, location_range=None):
+        """
+        Stream long rows of one time window with COPY TO STDOUT and pivot
+        them client side
+
+        returns (metadata, data) where metadata is (n, 4) float64 array of
+                (location_id, t, lon, lat) and data (n, len(parameters))
+                float64 array, ordered by location and time
+        """
+        sql = self._long_sql(dataset_name, rowtype, parameters, start, end, location_range)
+        logging.debug(sql)
+
+        buf = io.BytesIO()
+        with self._connection() as conn:
+            with conn:
+                with conn.cursor() as curs:
+                    curs.copy_expert(sql, buf)
+
+        loc_ids, times, data = self._read_long(buf, self._parameter_keys(parameters))
+        if len(loc_ids) == 0:
+            return np.empty((0, 4)), data
+        return self._pivot_block(loc_ids, times, data, self._location_coordinates(loc_ids))
+
+    def _wide_rows_sql(self, dataset_name, rowtype, parameters, header, start, end, location_range=None):
+        """
+        Build query returning rows (location_id, t, lon, lat, parameters...)
+        of wide layout table ordered by location and time for time window
+        ]start, end]. Rows have the same form as rows of crosstab query
+        (see _rows_sql), values are picked from value arrays by position
+        in header.
+        """
+        index = {param: i + 1 for i, param in enumerate(header)}
+        columns = ', '.join('a.value_array[{}]'.format(index[param]) if param in index else 'NULL::float8'
+                            for param in parameters)
+        sql = """
+        SELECT a.location_id, cast(extract(epoch from a.time) as integer), ST_x(b.geom) as lon, ST_y(b.geom) as lat, {columns}
+        FROM {schema}.data_wide a
+        LEFT JOIN {schema}.location b ON a.location_id = b.id
+        WHERE
+          a.dataset = '{dataset}'
+          AND a.type = '{type}'
+          AND a.time > '{starttime}'
+          AND a.time <= '{endtime}'""".format(schema=self.schema, columns=columns, dataset=dataset_name, type=rowtype,
+                                             starttime=start.strftime('%Y-%m-%d %H:%M:%S'),
+                                             endtime=end.strftime('%Y-%m-%d %H:%M:%S'))
+        sql += self._location_filter_sql(location_range)
+        sql += """
+        ORDER BY a.location_id, a.time"""
+        return sql
+
+    def _fetch_wide(self, dataset_name, rowtype, parameters, header, start, end, location_range=None):
+        """
+        Stream wide layout rows of one time window with COPY TO STDOUT
+        straight into float64 arrays
+
+        returns (metadata, data) like _fetch_pivot
+        """
+        sql = """
+        COPY ({query}
+        ) TO STDOUT""".format(query=self._wide_rows_sql(dataset_name, rowtype, parameters, header, start, end, location_range))
+        logging.debug(sql)
+
+        buf = io.BytesIO()
+        with self._connection() as conn:
+            with conn:
+                with conn.cursor() as curs:
+                    curs.copy_expert(sql, buf)
+        return self._read_wide(buf, len(parameters))
+
+    def _read_wide(self, buf, n_parameters):
+        """
+        Parse wide rows written by COPY TO STDOUT into buffer
+
+        returns (metadata, data) float64 arrays
+        """
+        if buf.tell() == 0:
+            return np.empty((0, 4)), np.empty((0, n_parameters))
+        buf.seek(0)
+
+        block = pd.read_csv(buf, sep='\t', header=None, quoting=csv.QUOTE_NONE, dtype=np.float64,
+                            na_values=['\\N'], keep_default_na=False).to_numpy()
+        logging.debug('{} wide rows loaded from db...'.format(len(block)))
+        return np.ascontiguousarray(block[:, :4]), np.ascontiguousarray(block[:, 4:])
+
+    def _read_long(self, buf, parameters):
+        """
+        Parse long rows written by COPY TO STDOUT into buffer and pivot them
+
+        parameters : list
+                     parameters as stored in data table (see _parameter_keys)
+
+        returns (location ids, times, data) ordered by location and time
+        """
+        if buf.tell() == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty((0, len(parameters)))
+        buf.seek(0)
+
+        long = pd.read_csv(buf, sep='\t', header=None, quoting=csv.QUOTE_NONE,
+                           names=['location_id', 't', 'parameter', 'value'],
+                           dtype={'location_id': np.int64, 't': np.int64, 'parameter': str, 'value': np.float64},
+                           na_values=['\\N'], keep_default_na=False)
+        logging.debug('{} long rows loaded from db...'.format(len(long)))
+
+        return self._pivot(long['location_id'].to_numpy(), long['t'].to_numpy(),
+                           long['parameter'].to_numpy(), long['value'].to_numpy(),
+                           parameters)
+
+    def _pivot_block(self, loc_ids, times, data, coordinates):
+        """
+        Combine pivoted arrays and (lon, lat) coordinates to (metadata, data) block
+        """
+        metadata = np.empty((len(loc_ids), 4))
+        metadata[:, 0] = loc_ids
+        metadata[:, 1] = times
+        metadata[:, 2:] = coordinates
+        return metadata, data
+
+    def _pivot(self, loc_ids, times, params, values, parameters):
+        """
+        Pivot long (location_id, t, parameter, value) arrays into a
+        matrix with one row per (location_id, t) and one column per
+        parameter
+
+        returns (location ids, times, data) ordered by location and time
+        """
+        # -1 for parameters not asked for
+        columns = pd.Index(parameters).get_indexer(params)
+        order = np.lexsort((times, loc_ids))
+        loc_ids, times, columns, values = loc_ids[order], times[order], columns[order], values[order]
+
+        new_row = np.empty(len(order), dtype=bool)
+        new_row[:1] = True
+        new_row[1:] = (loc_ids[1:] != loc_ids[:-1]) | (times[1:] != times[:-1])
+        rows = np.cumsum(new_row) - 1
+
+        data = np.full((int(new_row.sum()), len(parameters)), np.nan)
+        known = columns >= 0
+        data[rows[known], columns[known]] = values[known]
+        return loc_ids[new_row], times[new_row], data
+
+    def _location_coordinates(self, loc_ids):
+        """
+        Get (lon, lat) of given location ids, NaN for unknown locations
+
+        returns (n, 2) float64 array
+        """
+        unique = np.unique(loc_ids)
+        if len(unique) == 0:
+            return np.full((len(loc_ids), 2), np.nan)
+
+        locations = self._query(self._coordinates_sql(unique))
+        return self._match_coordinates(loc_ids, locations)
+
+    def _coordinates_sql(self, unique):
+        """
+        Build query returning (id, lon, lat) of given unique location ids
+        """
+        return "SELECT id, ST_x(geom), ST_y(geom) FROM {schema}.location WHERE id IN ({ids})".format(schema=self.schema, ids=','.join(map(str, unique)))
+
+    def _match_coordinates(self, loc_ids, locations):
+        """
+        Map (id, lon, lat) rows to (lon, lat) of each location id, NaN for unknown locations
+
+        returns (n, 2) float64 array
+        """
+        coordinates = np.full((len(loc_ids), 2), np.nan)
+        locations = np.array(locations, dtype=np.float64).reshape(-1, 3)
+
+        idx = pd.Index(locations[:, 0].astype(np.int64)).get_indexer(loc_ids)
+        found = idx >= 0
+        coordinates[found] = locations[idx[found], 1:]
+        return coordinates
+
+    def _blocks_to_result(self, blocks, parameters, rowtype, return_type):
+        """
+        Concatenate (metadata, data) blocks to np arrays or pandas DataFrame
+        """
+        metadata = np.concatenate([block[0] for block in blocks])
+        data = np.concatenate([block[1] for block in blocks])
+        logging.debug('Shape of metadata: {}'.format(metadata.shape))
+        logging.debug('Shape of data {}'.format(data.shape))
+
+        if return_type == 'pandas':
+            df = pd.DataFrame(data, columns=parameters)
+            df.insert(0, 'loc_id', metadata[:, 0].astype(np.int64))
+            df.insert(1, 'time', metadata[:, 1].astype(np.int64))
+            df.insert(2, 'lon', metadata[:, 2])
+            df.insert(3, 'lat', metadata[:, 3])
+            return df
+
+        return metadata, parameters, data
+
+    def _rows_to_block(self, rows):
+        """
+        Convert list of row tuples to (metadata, data) float64 arrays, None as NaN
+        """
+        if len(rows) == 0:
+            return np.empty((0, 4)), np.empty((0, 0))
+        block = np.array(rows, dtype=np.float64)
+        return block[:, 0:4], block[:, 4:]
+
+    def _typed_result(self, blocks, parameters, return_type, dtype, rows=False):
+        """
+        Decode (metadata, data) float64 blocks or, if rows is True,
+        lists of crosstab row tuples into typed arrays. Arrays are
+        allocated once and filled block by block. Blocks are dropped
+        from the list as they are decoded, so memory of a block is
+        released as soon as it has been copied.
+
+        returns : structured np array, list, np array or pandas DataFrame depending on return_type
+        """
+        n = sum(len(block) if rows else len(block[0]) for block in blocks)
+        loc_id = np.empty(n, dtype=np.int32)
+        t = np.empty(n, dtype=np.int64)
+        lon = np.empty(n, dtype=np.float64)
+        lat = np.empty(n, dtype=np.float64)
+        data = np.empty((n, len(parameters)), dtype=dtype)
+
+        i = 0
+        for k in range(len(blocks)):
+            block, blocks[k] = blocks[k], None
+            if rows:
+                if len(block) == 0:
+                    continue
+                # None is converted to NaN
+                metadata = np.array([row[0:4] for row in block], dtype=np.float64)
+                values = [row[4:] for row in block]
+            else:
+                metadata, values = block
+                if len(metadata) == 0:
+                    continue
+            j = i + len(metadata)
+            loc_id[i:j] = metadata[:, 0]
+            t[i:j] = metadata[:, 1]
+            lon[i:j] = metadata[:, 2]
+            lat[i:j] = metadata[:, 3]
+            data[i:j] = values
+            i = j
+            del block, metadata, values
+        logging.debug('Decoded {} rows to {} matrix of shape {}'.format(n, data.dtype, data.shape))
+
+        if return_type == 'pandas':
+            df = pd.DataFrame(data, columns=parameters, copy=False)
+            df.insert(0, 'loc_id', loc_id)
+            df.insert(1, 'time', t)
+            df.insert(2, 'lon', lon)
+            df.insert(3, 'lat', lat)
+            return df
+
+        metadata = np.empty(n, dtype=[('loc_id', np.int32), ('time', np.int64), ('lon', np.float64), ('lat', np.float64)])
+        metadata['loc_id'] = loc_id
+        metadata['time'] = t
+        metadata['lon'] = lon
+        metadata['lat'] = lat
+        return metadata, parameters, data
+
+    def _write_memmap(self, out, blocks, parameters):
+        """
+        Append (metadata, data) blocks to float64 files in directory out
+        as they arrive and return them memory mapped
+
+        returns : np.memmap, list, np.memmap
+        """
+        os.makedirs(out, exist_ok=True)
+
+        rows = 0
+        with open(os.path.join(out, 'metadata.f8'), 'wb') as fm, open(os.path.join(out, 'data.f8'), 'wb') as fd:
+            for metadata, data in blocks:
+                if len(metadata) == 0:
+                    continue
+                np.ascontiguousarray(metadata, dtype=np.float64).tofile(fm)
+                np.ascontiguousarray(data, dtype=np.float64).tofile(fd)
+                rows += len(metadata)
+                logging.debug('{} rows written to {}...'.format(rows, out))
+
+        with open(os.path.join(out, 'header.json'), 'w') as f:
+            json.dump({'rows': rows, 'parameters': list(parameters), 'dtype': 'float64'}, f)
+
+        logging.debug('{} rows written to {}'.format(rows, out))
+        return self.load_memmap(out)
+
+    def load_memmap(self, path):
+        """
+        Open arrays written by get_rows(out=path)
+
+        path : str
+               directory given as out to get_rows
+
+        returns : np.memmap, list, np.memmap (metadata, parameters, data)
+        """
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+
+        rows, parameters = header['rows'], header['parameters']
+        if rows == 0:
+            return np.empty((0, 4)), parameters, np.empty((0, len(parameters)))
+
+        metadata = np.memmap(os.path.join(path, 'metadata.f8'), dtype=header['dtype'], mode='r', shape=(rows, 4))
+        data = np.memmap(os.path.join(path, 'data.f8'), dtype=header['dtype'], mode='r', shape=(rows, len(parameters)))
+        return metadata, parameters, data
+
+    def _rows_to_result(self, data, parameters, rowtype, return_type):
+        """
+        Convert list of row tuples to np arrays or pandas DataFrame
+        """
+        if return_type == 'pandas':
+            return pd.DataFrame(data, columns=['loc_id', 'time', 'lon', 'lat'] + parameters)
+
+        data = np.array(data)
+        metadata = data[:,0:4]
+        data = data[:,4:]
+        logging.debug('{} \n'.format(rowtype))
+        logging.debug('Header is: \n {} \n'.format(','.join(parameters)))
 
-            logging.debug('Shape of metadata: {}'.format(np.array(metadata).shape))
-            logging.debug('Sample of metadata: \n {} \n'.format(np.array(metadata[0:10])))
+        logging.debug('Shape of metadata: {}'.format(np.array(metadata).shape))
+        logging.debug('Sample of metadata: \n {} \n'.format(np.array(metadata[0:10])))
 
-            logging.debug('Shape of data {}'.format(data.shape))
-            logging.debug('Sample of data: \n {} \n '.format(data))
+        logging.debug('Shape of data {}'.format(data.shape))
+        logging.debug('Sample of data: \n {} \n '.format(data))
 
-            return metadata, parameters, data
+        return metadata, parameters, data
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Helpers to serialize data rows for PostgreSQL COPY ... FROM STDIN
+
+Rows are either tuples or long layout batches (see encoder.iter_long)
+in the column order of DATA_COLUMNS:
+(type, dataset, time, location_id, parameter, value, row)
+or, with compact layout, COMPACT_COLUMNS where type, dataset and
+parameter are replaced by their ids. Rows of wide layout table are
+serialized from encoded frames (see encoder.encode_df) in the column
+order of WIDE_COLUMNS.
+"""
+import io
+import math
+import struct
+import datetime
+import numpy as np
+import pandas as pd
+
+from .encoder import concat_str, value_strings
+
+DATA_COLUMNS = ('type', 'dataset', 'time', 'location_id', 'parameter', 'value', 'row')
+DATA_KINDS = ('text', 'text', 'timestamp', 'int8', 'text', 'float8', 'text')
+
+COMPACT_COLUMNS = ('type_id', 'dataset_id', 'time', 'location_id', 'parameter_id', 'value', 'row')
+COMPACT_KINDS = ('int2', 'int4', 'timestamp', 'int8', 'int4', 'float8', 'text')
+
+WIDE_COLUMNS = ('type', 'dataset', 'time', 'location_id', 'row', 'value_array')
+
+# Binary COPY timestamps are microseconds from 2000-01-01
+PG_EPOCH = datetime.datetime(2000, 1, 1)
+BINARY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_sql(table, columns=DATA_COLUMNS, copy_format='text'):
+    """
+    Return COPY statement for given table and format (text|binary)
+    """
+    if copy_format not in ('text', 'binary'):
+        raise ValueError('Unknown copy format {}'.format(copy_format))
+    return 'COPY {table} ({columns}) FROM STDIN WITH (FORMAT {format})'.format(table=table, columns=', '.join(columns), format=copy_format)
+
+
+def _text_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, float) and math.isnan(value):
+        return '\\N'
+    return str(value).translate(_TEXT_ESCAPES)
+
+
+def text_buffer(rows):
+    """
+    Serialize rows into COPY text format
+
+    rows : iterable
+           iterable of tuples
+
+    returns io.StringIO positioned to the beginning
+    """
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(map(_text_value, row)))
+        buf.write('\n')
+    buf.seek(0)
+    return buf
+
+
+def _binary_field(value, kind):
+    if value is None or (kind == 'float8' and math.isnan(value)):
+        return struct.pack('!i', -1)
+    if kind == 'text':
+        b = str(value).encode('utf-8')
+        return struct.pack('!i', len(b)) + b
+    if kind == 'timestamp':
+        usecs = (value - PG_EPOCH) // datetime.timedelta(microseconds=1)
+        return struct.pack('!iq', 8, usecs)
+    if kind == 'int8':
+        return struct.pack('!iq', 8, int(value))
+    if kind == 'int4':
+        return struct.pack('!ii', 4, int(value))
+    if kind == 'int2':
+        return struct.pack('!ih', 2, int(value))
+    return struct.pack('!id', 8, float(value))
+
+
+def binary_buffer(rows, kinds=DATA_KINDS):
+    """
+    Serialize rows into COPY binary format
+
+    rows  : iterable
+            iterable of tuples
+    kinds : tuple
+            wire type of each column (text|timestamp|int2|int4|int8|float8)
+
+    returns io.BytesIO positioned to the beginning
+    """
+    buf = io.BytesIO()
+    buf.write(BINARY_SIGNATURE)
+    buf.write(struct.pack('!ii', 0, 0))
+    field_count = struct.pack('!h', len(kinds))
+    for row in rows:
+        buf.write(field_count)
+        for value, kind in zip(row, kinds):
+            buf.write(_binary_field(value, kind))
+    buf.write(struct.pack('!h', -1))
+    buf.seek(0)
+    return buf
+
+
+def _escape_array(arr):
+    for char, escaped in (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r')):
+        if (np.char.find(arr, char) >= 0).any():
+            arr = np.char.replace(arr, char, escaped)
+    return arr
+
+
+def text_buffer_columns(batch):
+    """
+    Serialize long layout batch into COPY text format
+
+    batch : dict
+            long layout batch (see encoder.iter_long)
+
+    returns io.StringIO positioned to the beginning
+    """
+    prefix = '{}\t{}\t'.format(_text_value(batch['type']), _text_value(batch['dataset']))
+    lines = concat_str(prefix, batch['timestr'], '\t',
+                       batch['location_id'].astype(str), '\t',
+                       _escape_array(batch['parameter']), '\t',
+                       value_strings(batch['value'], null='\\N'), '\t',
+                       _escape_array(batch['row']), '\n')
+    return io.StringIO(''.join(lines.tolist()))
+
+
+def _fields(values, kind='text'):
+    """
+    Length prefixed binary fields of array
+
+    returns (pool, offsets, lengths) where pool holds each distinct field once
+    """
+    codes, uniques = pd.factorize(values)
+    fields = [_binary_field(u, kind) for u in uniques]
+    lengths = np.array([len(f) for f in fields], dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    pool = np.frombuffer(b''.join(fields), dtype=np.uint8)
+    return pool, offsets[codes], lengths[codes]
+
+
+def _interleave(segments, n):
+    """
+    Gather variable length byte segments into one buffer
+
+    segments : list
+               list of (pool, offsets, lengths) where offsets and
+               lengths are scalars or arrays of length n
+    n        : int
+               amount of tuples
+
+    returns uint8 array with segments of each tuple in order
+    """
+    bases = np.cumsum([0] + [len(seg[0]) for seg in segments[:-1]])
+    pool = np.concatenate([seg[0] for seg in segments])
+    src = np.stack([np.broadcast_to(seg[1] + base, (n,)) for seg, base in zip(segments, bases)], axis=1).ravel()
+    lengths = np.stack([np.broadcast_to(seg[2], (n,)) for seg in segments], axis=1).ravel()
+    out_start = np.cumsum(lengths) - lengths
+    idx = np.repeat(src - out_start, lengths) + np.arange(int(lengths.sum()))
+    return pool[idx]
+
+
+def binary_buffer_columns(batch, kinds=DATA_KINDS):
+    """
+    Serialize long layout batch into COPY binary format
+
+    batch : dict
+            long layout batch (see encoder.iter_long)
+    kinds : tuple
+            wire type of each column. Only types of type, dataset,
+            parameter and row columns may differ from DATA_KINDS.
+
+    returns io.BytesIO positioned to the beginning
+    """
+    n = len(batch['value'])
+    head = struct.pack('!h', len(kinds)) + _binary_field(batch['type'], kinds[0]) + _binary_field(batch['dataset'], kinds[1])
+
+    fixed = np.empty(n, dtype=[('tlen', '>i4'), ('t', '>i8'), ('llen', '>i4'), ('l', '>i8')])
+    fixed['tlen'] = 8
+    fixed['t'] = (batch['time'] - np.datetime64(PG_EPOCH)).astype('timedelta64[us]').astype(np.int64)
+    fixed['llen'] = 8
+    fixed['l'] = batch['location_id']
+
+    null = np.isnan(batch['value'])
+    value = np.empty(n, dtype=[('len', '>i4'), ('v', '>f8')])
+    value['len'] = np.where(null, -1, 8)
+    value['v'] = batch['value']
+
+    segments = [(np.frombuffer(head, dtype=np.uint8), 0, len(head)),
+                (np.frombuffer(fixed.tobytes(), dtype=np.uint8), np.arange(n) * fixed.itemsize, fixed.itemsize),
+                _fields(batch['parameter'], kinds[4]),
+                (np.frombuffer(value.tobytes(), dtype=np.uint8), np.arange(n) * value.itemsize, np.where(null, 4, value.itemsize)),
+                _fields(batch['row'], kinds[6])]
+
+    buf = io.BytesIO()
+    buf.write(BINARY_SIGNATURE)
+    buf.write(struct.pack('!ii', 0, 0))
+    buf.write(_interleave(segments, n).tobytes())
+    buf.write(struct.pack('!h', -1))
+    buf.seek(0)
+    return buf
+
+
+def text_buffer_wide(encoded, values):
+    """
+    Serialize encoded frame into COPY text format of wide layout table
+
+    encoded : dict
+              encoded frame (see encoder.encode_df)
+    values  : np.array
+              (n, p) float array with columns in order of dataset header
+
+    returns io.StringIO positioned to the beginning
+    """
+    cells = value_strings(values.ravel(), null='NULL').reshape(values.shape)
+    arrays = np.array(['{' + ','.join(row) + '}' for row in cells.tolist()], dtype=str)
+    prefix = '{}\t{}\t'.format(_text_value(encoded['type']), _text_value(encoded['dataset']))
+    lines = concat_str(prefix, encoded['timestr'], '\t',
+                       encoded['location_id'].astype(str), '\t',
+                       _escape_array(encoded['row']), '\t',
+                       arrays, '\n')
+    return io.StringIO(''.join(lines.tolist()))
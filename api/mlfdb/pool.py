@@ -0,0 +1,164 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import psycopg2
+import psycopg2.extensions
+import logging
+import threading
+import contextlib
+import time
+
+
+class PoolError(psycopg2.Error):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of PostgreSQL connections
+
+    params       : dict
+                   psycopg2.connect keyword arguments
+    minconn      : int
+                   amount of connections kept open
+    maxconn      : int
+                   maximum amount of open connections
+    idle_timeout : int
+                   seconds after which idle connections above minconn are closed
+    check_after  : int
+                   connections idle longer than this (seconds) are checked
+                   with a query before they are handed out
+    """
+
+    def __init__(self, params, minconn=1, maxconn=4, idle_timeout=300, check_after=30):
+        if minconn > maxconn:
+            raise ValueError('minconn {} is larger than maxconn {}'.format(minconn, maxconn))
+
+        self.params = params
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+
+        self._idle = [] # <-- (connection, last used), most recently used last
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        for i in range(minconn):
+            self._idle.append((self._new(), time.time()))
+            self._size += 1
+
+    def _new(self):
+        logging.debug('Opening new database connection...')
+        return psycopg2.connect(**self.params)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.time() - last_used < self.check_after:
+            return True
+        try:
+            with conn.cursor() as curs:
+                curs.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error as error:
+            logging.warning('Discarding broken connection: {}'.format(error))
+            return False
+
+    def _expire_idle(self):
+        """ Close connections idle longer than idle_timeout. Must be called with lock held. """
+        now = time.time()
+        while len(self._idle) > 0 and self._size > self.minconn and now - self._idle[0][1] > self.idle_timeout:
+            conn, last_used = self._idle.pop(0)
+            self._discard(conn)
+            self._size -= 1
+
+    def getconn(self, timeout=None):
+        """
+        Borrow connection from the pool. Blocks until connection is
+        available or timeout (seconds) is reached.
+
+        return psycopg2 connection
+        """
+        conn = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError('Connection pool is closed')
+                self._expire_idle()
+                if len(self._idle) > 0:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+                if not self._cond.wait(timeout):
+                    raise PoolError('No connection available in {} seconds'.format(timeout))
+
+        try:
+            if conn is None:
+                conn = self._new()
+            elif not self._healthy(conn, last_used):
+                self._discard(conn)
+                conn = self._new()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def putconn(self, conn, close=False):
+        """
+        Return connection to the pool. Connection is closed if close is
+        True, pool is closed or connection is broken.
+        """
+        if not close and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+
+        with self._cond:
+            if close or conn.closed or self._closed:
+                self._discard(conn)
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager borrowing a connection from the pool
+        """
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        """
+        Close all idle connections and mark pool closed. Borrowed
+        connections are closed when they are returned.
+        """
+        with self._cond:
+            self._closed = True
+            for conn, last_used in self._idle:
+                self._discard(conn)
+                self._size -= 1
+            self._idle = []
+            self._cond.notify_all()
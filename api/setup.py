@@ -21,5 +21,11 @@ setup(name='mlfdb',
           'numpy',
           'pandas'
       ],
+      extras_require={
+          'async': ['asyncpg'],
+          'export': ['pyarrow'],
+          'gcs': ['google-cloud-storage'],
+          'test': ['pytest']
+      },
       include_package_data=True,
       zip_safe=False)
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+# Tests import the package from the source tree (api/mlfdb)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
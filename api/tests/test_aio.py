@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import contextlib
+import numpy as np
+import pandas as pd
+import pytest
+
+from mlfdb import aio, encoder, mlfdb, pgcopy
+
+
+class Recorder(object):
+    """
+    Connection and cursor of both clients recording statements. Queries
+    are answered with rows returned by answer(sql).
+    """
+
+    def __init__(self, answer=lambda sql: []):
+        self.answer = answer
+        self.queries = []
+        self.copies = []
+
+    # psycopg2 connection and cursor
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def cursor(self):
+        return self
+
+    def copy_expert(self, sql, buf):
+        data = buf.getvalue()
+        self.copies.append((sql, data.encode('utf-8') if isinstance(data, str) else data))
+
+    # asyncpg pool and connection
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield self
+
+    @contextlib.asynccontextmanager
+    async def _transaction(self):
+        yield
+
+    def transaction(self):
+        return self._transaction()
+
+    async def execute(self, sql):
+        self.queries.append(sql)
+        return 'OK'
+
+    async def fetch(self, sql):
+        self.queries.append(sql)
+        return self.answer(sql)
+
+    async def copy_to_table(self, table, source, columns, schema_name, format):
+        self.copies.append(((schema_name, table, tuple(columns), format), source.read()))
+
+
+def prepare(db):
+    """
+    Answer schema checks of db: long layout without catalog, partitions or wide tables
+    """
+    db.layout = 'long'
+    db._catalog_tables = False
+    db._catalog_filled = False
+    db._partitions_function = False
+    db._wide_tables = False
+
+
+@pytest.fixture
+def clients(tmp_path, monkeypatch):
+    monkeypatch.setattr(aio, 'asyncpg', object())
+    config = str(tmp_path / 'mlfdbconfig')
+    sync, client = mlfdb.mlfdb(config_filename=config), aio.aiomlfdb(config_filename=config)
+    prepare(sync)
+    prepare(client.db)
+    return sync, client
+
+
+def batches():
+    df = pd.DataFrame({'time': [1514764800, 1514768400, 1514772000], 'loc_id': [1, 2, 1], 'lon': 25.0, 'lat': 60.0,
+                       'a': [1.0, np.nan, 3.0], 'b': [4.0, 5.0, 6.0]})
+    return list(encoder.iter_long(encoder.encode_df('feature', df, 'ds'), batch_size=4))
+
+
+@pytest.mark.parametrize('copy_format', ['text', 'binary'])
+def test_copy_long_sends_sync_buffers(clients, monkeypatch, copy_format):
+    sync, client = clients
+    expected = Recorder()
+    monkeypatch.setattr(sync, '_connection', lambda: expected)
+    assert sync.copy_long(batches(), copy_format=copy_format) == 6
+
+    copied = Recorder()
+    client.pool = copied
+    assert asyncio.run(client.copy_long(batches(), copy_format=copy_format)) == 6
+
+    columns = tuple(sync._columns()[0])
+    assert [sql for sql, _ in expected.copies] == [pgcopy.copy_sql('traindata.data', columns, copy_format)] * 2
+    assert [target for target, _ in copied.copies] == [('traindata', 'data', columns, copy_format)] * 2
+    assert [data for _, data in copied.copies] == [data for _, data in expected.copies]
+
+
+def test_get_rows_sends_sync_queries(clients, monkeypatch):
+    sync, client = clients
+    rows = lambda sql: [(1, 1514764800, 25.0, 60.0, 1.0, None)] if 'crosstab' in sql else []
+    queries = []
+    monkeypatch.setattr(sync, '_query', lambda sql, params=None: queries.append(sql) or rows(sql))
+    start, end = datetime.datetime(2018, 1, 1), datetime.datetime(2018, 1, 3)
+    expected = sync.get_rows('ds', start, end, parameters=['a', 'b'], chunk_size=1)
+
+    recorder = Recorder(rows)
+    client.pool = recorder
+    result = asyncio.run(client.get_rows('ds', start, end, parameters=['a', 'b'], chunk_size=1))
+
+    assert len(queries) == 2
+    assert recorder.queries == queries
+    for got, want in zip(result, expected):
+        np.testing.assert_array_equal(got, want)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from mlfdb import cache
+from mlfdb.cache import NameCache, ResultCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Manually advanced time.monotonic of cache module
+    """
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def result(n=10):
+    metadata = np.arange(n * 4, dtype=np.float64).reshape(n, 4)
+    return metadata, ['a', 'b'], np.ones((n, 2))
+
+
+def test_name_cache_get_many():
+    names = NameCache()
+    names.put_many({'a': 1, 'b': 2})
+    found, missing = names.get_many(['a', 'c', 'b'])
+    assert found == {'a': 1, 'b': 2}
+    assert missing == ['c']
+    assert names.stats() == {'hits': 2, 'misses': 1, 'entries': 2}
+
+
+def test_name_cache_lru():
+    names = NameCache(max_entries=2)
+    names.put_many({'a': 1, 'b': 2})
+    names.get_many(['a'])
+    names.put_many({'c': 3})
+
+    # b was used least recently
+    found, missing = names.get_many(['a', 'b', 'c'])
+    assert found == {'a': 1, 'c': 3}
+    assert missing == ['b']
+    assert names.stats()['entries'] == 2
+
+
+def test_name_cache_ttl(clock):
+    names = NameCache(ttl=60)
+    names.put_many({'a': 1})
+    clock[0] += 30
+    names.put_many({'b': 2})
+
+    clock[0] += 40
+    found, missing = names.get_many(['a', 'b'])
+    assert found == {'b': 2}
+    assert missing == ['a']
+
+    # Expired entry is dropped and can be stored again
+    assert names.stats()['entries'] == 1
+    names.put_many({'a': 5})
+    assert names.get_many(['a']) == ({'a': 5}, [])
+
+
+def test_name_cache_clear():
+    names = NameCache()
+    names.put_many({'a': 1})
+    names.clear()
+    assert names.get_many(['a']) == ({}, ['a'])
+
+
+def test_result_cache_round_trip(tmp_path):
+    results = ResultCache(str(tmp_path))
+    key = results.key('ds', 'feature', ['a', 'b'], 1)
+    assert results.get(key) is None
+
+    results.put(key, result())
+    metadata, parameters, data = results.get(key)
+    np.testing.assert_array_equal(metadata, result()[0])
+    assert parameters == ['a', 'b']
+    np.testing.assert_array_equal(data, result()[2])
+    assert results.stats()['hits'] == 1
+    assert results.stats()['misses'] == 1
+
+
+def test_result_cache_pandas(tmp_path):
+    results = ResultCache(str(tmp_path))
+    df = pd.DataFrame({'loc_id': [1, 2], 'time': [10, 20], 'a': [0.5, np.nan]})
+    results.put('k', df)
+    pd.testing.assert_frame_equal(results.get('k'), df)
+
+
+def test_result_cache_key():
+    results = ResultCache.__new__(ResultCache)
+    assert results.key('ds', 1) == results.key('ds', 1)
+    assert results.key('ds', 1) != results.key('ds', 2)
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    results = ResultCache(str(tmp_path))
+    for i, key in enumerate(['old', 'used', 'new']):
+        results.put(key, result())
+        os.utime(results._path(key), (1000 + i, 1000 + i))
+    size = os.path.getsize(results._path('old'))
+
+    # Reading refreshes modification time
+    assert results.get('used') is not None
+
+    results.max_bytes = 2 * size
+    results.evict()
+    assert not os.path.exists(results._path('old'))
+    assert os.path.exists(results._path('used'))
+    assert os.path.exists(results._path('new'))
+
+    results.max_bytes = size
+    results.evict()
+    assert results.stats()['entries'] == 1
+    assert os.path.exists(results._path('used'))
+
+
+def test_result_cache_discards_broken_entry(tmp_path):
+    results = ResultCache(str(tmp_path))
+    with open(results._path('broken'), 'wb') as f:
+        f.write(b'not a zip file')
+    assert results.get('broken') is None
+    assert not os.path.exists(results._path('broken'))
+
+
+def test_result_cache_removes_stale_tmp_files(tmp_path):
+    results = ResultCache(str(tmp_path))
+    stale = str(tmp_path / '.dead.1.tmp.npz')
+    fresh = str(tmp_path / '.live.2.tmp.npz')
+    for path in (stale, fresh):
+        with open(path, 'wb') as f:
+            f.write(b'partial')
+    os.utime(stale, (1000, 1000))
+
+    results.evict()
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
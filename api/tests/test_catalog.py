@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import datetime
+import numpy as np
+import pandas as pd
+
+from mlfdb import encoder
+from mlfdb.catalog import WriteStats, timestamp
+
+
+def encoded():
+    df = pd.DataFrame({'time': [1514764800, 1514768400, 1514772000], 'loc_id': [1, 2, 1], 'lon': 25.0, 'lat': 60.0,
+                       'a': [1.0, 2.0, 3.0], 'b': [4.0, np.nan, 6.0]})
+    return encoder.encode_df('feature', df, 'ds')
+
+
+def test_add_encoded():
+    e = encoded()
+    stats = WriteStats()
+    stats.add_encoded(e)
+
+    entry = stats.entries[('ds', 'feature')]
+    assert entry['rows'] == 3
+    assert entry['cells'] == 6
+    assert entry['parameters'] == {'a', 'b'}
+    assert entry['min_time'] == e['time'][0]
+    assert entry['max_time'] == e['time'][2]
+    assert sorted(entry['locations']) == [1, 2]
+    assert entry['locations'][1] == [e['time'][0], e['time'][2]]
+
+
+def test_add_encoded_without_counts():
+    stats = WriteStats()
+    stats.add_encoded(encoded(), counts=False)
+    entry = stats.entries[('ds', 'feature')]
+    assert (entry['rows'], entry['cells']) == (0, 0)
+    assert entry['parameters'] == {'a', 'b'}
+
+
+def test_add_batch_counts_rows_over_batches():
+    e = encoded()
+    stats = WriteStats()
+    # Second row is split between the batches
+    for batch in encoder.iter_long(e, batch_size=3):
+        stats.add_batch(batch)
+
+    entry = stats.entries[('ds', 'feature')]
+    assert entry['rows'] == 3
+    assert entry['cells'] == 6
+    assert entry['locations'][2] == [e['time'][1], e['time'][1]]
+
+
+def test_add_tuples():
+    rows = [('label', 'ds', datetime.datetime(2018, 1, 1, 1), 1, 'a', 1.0, 'r1'),
+            ('label', 'ds', datetime.datetime(2018, 1, 1, 1), 1, 'b', 2.0, 'r1'),
+            ('label', 'ds', datetime.datetime(2018, 1, 1, 2), 3, 'a', 3.0, 'r2'),
+            ('label', 'other', datetime.datetime(2018, 1, 1, 0), 3, 'a', 3.0, 'r3')]
+    stats = WriteStats()
+    assert list(stats.add_tuples(rows)) == rows
+
+    entry = stats.entries[('ds', 'label')]
+    assert (entry['rows'], entry['cells']) == (2, 3)
+    assert timestamp(entry['min_time']) == '2018-01-01 01:00:00'
+    assert timestamp(entry['max_time']) == '2018-01-01 02:00:00'
+    assert stats.entries[('other', 'label')]['rows'] == 1
+
+
+def test_timestamp():
+    assert timestamp(datetime.datetime(2018, 1, 2, 3, 4, 5)) == '2018-01-02 03:04:05'
+    assert timestamp(np.datetime64('2018-01-02T03:04:05')) == '2018-01-02 03:04:05'
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import time
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+
+from mlfdb import encoder
+
+
+@pytest.fixture
+def helsinki(monkeypatch):
+    """
+    Run test in local time zone with DST changes
+    """
+    monkeypatch.setenv('TZ', 'Europe/Helsinki')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def frame(times, locs, **columns):
+    df = pd.DataFrame({'time': times, 'loc_id': locs, 'lon': 25.0, 'lat': 60.0})
+    for name, values in columns.items():
+        df[name] = values
+    return df
+
+
+def test_row_keys():
+    df = frame([1514764800, 1514768400], [3, 4], temperature=[1.5, 2.5], pressure=[1000.0, np.nan])
+    encoded = encoder.encode_df('feature', df, 'ds', row_offset=10)
+
+    # Float columns made iterrows() upcast location ids in old row keys
+    assert encoded['row'].tolist() == ['feature-ds-1514764800.0-3.0-10', 'feature-ds-1514768400.0-4.0-11']
+    assert encoded['parameters'].tolist() == ['temperature', 'pressure']
+    assert encoded['location_id'].tolist() == [3, 4]
+    assert encoded['values'].shape == (2, 2)
+    assert np.isnan(encoded['values'][1, 1])
+
+
+def test_row_keys_integer_frame():
+    df = pd.DataFrame({'time': [1514764800], 'loc_id': [3], 'lon': [25], 'lat': [60], 'count': [7]})
+    encoded = encoder.encode_df('label', df, 'ds')
+    assert encoded['row'].tolist() == ['label-ds-1514764800.0-3-0']
+
+
+def test_columns():
+    df = frame([1514764800], [1], a=[1.0], b=[2.0], c=[3.0])
+    encoded = encoder.encode_df('feature', df, 'ds', columns=['c', 'a'])
+    assert encoded['parameters'].tolist() == ['c', 'a']
+    assert encoded['values'].tolist() == [[3.0, 1.0]]
+
+
+def test_local_time_over_dst(helsinki):
+    # Clocks move forward on 2018-03-25 01:00 UTC and back on 2018-10-28 01:00 UTC
+    epochs = [1521935999, 1521936000, 1521939600, 1540684800, 1540688400, 1540692000]
+    df = frame(epochs, [1] * len(epochs), value=np.arange(len(epochs), dtype=np.float64))
+    encoded = encoder.encode_df('feature', df, 'ds')
+
+    expected = [datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S') for t in epochs]
+    assert encoded['timestr'].tolist() == expected
+    assert expected[1:3] == ['2018-03-25 02:00:00', '2018-03-25 04:00:00']
+    assert expected[3:] == ['2018-10-28 03:00:00', '2018-10-28 03:00:00', '2018-10-28 04:00:00']
+    assert encoded['time'].astype(datetime.datetime).tolist() == [datetime.datetime.fromtimestamp(t) for t in epochs]
+
+    # Row keys use unix time and stay unique when local times repeat
+    assert len(set(encoded['row'].tolist())) == len(epochs)
+    assert encoded['row'][4] == 'feature-ds-1540688400.0-1.0-4'
+
+
+def test_iter_long():
+    df = frame([1514764800, 1514768400], [1, 2], a=[1.0, 2.0], b=[3.0, 4.0])
+    encoded = encoder.encode_df('feature', df, 'ds')
+    batches = list(encoder.iter_long(encoded, batch_size=3))
+
+    assert [len(batch['value']) for batch in batches] == [3, 1]
+    long = encoder.to_long(encoded)
+    assert long['parameter'].tolist() == ['a', 'b', 'a', 'b']
+    assert long['value'].tolist() == [1.0, 3.0, 2.0, 4.0]
+    assert long['location_id'].tolist() == [1, 1, 2, 2]
+    assert np.concatenate([batch['row'] for batch in batches]).tolist() == long['row'].tolist()
+
+
+def test_value_strings():
+    assert encoder.value_strings(np.array([1.5, np.nan]), null='\\N').tolist() == ['1.5', '\\N']
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+
+from mlfdb import encoder, mlfdb
+
+
+@pytest.fixture
+def client(tmp_path):
+    """
+    Client with long layout and without catalog tables. Database
+    access is replaced per test.
+    """
+    a = mlfdb.mlfdb(config_filename=str(tmp_path / 'mlfdbconfig'), layout='long')
+    a._catalog_tables = False
+    return a
+
+
+def test_clean_duplicate_rows_per_partition(client, monkeypatch):
+    partitions = [('traindata.data_2018', "FOR VALUES FROM ('2018-01-01') TO ('2019-01-01')", None),
+                  ('traindata.data_2019', "FOR VALUES FROM ('2019-01-01') TO ('2020-01-01')", None)]
+    monkeypatch.setattr(client, '_query', lambda sql, params=None: partitions)
+    statements, counts = [], [2, 0, 1]
+    monkeypatch.setattr(client, 'execute', lambda sql, params=None: statements.append(sql) or counts.pop(0))
+
+    assert client.clean_duplicate_rows('ds', 'feature', batch_size=2) == 3
+    # Full batch is repeated, then next partition
+    assert [s.split()[2] for s in statements] == ['traindata.data_2018', 'traindata.data_2018', 'traindata.data_2019']
+    assert "a.dataset = 'ds' AND a.type = 'feature'" in statements[0]
+
+
+def test_pivot_sparse_rows(client):
+    loc_ids = np.array([2, 1, 1, 2, 1])
+    times = np.array([10, 20, 10, 10, 20])
+    params = np.array(['b', 'a', 'c', 'a', 'c'], dtype=object)
+    values = np.array([1.0, 2.0, 3.0, 4.0, 5.0])
+    locs, ts, data = client._pivot(loc_ids, times, params, values, ['a', 'b', 'c'])
+
+    # Rows ordered by (location, time), values placed by name
+    assert locs.tolist() == [1, 1, 2]
+    assert ts.tolist() == [10, 20, 10]
+    np.testing.assert_array_equal(data, [[np.nan, np.nan, 3.0],
+                                         [2.0, np.nan, 5.0],
+                                         [4.0, 1.0, np.nan]])
+
+
+def test_pivot_unknown_parameters(client):
+    loc_ids, times = np.array([1, 1]), np.array([10, 10])
+    params = np.array(['a', 'x'], dtype=object)
+    locs, ts, data = client._pivot(loc_ids, times, params, np.array([1.0, 2.0]), ['b', 'a'])
+    assert locs.tolist() == [1]
+    np.testing.assert_array_equal(data, [[np.nan, 1.0]])
+
+
+def test_rows_sql_places_values_by_parameter(client):
+    sql = client._rows_sql('ds', 'feature', ['a', 'b'], datetime.datetime(2018, 1, 1), datetime.datetime(2018, 1, 2))
+    assert "VALUES ('a', 0), ('b', 1)) AS x (id, ordering)" in sql
+    assert "x.ordering" in sql
+    assert "$$SELECT generate_series(0, 1)$$" in sql
+    assert "ct(row_info int[], a float8, b float8)" in sql
+
+
+def test_discover_parameters_scans_dataset_missing_from_catalog(client, monkeypatch):
+    client._catalog_tables = True
+    client._wide_tables = False
+    queries = []
+
+    def query(sql, params=None):
+        queries.append(sql)
+        return [] if 'traindata.parameter ' in sql else [('a',), ('b',)]
+    monkeypatch.setattr(client, '_query', query)
+
+    parameters = []
+    client._discover_parameters('ds', 'feature', parameters)
+    assert parameters == ['a', 'b']
+    assert queries[1] == "SELECT DISTINCT a.parameter FROM traindata.data a WHERE a.dataset = 'ds' AND a.type = 'feature' ORDER BY parameter"
+
+
+def test_delete_batches_walk_id_range(client, monkeypatch):
+    queries, results = [], [(2, 7, 2), (2, 12, 1), (1, 15, 1)]
+    monkeypatch.setattr(client, '_query', lambda sql, params=None: queries.append(sql) or [results.pop(0)])
+
+    assert client._delete_batches('traindata.data', "a.dataset = 'ds'", 2, 'ds') == 4
+    # Each batch continues after the largest id of the previous one
+    for last, sql in zip([0, 7, 12], queries):
+        assert 'a.id > {}'.format(last) in sql
+    assert "ORDER BY a.id LIMIT 2" in queries[0]
+
+
+class Cursor(object):
+    """
+    Connection and cursor recording statements, rowcount is taken from counts by statement prefix
+    """
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.statements = []
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=None):
+        self.statements.append(' '.join(sql.split()))
+        self.rowcount = next((n for prefix, n in self.counts if self.statements[-1].startswith(prefix)), 0)
+
+    def copy_expert(self, sql, buf):
+        self.statements.append(sql)
+
+
+def test_upsert_counts_only_new_rows_in_catalog(client, monkeypatch):
+    client._catalog_tables = True
+    client._seq_column = False
+    cursor = Cursor([('DELETE FROM data_stage a', 0), ('UPDATE traindata.data', 1), ('DELETE FROM data_stage s', 1)])
+    monkeypatch.setattr(client, '_connection', lambda: cursor)
+    df = pd.DataFrame({'time': [1514764800, 1514768400], 'loc_id': [1, 1], 'lon': 25.0, 'lat': 60.0, 'a': [1.0, 2.0]})
+
+    assert client._upsert(encoder.encode_df('feature', df, 'ds'), insert=True) == (1, 1)
+    position = lambda prefix: next(i for i, s in enumerate(cursor.statements) if s.startswith(prefix))
+    catalog = position('INSERT INTO traindata.parameter ')
+    # Rows are marked and counted before the inserted cells reach data table
+    assert position('UPDATE data_stage s SET new_row = true') < catalog < position('INSERT INTO traindata.data (')
+    assert 'count(DISTINCT (time, location_id)) FILTER (WHERE new_row), count(1)' in cursor.statements[catalog]
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import struct
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+
+from mlfdb import encoder, pgcopy
+
+
+def batch():
+    df = pd.DataFrame({'time': [1514764800, 1514768400], 'loc_id': [1, 2], 'lon': 25.0, 'lat': 60.0,
+                       'temperature': [1.5, np.nan], 'weird\tname': [2.0, 3.0]})
+    return encoder.to_long(encoder.encode_df('feature', df, 'ds'))
+
+
+def tuples(batch):
+    times = batch['time'].astype(datetime.datetime).tolist()
+    return [(batch['type'], batch['dataset'], times[i], int(batch['location_id'][i]),
+             str(batch['parameter'][i]), float(batch['value'][i]), str(batch['row'][i]))
+            for i in range(len(batch['value']))]
+
+
+def read_binary(data, kinds):
+    """
+    Parse COPY binary buffer into lists of raw field bytes (None for NULL)
+    """
+    assert data[:11] == pgcopy.BINARY_SIGNATURE
+    assert struct.unpack('!ii', data[11:19]) == (0, 0)
+    pos, rows = 19, []
+    while True:
+        count, = struct.unpack('!h', data[pos:pos + 2])
+        pos += 2
+        if count == -1:
+            break
+        assert count == len(kinds)
+        fields = []
+        for _ in range(count):
+            length, = struct.unpack('!i', data[pos:pos + 4])
+            pos += 4
+            if length == -1:
+                fields.append(None)
+            else:
+                fields.append(data[pos:pos + length])
+                pos += length
+        rows.append(fields)
+    assert pos == len(data)
+    return rows
+
+
+def test_copy_sql():
+    assert pgcopy.copy_sql('s.data', columns=('a', 'b'), copy_format='binary') == 'COPY s.data (a, b) FROM STDIN WITH (FORMAT binary)'
+    with pytest.raises(ValueError):
+        pgcopy.copy_sql('s.data', copy_format='csv')
+
+
+def test_text_buffer():
+    rows = [('feature', 'ds', datetime.datetime(2018, 1, 1, 2), 1, 'a\tb', None, 'x\\y'),
+            ('feature', 'ds', datetime.datetime(2018, 1, 1, 3), 2, 'c', float('nan'), 'line\nbreak')]
+    assert pgcopy.text_buffer(rows).getvalue() == ('feature\tds\t2018-01-01 02:00:00\t1\ta\\tb\t\\N\tx\\\\y\n'
+                                                   'feature\tds\t2018-01-01 03:00:00\t2\tc\t\\N\tline\\nbreak\n')
+
+
+def test_text_buffer_columns_matches_tuples():
+    b = batch()
+    assert pgcopy.text_buffer_columns(b).getvalue() == pgcopy.text_buffer(tuples(b)).getvalue()
+
+
+def test_binary_buffer_columns_matches_tuples():
+    b = batch()
+    assert pgcopy.binary_buffer_columns(b).getvalue() == pgcopy.binary_buffer(tuples(b)).getvalue()
+
+
+def test_binary_fields():
+    b = batch()
+    rows = read_binary(pgcopy.binary_buffer_columns(b).getvalue(), pgcopy.DATA_KINDS)
+
+    assert len(rows) == 4
+    first = rows[0]
+    assert first[0] == b'feature'
+    assert first[1] == b'ds'
+    usecs, = struct.unpack('!q', first[2])
+    assert pgcopy.PG_EPOCH + datetime.timedelta(microseconds=usecs) == b['time'][0].astype(datetime.datetime)
+    assert struct.unpack('!q', first[3]) == (1,)
+    assert first[4] == b'temperature'
+    assert struct.unpack('!d', first[5]) == (1.5,)
+    assert first[6] == b['row'][0].encode('utf-8')
+
+    # NaN is written as NULL
+    assert rows[2][4] == b'temperature'
+    assert rows[2][5] is None
+
+
+def test_binary_compact_kinds():
+    rows = [(1, 2, datetime.datetime(2018, 1, 1), 3, 4, 0.5, 'r')]
+    fields = read_binary(pgcopy.binary_buffer(rows, pgcopy.COMPACT_KINDS).getvalue(), pgcopy.COMPACT_KINDS)[0]
+    assert struct.unpack('!h', fields[0]) == (1,)
+    assert struct.unpack('!i', fields[1]) == (2,)
+    assert struct.unpack('!i', fields[4]) == (4,)
+
+
+def test_text_buffer_wide():
+    df = pd.DataFrame({'time': [1514764800], 'loc_id': [1], 'lon': 25.0, 'lat': 60.0, 'a': [1.5], 'b': [np.nan]})
+    encoded = encoder.encode_df('feature', df, 'ds')
+    line = pgcopy.text_buffer_wide(encoded, encoded['values']).getvalue()
+    assert line == 'feature\tds\t{}\t1\t{}\t{{1.5,NULL}}\n'.format(encoded['timestr'][0], encoded['row'][0])
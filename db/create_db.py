@@ -9,57 +9,375 @@ import itertools
 import numpy as np
 from configparser import ConfigParser
 
-import os,sys,inspect
+import os,sys,inspect,time
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir)
-from api.lib import mlfb
+from api.mlfdb import mlfb
+from api.mlfdb import mlfdb
 
+# Indexes of each index profile. Indexes of default profile are always created.
+DEFAULT_INDEXES = ['row_idx', 'location_id_idx', 'idx_values_uniq']
+INDEX_PROFILES = {'default': DEFAULT_INDEXES,
+                  'covering': DEFAULT_INDEXES + ['data_covering_idx'],
+                  'brin': DEFAULT_INDEXES + ['data_time_brin'],
+                  'full': DEFAULT_INDEXES + ['data_covering_idx', 'data_time_brin']}
 
-def main():
+
+def create_catalog(a, fill=False):
     """
-    Main python script for creating the classification model.
+    Create catalog tables maintained by the api. If fill is True,
+    catalogs are filled from existing data.
     """
-    config = '{parentdir}/api/cnf/database.ini'.format(parentdir=parentdir)
+    # Per dataset write version, used to invalidate cached results
+    sql = """
+    CREATE TABLE IF NOT EXISTS {schema}.dataset_version
+    (
+      dataset character varying(254) PRIMARY KEY,
+      version bigint NOT NULL DEFAULT 0
+    )""".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
 
-    logging.info('Using configuration file: {}'.format(config))
-    a = mlfb.mlfb(config_filename=config)
+    # Parameters of each dataset and type, used instead of scanning data
+    sql = """
+    CREATE TABLE IF NOT EXISTS {schema}.parameter
+    (
+      dataset character varying(254),
+      type character varying(254),
+      parameter character varying(254),
+      PRIMARY KEY (dataset, type, parameter)
+    )""".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
 
-    # Create schema
-    parser = ConfigParser()
-    parser.read(config)
-    sql = "CREATE SCHEMA IF NOT EXISTS  {} AUTHORIZATION {}".format(options.schema, parser.items('postgresql')[2][1])
+    # Time span and size of each dataset and type
+    sql = """
+    CREATE TABLE IF NOT EXISTS {schema}.dataset
+    (
+      dataset character varying(254),
+      type character varying(254),
+      min_time TIMESTAMP,
+      max_time TIMESTAMP,
+      row_count bigint NOT NULL DEFAULT 0,
+      cell_count bigint NOT NULL DEFAULT 0,
+      PRIMARY KEY (dataset, type)
+    )""".format(schema=options.schema)
     logging.debug(sql)
     if not options.simulate:
         a.execute(sql)
 
-    # Enable PostGIS
-    if options.create_extension:
-        sql = "CREATE EXTENSION postgis"
-        logging.debug(sql)
-        if not options.simulate:
-            a.execute(sql)
+    # Locations of each dataset and type with their time spans
+    sql = """
+    CREATE TABLE IF NOT EXISTS {schema}.dataset_location
+    (
+      dataset character varying(254),
+      type character varying(254),
+      location_id bigint,
+      min_time TIMESTAMP,
+      max_time TIMESTAMP,
+      PRIMARY KEY (dataset, type, location_id)
+    )""".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
 
-    # Enable table func
-    if options.create_extension:
-        sql = "CREATE EXTENSION tablefunc"
-        logging.debug(sql)
-        if not options.simulate:
-            a.execute(sql)
+    if fill:
+        fill_catalog(a)
 
-    sql = "SET SEARCH_PATH TO '{}, default'".format(options.schema)
+
+def fill_catalog(a):
+    """
+    Fill catalogs from existing data in one transaction and mark the
+    dataset catalog filled. Time spans of the catalog are used to clip
+    reads only after that (see mlfdb._is_catalog_filled).
+    """
+    sql = """
+    INSERT INTO {schema}.parameter (dataset, type, parameter)
+      SELECT DISTINCT dataset, type, parameter FROM {source} ON CONFLICT DO NOTHING;
+    DELETE FROM {schema}.dataset;
+    INSERT INTO {schema}.dataset (dataset, type, min_time, max_time, row_count, cell_count)
+      SELECT dataset, type, min(time), max(time), count(DISTINCT (time, location_id)), count(1)
+      FROM {source} GROUP BY dataset, type;
+    DELETE FROM {schema}.dataset_location;
+    INSERT INTO {schema}.dataset_location (dataset, type, location_id, min_time, max_time)
+      SELECT dataset, type, location_id, min(time), max(time)
+      FROM {source} GROUP BY dataset, type, location_id;
+    INSERT INTO {schema}.dataset_version (dataset, version) VALUES ('', 1) ON CONFLICT DO NOTHING""".format(schema=options.schema, source=data_source_sql())
     logging.debug(sql)
     if not options.simulate:
         a.execute(sql)
 
-    # Drop old tables
-    if options.force:
-        sql = "DROP TABLE IF EXISTS {schema}.data, {schema}.location".format(schema=options.schema)
+
+def create_dictionaries(a):
+    """
+    Create dictionary tables of compact layout mapping type, dataset and
+    parameter names to small integer ids
+    """
+    for kind, id_type in (('type', 'SMALLSERIAL'), ('dataset', 'SERIAL'), ('parameter', 'SERIAL')):
+        sql = """
+        CREATE TABLE IF NOT EXISTS {schema}.{kind}_dict
+        (
+          id {id_type} PRIMARY KEY,
+          name character varying(254) NOT NULL UNIQUE
+        )""".format(schema=options.schema, kind=kind, id_type=id_type)
         logging.debug(sql)
         if not options.simulate:
             a.execute(sql)
 
 
+def name_columns():
+    """
+    Return definitions of type, dataset and parameter columns of data
+    table. With compact layout names are replaced by dictionary ids.
+    """
+    if options.layout == 'compact':
+        return {'type': 'type_id smallint REFERENCES {schema}.type_dict (id)'.format(schema=options.schema),
+                'dataset': 'dataset_id integer REFERENCES {schema}.dataset_dict (id)'.format(schema=options.schema),
+                'parameter': 'parameter_id integer REFERENCES {schema}.parameter_dict (id)'.format(schema=options.schema)}
+    return {'type': 'type character varying(254)',
+            'dataset': 'dataset character varying(254)',
+            'parameter': 'parameter character varying(254)'}
+
+
+def dataset_column():
+    return 'dataset_id' if options.layout == 'compact' else 'dataset'
+
+
+def data_source_sql():
+    """
+    Return data table or, with compact layout, subquery joining names of
+    type, dataset and parameter to it
+    """
+    if options.layout != 'compact':
+        return '{schema}.data'.format(schema=options.schema)
+    return """(SELECT t.name AS type, d.name AS dataset, p.name AS parameter, s.time, s.location_id
+          FROM {schema}.data s
+          LEFT JOIN {schema}.type_dict t ON t.id = s.type_id
+          LEFT JOIN {schema}.dataset_dict d ON d.id = s.dataset_id
+          LEFT JOIN {schema}.parameter_dict p ON p.id = s.parameter_id) src""".format(schema=options.schema)
+
+
+def create_location_index(a):
+    """
+    Create unique index on location name used by location upserts
+    (see mlfdb.add_point_locations). Index is not created if existing
+    names are not unique, duplicates are reported instead.
+    """
+    sql = "SELECT name, count(1) FROM {schema}.location GROUP BY name HAVING count(1) > 1 ORDER BY count(1) DESC, name".format(schema=options.schema)
+    logging.debug(sql)
+    duplicates = [] if options.simulate else a._query(sql)
+    if len(duplicates) > 0:
+        logging.error('Location name index not created, {} names are used by several locations: {}'.format(
+            len(duplicates), ', '.join('{} ({})'.format(name, count) for name, count in duplicates[:20])))
+        return
+
+    sql = "CREATE UNIQUE INDEX IF NOT EXISTS location_name_uniq ON {schema}.location (name)".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+
+def create_wide_tables(a):
+    """
+    Create wide layout table storing one value array per row and
+    parameter headers giving positions of parameters in the arrays
+    """
+    sql = """
+    CREATE TABLE IF NOT EXISTS {schema}.dataset_header
+    (
+      dataset character varying(254),
+      type character varying(254),
+      parameters character varying(254)[] NOT NULL,
+      PRIMARY KEY (dataset, type)
+    )""".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+    sql = """
+    CREATE TABLE IF NOT EXISTS {schema}.data_wide
+    (
+      id SERIAL PRIMARY KEY,
+      type character varying(254),
+      dataset character varying(254),
+      "time" TIMESTAMP NOT NULL,
+      location_id bigint REFERENCES {schema}.location (id) ON DELETE NO ACTION,
+      "row" character varying(254),
+      value_array double precision[] NOT NULL
+    )""".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+    sql = "CREATE UNIQUE INDEX IF NOT EXISTS data_wide_uniq ON {schema}.data_wide (dataset, type, time, location_id)".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+
+def data_table_sql():
+    """
+    Return statement creating natively partitioned data table. Time
+    ranges are partitioned by month and, with dataset partitioning,
+    months further by dataset. Partitioning columns have to be part of
+    the primary key. Column seq numbers inserted and updated rows (see
+    mlfdb.get_changes).
+    """
+    key = 'id, "time", ' + dataset_column() if options.partitioning == 'dataset' else 'id, "time"'
+    return """
+    CREATE SEQUENCE IF NOT EXISTS {schema}.data_seq;
+    CREATE TABLE {schema}.data
+    (
+      id SERIAL,
+      {type},
+      {dataset},
+      "time" TIMESTAMP NOT NULL,
+      location_id bigint REFERENCES {schema}.location (id) ON DELETE NO ACTION,
+      {parameter},
+      value double precision,
+      "row" character varying(254),
+      seq bigint DEFAULT nextval('{schema}.data_seq'),
+      PRIMARY KEY ({key})
+    )
+    PARTITION BY RANGE ("time")
+    TABLESPACE pg_default;
+    """.format(schema=options.schema, key=key, **name_columns())
+
+
+def native_partition_function_sql():
+    """
+    Return statement creating function which creates monthly partitions
+    (and dataset sub-partitions) of natively partitioned data table for
+    given time range. Partitions are named data_YY_MM and
+    data_YY_MM_<dataset>_<hash> like the inherited tables of trigger
+    partitioning. Dataset names are shortened and lowercased in
+    partition names, so a hash of the full name keeps them unique.
+    With compact layout dataset sub-partitions hold the dictionary id of
+    the dataset, which is added to the dictionary if missing.
+    """
+    if options.partitioning == 'dataset':
+        month_sql = "'CREATE TABLE IF NOT EXISTS {schema}.%I PARTITION OF {schema}.data FOR VALUES FROM (%L) TO (%L) PARTITION BY LIST ({dataset_column})'"
+        sub_sql = """
+          -- Rows of datasets without own partition
+          EXECUTE format('CREATE TABLE IF NOT EXISTS {schema}.%I PARTITION OF {schema}.%I DEFAULT', table_name || '_default', table_name);"""
+        dataset_sql = """
+        -- Migrated months are not sub-partitioned
+        IF dataset_name IS NOT NULL AND (SELECT relkind FROM pg_class WHERE oid = to_regclass('{schema}.' || table_name)) = 'p' THEN
+          sub_name := table_name || '_' || left(regexp_replace(lower(dataset_name), '[^a-z0-9_]', '_', 'g'), 42) || '_' || left(md5(dataset_name), 8);
+          IF to_regclass('{schema}.' || sub_name) IS NULL THEN
+            PERFORM pg_advisory_xact_lock(hashtext('{schema}.' || sub_name));
+            EXECUTE format('CREATE TABLE IF NOT EXISTS {schema}.%I PARTITION OF {schema}.%I FOR VALUES IN (%L)', sub_name, table_name, {dataset_key});
+            created := created + 1;
+          END IF;
+        END IF;"""
+    else:
+        month_sql = "'CREATE TABLE IF NOT EXISTS {schema}.%I PARTITION OF {schema}.data FOR VALUES FROM (%L) TO (%L)'"
+        sub_sql = ''
+        dataset_sql = ''
+
+    if options.layout == 'compact':
+        dataset_key = 'dataset_id'
+        dataset_sql = dataset_sql.replace("""
+            PERFORM pg_advisory_xact_lock""", """
+            INSERT INTO {schema}.dataset_dict (name) VALUES (dataset_name) ON CONFLICT (name) DO NOTHING;
+            SELECT id INTO dataset_id FROM {schema}.dataset_dict WHERE name = dataset_name;
+            PERFORM pg_advisory_xact_lock""")
+    else:
+        dataset_key = 'dataset_name'
+
+    return """
+    CREATE OR REPLACE FUNCTION {schema}.create_partitions(IN start_time timestamp,
+    IN end_time timestamp, IN dataset_name text DEFAULT NULL)
+    RETURNS integer AS
+    $BODY$
+    DECLARE
+      from_time timestamp := date_trunc('month', start_time);
+      table_name text;
+      sub_name text;
+      dataset_id integer;
+      created integer := 0;
+    BEGIN
+      WHILE from_time <= end_time LOOP
+        table_name := 'data' || TO_CHAR(from_time, '_YY_MM');
+        IF to_regclass('{schema}.' || table_name) IS NULL THEN
+          -- Prevent two transactions creating the same partition
+          PERFORM pg_advisory_xact_lock(hashtext('{schema}.' || table_name));
+          EXECUTE format({month_sql}, table_name, from_time, from_time + '1 months'::interval);{sub_sql}
+          created := created + 1;
+        END IF;{dataset_sql}
+        from_time := from_time + '1 months'::interval;
+      END LOOP;
+      RETURN created;
+    END
+    $BODY$
+      LANGUAGE PLpgSQL
+      VOLATILE;
+    """.replace('{month_sql}', month_sql).replace('{sub_sql}', sub_sql).replace('{dataset_sql}', dataset_sql).replace('{dataset_key}', dataset_key).replace('{dataset_column}', dataset_column()).replace('{schema}', options.schema)
+
+
+def trigger_partition_function_sql():
+    """
+    Return statement creating create_partitions function for trigger
+    partitioned data table. Creating partitions in advance avoids the
+    exception path of the insert trigger.
+    """
+    return """
+    CREATE OR REPLACE FUNCTION {schema}.create_partitions(IN start_time timestamp,
+    IN end_time timestamp, IN dataset_name text DEFAULT NULL)
+    RETURNS integer AS
+    $BODY$
+    DECLARE
+      from_time timestamp := date_trunc('month', start_time);
+      created integer := 0;
+    BEGIN
+      WHILE from_time <= end_time LOOP
+        IF to_regclass('{schema}.data' || TO_CHAR(from_time, '_YY_MM')) IS NULL THEN
+          PERFORM pg_advisory_xact_lock('{schema}.data'::regclass::oid::integer);
+          PERFORM create_partition('{schema}.data', from_time);
+          created := created + 1;
+        END IF;
+        from_time := from_time + '1 months'::interval;
+      END LOOP;
+      RETURN created;
+    END
+    $BODY$
+      LANGUAGE PLpgSQL
+      VOLATILE;
+    """.format(schema=options.schema)
+
+
+def create_trigger_partitioned_data(a):
+    """
+    Create data table partitioned to inherited tables by insert trigger
+    """
+    # Create data table
+    sql = """
+    CREATE SEQUENCE IF NOT EXISTS {schema}.data_seq;
+    CREATE TABLE {schema}.data
+    (
+      id SERIAL PRIMARY KEY,
+      {type},
+      {dataset},
+      "time" TIMESTAMP,
+      location_id bigint REFERENCES {schema}.location (id) ON DELETE NO ACTION,
+      {parameter},
+      value double precision,
+      "row" character varying(254),
+      seq bigint DEFAULT nextval('{schema}.data_seq')
+    )
+    WITH (
+      OIDS = FALSE
+    )
+    TABLESPACE pg_default;
+    """.format(schema=options.schema, **name_columns())
+
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
     # Create partition functions
     sql = """
     CREATE OR REPLACE FUNCTION create_partition(IN base_name text,
@@ -121,6 +439,11 @@ def main():
     $$
     LANGUAGE plpgsql;""".format(schema=options.schema)
 
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+    sql = trigger_partition_function_sql()
     logging.debug(sql)
     if not options.simulate:
         a.execute(sql)
@@ -135,6 +458,441 @@ def main():
     if not options.simulate:
         a.execute(sql)
 
+
+def index_definitions():
+    """
+    Return definitions (without name and table) of indexes used in
+    index profiles
+
+    data_covering_idx : b-tree matching the get_rows filter which holds
+                        the fetched columns, so rows are read with
+                        index-only scans once the visibility map is set
+    data_time_brin    : BRIN of time ranges. Rows are inserted roughly in
+                        time order, so block ranges are tight and the
+                        index stays small even for huge partitions
+    """
+    if options.layout == 'compact':
+        key, covering = 'type_id, dataset_id, time, location_id, parameter_id', '(dataset_id, type_id, time) INCLUDE (location_id, parameter_id, value)'
+    else:
+        key, covering = 'type, dataset, time, location_id, parameter', '(dataset, type, time) INCLUDE (location_id, parameter, value)'
+    return {'row_idx': 'INDEX {name} ON {table} (row)',
+            'location_id_idx': 'INDEX {name} ON {table} (location_id)',
+            'idx_values_uniq': 'UNIQUE INDEX {name} ON {table} (' + key + ')',
+            'data_covering_idx': 'INDEX {name} ON {table} ' + covering,
+            'data_time_brin': 'INDEX {name} ON {table} USING brin (time) WITH (pages_per_range = 32)'}
+
+
+def create_data_indexes(a):
+    """
+    Create indexes of index profile given with --index_profile to new data table
+    """
+    definitions = index_definitions()
+    for name in INDEX_PROFILES[options.index_profile]:
+        sql = "CREATE " + definitions[name].format(name=name, table='{schema}.data'.format(schema=options.schema))
+        logging.debug(sql)
+        if not options.simulate:
+            a.execute(sql)
+
+    sql = "CREATE INDEX data_seq_idx ON {schema}.data (seq)".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+
+def add_change_sequence(a):
+    """
+    Add seq column numbering inserted and updated rows to existing data
+    table (see mlfdb.get_changes). Existing rows are left unnumbered.
+    Column and default cascade to partitions and inherited month tables,
+    index is created to inherited month tables separately.
+    """
+    sql = """
+    CREATE SEQUENCE IF NOT EXISTS {schema}.data_seq;
+    ALTER TABLE {schema}.data ADD COLUMN IF NOT EXISTS seq bigint;
+    ALTER TABLE {schema}.data ALTER COLUMN seq SET DEFAULT nextval('{schema}.data_seq');
+    CREATE INDEX IF NOT EXISTS data_seq_idx ON {schema}.data (seq)""".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+    sql = "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent WHERE p.oid = '{schema}.data'::regclass AND p.relkind = 'r' ORDER BY c.relname".format(schema=options.schema)
+    children = [] if options.simulate else [row[0] for row in a._query(sql)]
+    for child in children:
+        sql = "CREATE INDEX IF NOT EXISTS {child}_data_seq_idx ON {schema}.{child} (seq)".format(schema=options.schema, child=child)
+        logging.debug(sql)
+        a.execute(sql)
+
+
+def detect_layout(a):
+    """
+    Set options.layout from columns of existing data table
+    """
+    sql = "SELECT count(1) FROM information_schema.columns WHERE table_schema='{schema}' AND table_name='data' AND column_name='dataset_id'".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        options.layout = 'compact' if a._query(sql)[0][0] > 0 else 'long'
+
+
+def apply_index_profile(a, profile):
+    """
+    Create missing indexes of profile to existing data table and drop
+    optional indexes not in the profile. Indexes of natively partitioned
+    table are created on the parent and cascade to partitions. Inherited
+    month tables of trigger partitioning get own indexes named
+    <month table>_<index>.
+    """
+    sql = "SELECT relkind FROM pg_class WHERE oid = '{schema}.data'::regclass".format(schema=options.schema)
+    native = options.simulate or a._query(sql)[0][0] == 'p'
+
+    children = []
+    if not native:
+        sql = "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = '{schema}.data'::regclass ORDER BY c.relname".format(schema=options.schema)
+        children = [row[0] for row in a._query(sql)]
+
+    definitions = index_definitions()
+    for name in definitions:
+        if name in DEFAULT_INDEXES:
+            # Inherited tables got default indexes when they were created
+            tables = [('data', name)]
+        else:
+            tables = [('data', name)] + [(child, '{}_{}'.format(child, name)) for child in children]
+        for table, index in tables:
+            if name in INDEX_PROFILES[profile]:
+                sql = "CREATE " + definitions[name].replace('INDEX {name}', 'INDEX IF NOT EXISTS {name}').format(
+                    name=index, table='{schema}.{table}'.format(schema=options.schema, table=table))
+            else:
+                sql = "DROP INDEX IF EXISTS {schema}.{index}".format(schema=options.schema, index=index)
+            logging.debug(sql)
+            if not options.simulate:
+                start = time.time()
+                a.execute(sql)
+                if sql.startswith('CREATE'):
+                    logging.info('{} on {} ready in {:.1f}s'.format(name, table, time.time() - start))
+
+    sql = "ANALYZE {schema}.data".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+
+def index_sizes(a):
+    """
+    Return sizes of profile indexes and all indexes of data table
+    including partitions
+
+    returns dict {index name: bytes} with key 'total' for all indexes
+    """
+    sizes = {}
+    for name in index_definitions():
+        sql = """
+        WITH RECURSIVE tree AS (
+          SELECT c.oid FROM pg_class c
+          WHERE c.relnamespace = '{schema}'::regnamespace AND (c.relname = '{name}' OR c.relname LIKE '%\\_{name}')
+          UNION
+          SELECT i.inhrelid FROM pg_inherits i JOIN tree ON i.inhparent = tree.oid)
+        SELECT coalesce(sum(pg_relation_size(oid)), 0) FROM tree""".format(schema=options.schema, name=name)
+        sizes[name] = int(a._query(sql)[0][0])
+
+    sql = """
+    WITH RECURSIVE tree AS (
+      SELECT '{schema}.data'::regclass AS oid
+      UNION ALL
+      SELECT i.inhrelid::regclass FROM pg_inherits i JOIN tree ON i.inhparent = tree.oid)
+    SELECT coalesce(sum(pg_indexes_size(oid)), 0) FROM tree""".format(schema=options.schema)
+    sizes['total'] = int(a._query(sql)[0][0])
+    return sizes
+
+
+def index_report(a, config):
+    """
+    Apply each index profile in turn and report index sizes and
+    measured get_rows latency. The profile given with --index_profile
+    is applied last and left in place.
+    """
+    starttime = dt.datetime.strptime(options.starttime, '%Y%m%d%H%M')
+    endtime = dt.datetime.strptime(options.endtime, '%Y%m%d%H%M')
+    profiles = [p for p in options.report_profiles if p != options.index_profile] + [options.index_profile]
+
+    results = []
+    with mlfdb.mlfdb(config_filename=config, schema=options.schema) as db:
+        for profile in profiles:
+            logging.info('Applying index profile {}...'.format(profile))
+            apply_index_profile(a, profile)
+            sizes = index_sizes(a)
+
+            # First round warms up caches
+            db.get_rows(options.dataset, starttime, endtime, rowtype=options.rowtype, use_cache=False)
+            start = time.time()
+            for i in range(options.repeat):
+                metadata, header, data = db.get_rows(options.dataset, starttime, endtime, rowtype=options.rowtype, use_cache=False)
+            elapsed = (time.time() - start) / options.repeat
+            results.append((profile, sizes, len(data), elapsed))
+
+    optional = [name for name in index_definitions() if name not in DEFAULT_INDEXES]
+    print('{:<9} | {:>12} | {} | {:>8} | {:>9}'.format('profile', 'indexes MB', ' | '.join('{:>17}'.format(name + ' MB') for name in optional), 'rows', 'get_rows'))
+    for profile, sizes, rows, elapsed in results:
+        print('{:<9} | {:12.1f} | {} | {:8} | {:8.3f}s'.format(profile, sizes['total'] / 1024**2,
+                                                               ' | '.join('{:17.1f}'.format(sizes[name] / 1024**2) for name in optional),
+                                                               rows, elapsed))
+
+
+def migrate_to_native(a):
+    """
+    Move trigger partitioned data table to native partitioning. Inherited
+    month tables are detached and attached as partitions of the new data
+    table in one transaction. Their CHECK constraints match the partition
+    bounds, so attaching does not need to validate rows.
+    """
+    if options.partitioning == 'dataset' and options.layout == 'compact':
+        parent_partitions = """SELECT {schema}.create_partitions(min(a.time), max(a.time), d.name)
+      FROM ONLY {schema}.data_inherited a JOIN {schema}.dataset_dict d ON d.id = a.dataset_id GROUP BY d.name;"""
+    elif options.partitioning == 'dataset':
+        parent_partitions = "SELECT {schema}.create_partitions(min(time), max(time), dataset) FROM ONLY {schema}.data_inherited GROUP BY dataset;"
+    else:
+        parent_partitions = "SELECT {schema}.create_partitions(min(time), max(time)) FROM ONLY {schema}.data_inherited HAVING count(1) > 0;"
+
+    sql = native_partition_function_sql()
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+    sql = """
+    DROP TRIGGER IF EXISTS data_insert ON {schema}.data;
+    DROP INDEX IF EXISTS {schema}.row_idx, {schema}.location_id_idx, {schema}.idx_values_uniq, {schema}.data_seq_idx;
+    ALTER TABLE {schema}.data RENAME TO data_inherited;
+    ALTER SEQUENCE {schema}.data_id_seq RENAME TO data_inherited_id_seq;
+    -- Partitions need the same columns as the new table
+    ALTER TABLE {schema}.data_inherited ADD COLUMN IF NOT EXISTS seq bigint;
+    {create_table}
+    SELECT setval('{schema}.data_id_seq', (SELECT last_value FROM {schema}.data_inherited_id_seq));
+
+    DO $migrate$
+    DECLARE
+      child record;
+      pkey text;
+      from_time timestamp;
+    BEGIN
+      FOR child IN SELECT c.oid::regclass AS name, c.relname
+                   FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                   WHERE i.inhparent = '{schema}.data_inherited'::regclass
+      LOOP
+        RAISE NOTICE 'Attaching %', child.name;
+        EXECUTE format('ALTER TABLE %s NO INHERIT {schema}.data_inherited', child.name);
+        EXECUTE format('ALTER TABLE %s ALTER COLUMN id SET DEFAULT nextval(%L)', child.name, '{schema}.data_id_seq');
+        EXECUTE format('ALTER TABLE %s ALTER COLUMN "time" SET NOT NULL', child.name);
+
+        -- Partitions can not have own primary key
+        SELECT conname INTO pkey FROM pg_constraint WHERE conrelid = child.name AND contype = 'p';
+        IF pkey IS NOT NULL THEN
+          EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', child.name, pkey);
+        END IF;
+
+        from_time := to_timestamp(right(child.relname, 5), 'YY_MM')::timestamp;
+        EXECUTE format('ALTER TABLE {schema}.data ATTACH PARTITION %s FOR VALUES FROM (%L) TO (%L)',
+                       child.name, from_time, from_time + '1 months'::interval);
+      END LOOP;
+    END
+    $migrate$;
+
+    -- Rows stored in the parent itself (should not exist), with own sub-partition for each dataset
+    {parent_partitions}
+    INSERT INTO {schema}.data SELECT * FROM ONLY {schema}.data_inherited;
+    DROP TABLE {schema}.data_inherited;
+    """.format(schema=options.schema, create_table=data_table_sql().strip(),
+               parent_partitions=parent_partitions.format(schema=options.schema))
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+    create_data_indexes(a)
+
+
+def migrate_to_compact(a):
+    """
+    Move data table with names to compact layout. Dictionaries are
+    filled from data, old table is renamed to data_long (month tables to
+    long_data_YY_MM) and rows are copied one month table at a time into
+    a new data table with partitioning given by --partitioning. Old
+    table is dropped unless --keep_old is given.
+    """
+    create_dictionaries(a)
+    for kind in ('type', 'dataset', 'parameter'):
+        sql = "INSERT INTO {schema}.{kind}_dict (name) SELECT DISTINCT {kind} FROM {schema}.data WHERE {kind} IS NOT NULL ORDER BY {kind} ON CONFLICT (name) DO NOTHING".format(schema=options.schema, kind=kind)
+        logging.debug(sql)
+        if not options.simulate:
+            a.execute(sql)
+
+    sql = """
+    DROP TRIGGER IF EXISTS data_insert ON {schema}.data;
+    DROP INDEX IF EXISTS {schema}.row_idx, {schema}.location_id_idx, {schema}.idx_values_uniq, {schema}.data_seq_idx;
+    ALTER TABLE {schema}.data RENAME TO data_long;
+    ALTER SEQUENCE {schema}.data_id_seq RENAME TO data_long_id_seq;
+
+    DO $rename$
+    DECLARE
+      child record;
+    BEGIN
+      -- Free names of month tables for the new partitions
+      FOR child IN WITH RECURSIVE tree AS (
+                     SELECT inhrelid FROM pg_inherits WHERE inhparent = '{schema}.data_long'::regclass
+                     UNION ALL
+                     SELECT i.inhrelid FROM pg_inherits i JOIN tree ON i.inhparent = tree.inhrelid)
+                   SELECT c.oid::regclass AS name, c.relname FROM tree JOIN pg_class c ON c.oid = tree.inhrelid
+      LOOP
+        EXECUTE format('ALTER TABLE %s RENAME TO %I', child.name, 'long_' || child.relname);
+      END LOOP;
+    END
+    $rename$;
+    """.format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+    # Indexes of inherited month tables are copied from the parent when
+    # they are created, native partitions get them afterwards
+    if options.partitioning == 'trigger':
+        create_trigger_partitioned_data(a)
+        create_data_indexes(a)
+    else:
+        for sql in (data_table_sql(), native_partition_function_sql()):
+            logging.debug(sql)
+            if not options.simulate:
+                a.execute(sql)
+
+    # Leaf tables of old data table (and the parent itself for rows stored in it)
+    sql = """
+    WITH RECURSIVE tree AS (
+      SELECT inhrelid FROM pg_inherits WHERE inhparent = '{schema}.data_long'::regclass
+      UNION ALL
+      SELECT i.inhrelid FROM pg_inherits i JOIN tree ON i.inhparent = tree.inhrelid)
+    SELECT 'ONLY ' || '{schema}.data_long'::regclass::text
+    UNION ALL
+    SELECT 'ONLY ' || c.oid::regclass::text FROM tree JOIN pg_class c ON c.oid = tree.inhrelid
+    WHERE c.relkind = 'r'""".format(schema=options.schema)
+    logging.debug(sql)
+    sources = ['ONLY {schema}.long_data_YY_MM'.format(schema=options.schema)]
+    if not options.simulate:
+        sources = [row[0] for row in a._query(sql)]
+
+    for i, source in enumerate(sources):
+        sql = """
+        SELECT {schema}.create_partitions(min(time), max(time), dataset) FROM {source} GROUP BY dataset;
+        INSERT INTO {schema}.data (id, type_id, dataset_id, "time", location_id, parameter_id, value, "row")
+          SELECT s.id, t.id, d.id, s.time, s.location_id, p.id, s.value, s.row
+          FROM {source} s
+          LEFT JOIN {schema}.type_dict t ON t.name = s.type
+          LEFT JOIN {schema}.dataset_dict d ON d.name = s.dataset
+          LEFT JOIN {schema}.parameter_dict p ON p.name = s.parameter
+        """.format(schema=options.schema, source=source)
+        logging.debug(sql)
+        if not options.simulate:
+            start = time.time()
+            a.execute(sql)
+            logging.info('{}/{}: copied {} in {:.1f}s'.format(i + 1, len(sources), source, time.time() - start))
+
+    sql = "SELECT setval('{schema}.data_id_seq', (SELECT last_value FROM {schema}.data_long_id_seq))".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+    if options.partitioning != 'trigger':
+        create_data_indexes(a)
+
+    sql = "ANALYZE {schema}.data".format(schema=options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+    if not options.keep_old:
+        sql = "DROP TABLE {schema}.data_long CASCADE".format(schema=options.schema)
+        logging.debug(sql)
+        if not options.simulate:
+            a.execute(sql)
+
+
+def main():
+    """
+    Main python script for creating the classification model.
+    """
+    config = '{parentdir}/api/cnf/database.ini'.format(parentdir=parentdir)
+
+    logging.info('Using configuration file: {}'.format(config))
+    a = mlfb.mlfb(config_filename=config)
+
+    # Create schema
+    parser = ConfigParser()
+    parser.read(config)
+    sql = "CREATE SCHEMA IF NOT EXISTS  {} AUTHORIZATION {}".format(options.schema, parser.items('postgresql')[2][1])
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+    # Enable PostGIS
+    if options.create_extension:
+        sql = "CREATE EXTENSION postgis"
+        logging.debug(sql)
+        if not options.simulate:
+            a.execute(sql)
+
+    # Enable table func
+    if options.create_extension:
+        sql = "CREATE EXTENSION tablefunc"
+        logging.debug(sql)
+        if not options.simulate:
+            a.execute(sql)
+
+    sql = "SET SEARCH_PATH TO '{}, default'".format(options.schema)
+    logging.debug(sql)
+    if not options.simulate:
+        a.execute(sql)
+
+    # Change indexes of an existing database
+    if options.indexes_only or options.index_report:
+        detect_layout(a)
+        if options.index_report:
+            index_report(a, config)
+        else:
+            apply_index_profile(a, options.index_profile)
+        return
+
+    # Number changed rows of an existing database
+    if options.add_seq:
+        add_change_sequence(a)
+        return
+
+    # Only add catalog and wide layout tables to an existing database
+    if options.catalog_only:
+        detect_layout(a)
+        create_catalog(a, fill=True)
+        create_wide_tables(a)
+        if options.location_name_index:
+            create_location_index(a)
+        return
+
+    # Move existing data with names to compact layout
+    if options.migrate_compact:
+        options.layout = 'compact'
+        migrate_to_compact(a)
+        create_catalog(a)
+        return
+
+    # Move existing trigger partitioned data to native partitioning
+    if options.migrate:
+        if options.partitioning == 'trigger':
+            raise ValueError('Give target partitioning (range or dataset) with --partitioning')
+        detect_layout(a)
+        migrate_to_native(a)
+        create_catalog(a)
+        return
+
+    # Drop old tables
+    if options.force:
+        sql = "DROP TABLE IF EXISTS {schema}.data, {schema}.location, {schema}.dataset_version, {schema}.parameter, {schema}.dataset, {schema}.dataset_location, {schema}.type_dict, {schema}.dataset_dict, {schema}.parameter_dict, {schema}.data_wide, {schema}.dataset_header CASCADE;DROP SEQUENCE IF EXISTS {schema}.data_seq".format(schema=options.schema)
+        logging.debug(sql)
+        if not options.simulate:
+            a.execute(sql)
+
+
     # Create location table
     sql = """
     CREATE TABLE {schema}.location
@@ -159,44 +917,32 @@ def main():
     if not options.simulate:
         a.execute(sql)
 
+    if options.location_name_index:
+        create_location_index(a)
+
+    if options.layout == 'compact':
+        create_dictionaries(a)
+
     # Create data table
-    sql = """
-    CREATE TABLE {schema}.data
-    (
-      id SERIAL PRIMARY KEY,
-      type character varying(254),
-      dataset character varying(254),
-      "time" TIMESTAMP,
-      location_id bigint REFERENCES {schema}.location (id) ON DELETE NO ACTION,
-      parameter character varying(254),
-      value double precision,
-      "row" character varying(254)
-    )
-    WITH (
-      OIDS = FALSE
-    )
-    TABLESPACE pg_default;
-    """.format(schema=options.schema)
+    if options.partitioning == 'trigger':
+        create_trigger_partitioned_data(a)
+    else:
+        sql = data_table_sql()
+        logging.debug(sql)
+        if not options.simulate:
+            a.execute(sql)
 
-    logging.debug(sql)
-    if not options.simulate:
-        a.execute(sql)
+        sql = native_partition_function_sql()
+        logging.debug(sql)
+        if not options.simulate:
+            a.execute(sql)
 
-    # Indexes
-    sql = "CREATE INDEX row_idx ON {schema}.data (row)".format(schema=options.schema)
-    logging.debug(sql)
-    if not options.simulate:
-        a.execute(sql)
+    create_data_indexes(a)
 
-    sql = "CREATE INDEX location_id_idx ON {schema}.data (location_id)".format(schema=options.schema)
-    logging.debug(sql)
-    if not options.simulate:
-        a.execute(sql)
+    # Catalog of an empty data table is complete
+    create_catalog(a, fill=True)
 
-    sql = "CREATE UNIQUE INDEX idx_values_uniq ON {schema}.data (type, dataset, time, location_id, parameter)".format(options.schema)
-    logging.debug(sql)
-    if not options.simulate:
-        a.execute(sql)
+    create_wide_tables(a)
 
     #sql = "CREATE INDEX parameter_idx ON {schema}.data (parameter)".format(schema=options.schema)
     #logging.debug(sql)
@@ -217,6 +963,55 @@ if __name__=='__main__':
     parser.add_argument('--create_extension',
                         action='store_true',
                         help='Create postgis extension, default=False')
+    parser.add_argument('--catalog_only',
+                        action='store_true',
+                        help='Only create missing catalog and wide layout tables (and location name index with --location_name_index) to an existing schema and fill catalogs from data, default=False')
+    parser.add_argument('--location_name_index',
+                        action='store_true',
+                        help='Create unique index on location name. Existing names are then never added twice (see mlfdb.add_point_locations), default=False')
+    parser.add_argument('--add_seq',
+                        action='store_true',
+                        help='Only add seq column numbering inserted and updated rows to an existing data table, default=False')
+    parser.add_argument('--partitioning',
+                        type=str,
+                        default='trigger',
+                        choices=['trigger', 'range', 'dataset'],
+                        help='Partitioning of data table. trigger: monthly inherited tables filled by insert trigger, range: native monthly partitions, dataset: native monthly partitions sub-partitioned by dataset. Default trigger')
+    parser.add_argument('--migrate',
+                        action='store_true',
+                        help='Move existing trigger partitioned data table to native partitioning given with --partitioning, default=False')
+    parser.add_argument('--layout',
+                        type=str,
+                        default='long',
+                        choices=['long', 'compact'],
+                        help='Layout of data table. long: type, dataset and parameter names in each row, compact: names replaced by ids of dictionary tables. Default long')
+    parser.add_argument('--migrate_compact',
+                        action='store_true',
+                        help='Copy existing data table to compact layout with partitioning given with --partitioning, default=False')
+    parser.add_argument('--keep_old',
+                        action='store_true',
+                        help='Keep old data table as data_long after --migrate_compact, default=False')
+    parser.add_argument('--index_profile',
+                        type=str,
+                        default='default',
+                        choices=sorted(INDEX_PROFILES.keys()),
+                        help='Indexes of data table. default: row, location and unique index, covering: default and covering b-tree of get_rows filter for index-only scans, brin: default and BRIN on time, full: all. Default default')
+    parser.add_argument('--indexes_only',
+                        action='store_true',
+                        help='Only apply --index_profile to an existing data table, default=False')
+    parser.add_argument('--index_report',
+                        action='store_true',
+                        help='Apply each of --report_profiles and report index sizes and get_rows latency of --dataset, default=False')
+    parser.add_argument('--report_profiles',
+                        type=str,
+                        nargs='+',
+                        default=['default', 'covering', 'brin', 'full'],
+                        help='Profiles compared in index report, default all')
+    parser.add_argument('--dataset', type=str, default=None, help='Dataset read in index report')
+    parser.add_argument('--rowtype', type=str, default='feature', help='Row type read in index report, default feature')
+    parser.add_argument('--starttime', type=str, default=None, help='Start time of index report reads (YYYYMMDDHHMM)')
+    parser.add_argument('--endtime', type=str, default=None, help='End time of index report reads (YYYYMMDDHHMM)')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions of index report reads, default 3')
     parser.add_argument('--schema',
                         type=str,
                         default='traindata',
@@ -228,6 +1023,16 @@ if __name__=='__main__':
 
     options = parser.parse_args()
 
+    if options.index_report:
+        missing = ['--' + name for name in ('dataset', 'starttime', 'endtime') if getattr(options, name) is None]
+        if len(missing) > 0:
+            parser.error('--index_report needs {}'.format(', '.join(missing)))
+        for name in ('starttime', 'endtime'):
+            try:
+                dt.datetime.strptime(getattr(options, name), '%Y%m%d%H%M')
+            except ValueError:
+                parser.error('--{} should be given as YYYYMMDDHHMM'.format(name))
+
     debug=False
 
     logging_level = {'DEBUG':logging.DEBUG,